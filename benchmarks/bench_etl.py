@@ -0,0 +1,232 @@
+"""Benchmark each stage of the SQS-to-database ETL path.
+
+Synthetic SQS events are processed stage by stage, each stage in a fresh
+process so that its peak RSS can be reported:
+    envelope           sqs_event.split and extract_record
+    source_validation  source_model.validate_dict
+    conversion         CarbonIntensityRecord.from_source_model to a row
+    direct_conversion  sql_model.row_from_payload (replaces the two above)
+    db_write           CarbonIntensityTable.add_rows
+    end_to_end         lambda_processing.lambda_processing
+
+The database stages use SQLite, and also PostgreSQL if the TEST_DB_*
+environment variables are set (see README.md).
+
+Run from the repository root, e.g.:
+    python benchmarks/bench_etl.py --batch-size 10 --save-baseline b.json
+    python benchmarks/bench_etl.py --batch-size 10 --baseline b.json
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable
+
+from sqlmodel import SQLModel
+
+ROOT = Path(__file__).parents[1]
+sys.path.append(str(ROOT / 'function'))
+sys.path.append(str(ROOT / 'tests'))
+sys.path.append(str(ROOT / 'benchmarks'))
+
+import lambda_processing  # type: ignore # noqa: E402
+import source_model  # type: ignore # noqa: E402
+import sql_model  # type: ignore # noqa: E402
+import sqs_event  # type: ignore # noqa: E402
+import synthetic  # type: ignore # noqa: E402
+from sql_helper import (DBhelper, PSQLHelper,  # type: ignore # noqa: E402
+                        SQLiteHelper)
+
+STAGES = ('envelope', 'source_validation', 'conversion',
+          'direct_conversion', 'db_write', 'end_to_end')
+DB_STAGES = ('db_write', 'end_to_end')
+ALLOCATION_SAMPLES = 5
+
+
+def _payloads(event: dict[str, Any]) -> list[dict]:
+    return [sqs_event.extract_record(x) for x in sqs_event.split(event)]
+
+
+def _to_row(response: Any) -> dict[str, Any]:
+    record = sql_model.CarbonIntensityRecord.from_source_model(
+        response.data[0])
+    return sql_model.CarbonIntensityTable._create_row_from_model(record)
+
+
+def prepare_stage(stage: str, engine: Any
+                  ) -> tuple[Callable[[dict], Any], Callable[[Any], Any]]:
+    """Return functions to make a stage's input from an event, and run it."""
+    table = sql_model.CarbonIntensityTable
+    stages: dict[str, tuple[Callable[[dict], Any], Callable[[Any], Any]]] = {
+        'envelope': (lambda e: e, _payloads),
+        'source_validation': (
+            _payloads,
+            lambda x: [source_model.validate_dict(p) for p in x]),
+        'conversion': (
+            lambda e: [source_model.validate_dict(p) for p in _payloads(e)],
+            lambda x: [_to_row(r) for r in x]),
+        'direct_conversion': (
+            _payloads,
+            lambda x: [sql_model.row_from_payload(p) for p in x]),
+        'db_write': (
+            lambda e: [sql_model.row_from_payload(p) for p in _payloads(e)],
+            lambda x: table.add_rows(engine, x)),
+        'end_to_end': (
+            lambda e: e,
+            lambda x: lambda_processing.lambda_processing(x, engine))}
+    return stages[stage]
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p/100 * len(ordered)) - 1, 0)]
+
+
+def run_stage(stage: str, settings: Any, batch_size: int, invocations: int,
+              warmup: int, shape: str) -> dict[str, float]:
+    """Measure one stage; this runs in its own process."""
+    engine = None
+    if settings is not None:
+        engine = settings.create_sql_engine()
+        SQLModel.metadata.drop_all(engine)
+        SQLModel.metadata.create_all(engine)
+    make_input, run = prepare_stage(stage, engine)
+    total = warmup + invocations + ALLOCATION_SAMPLES
+    inputs = [make_input(synthetic.make_event(batch_size, i*batch_size,
+                                              shape))  # type: ignore
+              for i in range(total)]
+
+    for x in inputs[:warmup]:
+        run(x)
+    latencies = []
+    for x in inputs[warmup:warmup + invocations]:
+        t0 = time.perf_counter()
+        run(x)
+        latencies.append(time.perf_counter() - t0)
+
+    allocations = []
+    tracemalloc.start()
+    for x in inputs[warmup + invocations:]:
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        run(x)
+        allocations.append(tracemalloc.get_traced_memory()[1] - start)
+    tracemalloc.stop()
+
+    if engine is not None:
+        engine.dispose()
+    return {'records_per_s': batch_size * invocations / sum(latencies),
+            'p50_ms': percentile(latencies, 50) * 1e3,
+            'p99_ms': percentile(latencies, 99) * 1e3,
+            'alloc_peak_kb': sum(allocations) / len(allocations) / 1024,
+            'peak_rss_mb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def get_databases() -> dict[str, DBhelper]:
+    """Obtain SQLite, plus PostgreSQL if it is configured."""
+    databases: dict[str, DBhelper] = {'sqlite': SQLiteHelper()}
+    try:
+        databases['postgresql'] = PSQLHelper()
+    except KeyError:
+        print("TEST_DB_* parameter(s) not set: skipping PostgreSQL.")
+    return databases
+
+
+def get_settings(db: DBhelper) -> Any:
+    """Describe how to connect to a test database."""
+    return lambda_processing.DatabaseSettings(
+        db_user=db.user if isinstance(db, PSQLHelper) else None,
+        db_name=db.dbname,
+        db_password=db.password if isinstance(db, PSQLHelper) else None,
+        db_host=db.host if isinstance(db, PSQLHelper) else None,
+        db_port=db.port if isinstance(db, PSQLHelper) else None,
+        db_dialect_driver=db.dialect_driver)
+
+
+def compare(results: dict[str, dict[str, float]],
+            baseline: dict[str, dict[str, float]],
+            tolerance: float) -> list[str]:
+    """List the results which are worse than the baseline."""
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        old = baseline[key]
+        if result['records_per_s'] < old['records_per_s'] * (1 - tolerance):
+            regressions.append(
+                f"{key}: records/s {old['records_per_s']:.0f} -> "
+                f"{result['records_per_s']:.0f}")
+        if result['p99_ms'] > old['p99_ms'] * (1 + tolerance):
+            regressions.append(
+                f"{key}: p99 {old['p99_ms']:.3f} ms -> "
+                f"{result['p99_ms']:.3f} ms")
+    return regressions
+
+
+def main() -> int:
+    """Run the benchmark; return 1 if a regression is found."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--invocations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--shape', choices=synthetic.PAYLOAD_SHAPES,
+                        default='complete')
+    parser.add_argument('--stages', nargs='+', choices=STAGES,
+                        default=list(STAGES))
+    parser.add_argument('--baseline', type=Path,
+                        help="Compare with results saved in this file.")
+    parser.add_argument('--save-baseline', type=Path,
+                        help="Save the results in this file.")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed fractional slowdown (default 0.2).")
+    args = parser.parse_args()
+
+    databases = get_databases()
+    runs = [(stage, 'none', None) for stage in args.stages
+            if stage not in DB_STAGES]
+    runs += [(stage, name, get_settings(db)) for name, db in
+             databases.items() for stage in args.stages if stage in DB_STAGES]
+
+    results = {}
+    print(f"{'stage':<28} {'records/s':>10} {'p50 ms':>9} {'p99 ms':>9} "
+          f"{'alloc kB':>9} {'RSS MB':>7}")
+    context = multiprocessing.get_context('spawn')
+    try:
+        for stage, db_name, settings in runs:
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                result = executor.submit(
+                    run_stage, stage, settings, args.batch_size,
+                    args.invocations, args.warmup, args.shape).result()
+            key = f"{db_name}/{stage}"
+            results[key] = result
+            print(f"{key:<28} {result['records_per_s']:>10.0f} "
+                  f"{result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f} "
+                  f"{result['alloc_peak_kb']:>9.1f} "
+                  f"{result['peak_rss_mb']:>7.1f}")
+    finally:
+        for db in databases.values():
+            db.tearDown()
+
+    if args.save_baseline:
+        args.save_baseline.write_text(json.dumps(results, indent=2))
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()),
+                              args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""Compare the CPU time per row of the ways to write rows.
+
+    session_add      the ORM: Session.add for each row, then commit
+    insert_rebuilt   add_rows, building the INSERT statement every time
+    insert_cached    add_rows, reusing the statement built once per table
+
+Each write is one batch of new rows, in its own transaction. The CPU
+time is that of this process (so for PostgreSQL, excludes the server).
+The benchmark uses SQLite, and also PostgreSQL if the TEST_DB_*
+environment variables are set (see README.md).
+
+Run from the repository root, e.g.:
+    python benchmarks/bench_insert.py --batch-sizes 1 10 100
+"""
+
+import argparse
+import sys
+import time
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, ContextManager
+from unittest import mock
+
+from sqlmodel import Session, SQLModel
+
+ROOT = Path(__file__).parents[1]
+sys.path.append(str(ROOT / 'function'))
+sys.path.append(str(ROOT / 'tests'))
+sys.path.append(str(ROOT / 'benchmarks'))
+
+import sql_model  # type: ignore # noqa: E402
+from bench_etl import get_databases, get_settings  # noqa: E402
+
+RATINGS = sql_model.RATINGS
+TABLE = sql_model.CarbonIntensityTable
+
+
+def make_rows(first: int, n: int) -> list[dict[str, Any]]:
+    """Make n rows with distinct times."""
+    start = datetime(2020, 1, 1)
+    return [{'rating': RATINGS[i % len(RATINGS)], 'forecast': i % 500,
+             'actual': i % 400, 'time': start + timedelta(minutes=30*i)}
+            for i in range(first, first + n)]
+
+
+def session_add(engine: Any, rows: list[dict[str, Any]]) -> None:
+    """Write the rows as ORM objects."""
+    with Session(engine) as session:
+        for row in rows:
+            session.add(TABLE(**row))
+        session.commit()
+
+
+def rebuilt() -> ContextManager:
+    """Build the INSERT statement for every write, as before caching."""
+    return mock.patch.object(TABLE, '_insert_statement',
+                             TABLE._build_insert_statement)
+
+
+METHODS: dict[str, tuple[Callable[[Any, list], None],
+                         Callable[[], ContextManager]]] = {
+    'session_add': (session_add, nullcontext),
+    'insert_rebuilt': (TABLE.add_rows, rebuilt),
+    'insert_cached': (TABLE.add_rows, nullcontext)}
+
+
+def measure(engine: Any, method: str, batch_size: int, writes: int,
+            warmup: int) -> dict[str, float]:
+    """Time the writes of new batches of rows."""
+    SQLModel.metadata.drop_all(engine)
+    SQLModel.metadata.create_all(engine)
+    write, context = METHODS[method]
+    batches = [make_rows(i * batch_size, batch_size)
+               for i in range(warmup + writes)]
+    with context():
+        for rows in batches[:warmup]:
+            write(engine, rows)
+        cpu0, wall0 = time.process_time(), time.perf_counter()
+        for rows in batches[warmup:]:
+            write(engine, rows)
+        cpu, wall = (time.process_time() - cpu0,
+                     time.perf_counter() - wall0)
+    n_rows = batch_size * writes
+    return {'cpu_us_per_row': cpu / n_rows * 1e6,
+            'wall_us_per_row': wall / n_rows * 1e6}
+
+
+def main() -> None:
+    """Run each method for each database and batch size."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=[1, 10, 100])
+    parser.add_argument('--writes', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    args = parser.parse_args()
+
+    databases = get_databases()
+    print(f"{'database':<10} {'batch':>5} {'method':<15} "
+          f"{'cpu_us/row':>10} {'wall_us/row':>11} {'cpu_saved':>9}")
+    for name, db in databases.items():
+        engine = get_settings(db).create_sql_engine()
+        for batch_size in args.batch_sizes:
+            results = {method: measure(engine, method, batch_size,
+                                       args.writes, args.warmup)
+                       for method in METHODS}
+            orm_cpu = results['session_add']['cpu_us_per_row']
+            for method, result in results.items():
+                saved = 1 - result['cpu_us_per_row'] / orm_cpu
+                print(f"{name:<10} {batch_size:>5} {method:<15} "
+                      f"{result['cpu_us_per_row']:>10.1f} "
+                      f"{result['wall_us_per_row']:>11.1f} {saved:>9.0%}")
+        engine.dispose()
+        db.tearDown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Measure time-range query latency against table size, with/without index.
+
+Run from the repository root, e.g.:
+    python benchmarks/bench_time_index.py --sizes 1000 10000 100000
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from statistics import median
+
+from sqlalchemy import Engine, text
+from sqlmodel import SQLModel, create_engine
+
+sys.path.append(str(Path(__file__).parents[1] / 'function'))
+
+import sql_model  # type: ignore # noqa: E402
+
+START = datetime(2020, 1, 1)
+STEP = timedelta(minutes=30)
+
+
+def fill_table(engine: Engine, size: int) -> None:
+    """Add size half-hourly rows, in one transaction."""
+    rows = [{'rating': 'moderate', 'forecast': i % 400, 'actual': i % 400,
+             'time': START + i*STEP} for i in range(size)]
+    sql_model.CarbonIntensityTable.add_rows(engine, rows)
+
+
+def time_queries(engine: Engine, size: int, repeats: int) -> float:
+    """Return the median time (s) to read a 24h window of the table."""
+    durations = []
+    for i in range(repeats):
+        start = START + ((i * 7919) % max(size - 48, 1))*STEP
+        t0 = time.perf_counter()
+        results = sql_model.CarbonIntensityTable.read_range(
+            engine, start, start + timedelta(hours=24))
+        durations.append(time.perf_counter() - t0)
+        assert len(results) == min(48, size)  # nosec
+    return median(durations)
+
+
+def drop_indexes(engine: Engine) -> None:
+    """Remove every index on the table."""
+    with engine.begin() as connection:
+        table = sql_model.CarbonIntensityTable.__table__  # type: ignore
+        for index in table.indexes:
+            connection.execute(text(f'DROP INDEX {index.name}'))
+
+
+def main() -> None:
+    """Run the benchmark and print a table of results."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'indexed (ms)':>14} {'no index (ms)':>14}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            engine = create_engine(f"sqlite:///{temp_dir}/bench.db")
+            SQLModel.metadata.create_all(engine)
+            fill_table(engine, size)
+            indexed = time_queries(engine, size, args.repeats)
+            drop_indexes(engine)
+            unindexed = time_queries(engine, size, args.repeats)
+            engine.dispose()
+        print(f"{size:>10} {indexed*1e3:>14.3f} {unindexed*1e3:>14.3f}")
+
+
+if __name__ == '__main__':
+    main()
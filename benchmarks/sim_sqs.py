@@ -0,0 +1,328 @@
+"""Simulate the SQS trigger of the lambda, to compare its settings offline.
+
+Messages are sent to a simulated queue, synthetic or recorded from a
+JSONL file of SQS events or records (one per line). A simulated poller
+invokes lambda_function.lambda_handler as Lambda does:
+    batch size         up to this many messages per invocation
+    batching window    wait up to this long (s) to fill a batch
+    concurrency        up to this many containers, each with its own
+                       copy of lambda_function (its engine and caches)
+    visibility timeout failed messages are received again after this
+    maxReceiveCount    messages received more often go to the DLQ
+
+Time is simulated: each invocation runs for real, against a SQLite
+database shared by the containers, and advances the simulated time by
+its duration. The lambda's optional environment variables (README.md)
+apply, e.g. DEDUP_CACHE_SIZE or DB_POOL_MODE; NATURAL_KEY defaults
+to true, so that each time is stored once and rewrites are counted.
+
+For each combination of the settings, report the throughput, the
+latency from sending to acknowledgement, the number of containers,
+invocations, database connections and commits, the duplicate row
+writes, the receives, redeliveries and DLQ messages.
+
+Run from the repository root, e.g.:
+    python benchmarks/sim_sqs.py --batch-sizes 1 10 --windows 0 5 \\
+        --concurrency 1 4 --messages 500 --rate 20 --resend 0.3
+"""
+
+import argparse
+import importlib.util
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import ModuleType
+from typing import Any
+
+from sqlalchemy import event, text
+
+ROOT = Path(__file__).parents[1]
+sys.path.append(str(ROOT / 'function'))
+sys.path.append(str(ROOT / 'benchmarks'))
+
+import synthetic  # type: ignore # noqa: E402
+
+
+@dataclass
+class Settings:
+    """The trigger and queue settings being compared."""
+
+    batch_size: int
+    window: float
+    concurrency: int
+    visibility_timeout: float = 30
+    max_receive_count: int = 3
+    timeout: float = 3
+
+
+@dataclass
+class Message:
+    """A message in the simulated queue."""
+
+    record: dict[str, Any]
+    sent_at: float
+    visible_at: float
+    receives: int = 0
+
+
+@dataclass
+class Container:
+    """A lambda container: its own lambda_function module."""
+
+    module: ModuleType
+    busy_until: float = 0
+
+
+@dataclass
+class Counters:
+    """Totals over a simulation."""
+
+    invocations: int = 0
+    connections: int = 0
+    commits: int = 0
+    rows_written: int = 0
+    dlq: int = 0
+    latencies: list[float] = field(default_factory=list)
+
+
+class _Context:
+    """The part of the Lambda context used by the handler."""
+
+    def __init__(self, timeout: float):
+        self.deadline = time.perf_counter() + timeout
+
+    def get_remaining_time_in_millis(self) -> float:
+        """Milliseconds until the invocation times out."""
+        return (self.deadline - time.perf_counter()) * 1e3
+
+
+def synthetic_traffic(n: int, rate: float, resend: float,
+                      seed: int = 0) -> list[tuple[float, dict[str, Any]]]:
+    """Send n messages at random at a mean rate (/s).
+
+    A fraction, resend, of the messages is sent again within a minute
+    with a new message ID, as the upstream poller does.
+    """
+    rng = random.Random(seed)
+    traffic = []
+    t = 0.0
+    for i in range(n):
+        t += rng.expovariate(rate)
+        record = synthetic.make_record(i, rng=rng)
+        traffic.append((t, record))
+        if rng.random() < resend:
+            traffic.append((t + rng.uniform(0, 60),
+                            record | {'messageId': f'message-{i}-resend'}))
+    return sorted(traffic, key=lambda x: x[0])
+
+
+def recorded_traffic(path: Path, rate: float
+                     ) -> list[tuple[float, dict[str, Any]]]:
+    """Send the records of a JSONL file at a steady rate (/s)."""
+    records = []
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                item = json.loads(line)
+                records.extend(item['Records'] if 'Records' in item
+                               else [item])
+    return [((i + 1) / rate, x) for i, x in enumerate(records)]
+
+
+class Simulation:
+    """Run one combination of settings over the traffic."""
+
+    def __init__(self, settings: Settings,
+                 traffic: list[tuple[float, dict[str, Any]]]):
+        self.settings = settings
+        self.queue = [Message(record, t, t) for t, record in traffic]
+        self.now = 0.0
+        self.containers: list[Container] = []
+        self.counters = Counters()
+        self.receives = 0
+
+    def _on_connect(self, *_args: Any) -> None:
+        self.counters.connections += 1
+
+    def _on_commit(self, *_args: Any) -> None:
+        self.counters.commits += 1
+
+    def _on_execute(self, _conn: Any, _cursor: Any, statement: str,
+                    parameters: Any, _context: Any,
+                    executemany: bool) -> None:
+        if statement.lstrip().upper().startswith(
+                'INSERT INTO CARBONINTENSITYRECORD'):
+            self.counters.rows_written += (len(parameters) if executemany
+                                           else 1)
+
+    def _load_container(self) -> Container:
+        """Import a new copy of lambda_function, as a cold start does."""
+        spec = importlib.util.spec_from_file_location(
+            f'lambda_function_{len(self.containers)}',
+            ROOT / 'function' / 'lambda_function.py')
+        module = importlib.util.module_from_spec(spec)  # type: ignore
+        spec.loader.exec_module(module)  # type: ignore
+        event.listen(module.engine, 'connect', self._on_connect)
+        event.listen(module.engine, 'commit', self._on_commit)
+        event.listen(module.engine, 'before_cursor_execute',
+                     self._on_execute)
+        # The cache expires in simulated time
+        if module.written_cache is not None:
+            module.written_cache.clock = lambda: self.now
+        return Container(module)
+
+    def _container(self) -> tuple[Container, float]:
+        """Choose an idle container, or start one; return its init time."""
+        idle = [x for x in self.containers if x.busy_until <= self.now]
+        if idle:
+            return idle[0], 0.0
+        t0 = time.perf_counter()
+        container = self._load_container()
+        self.containers.append(container)
+        return container, time.perf_counter() - t0
+
+    def _next_batch(self) -> list[Message]:
+        """Advance to the next invocation and receive its messages."""
+        settings = self.settings
+        if len(self.containers) == settings.concurrency:
+            self.now = max(self.now, min(x.busy_until
+                                         for x in self.containers))
+        times = sorted(x.visible_at for x in self.queue)
+        first = max(self.now, times[0])
+        full = (times[settings.batch_size - 1]
+                if len(times) >= settings.batch_size else math.inf)
+        self.now = max(first, min(full, first + settings.window))
+
+        batch: list[Message] = []
+        for message in sorted(self.queue, key=lambda x: x.visible_at):
+            if (message.visible_at > self.now or
+                    len(batch) == settings.batch_size):
+                break
+            message.receives += 1
+            if message.receives > settings.max_receive_count:
+                self.queue.remove(message)
+                self.counters.dlq += 1
+                continue
+            self.receives += 1
+            message.visible_at = self.now + settings.visibility_timeout
+            batch.append(message)
+        return batch
+
+    def _invoke(self, batch: list[Message]) -> None:
+        container, init = self._container()
+        records = [x.record | {'attributes': x.record['attributes'] | {
+                       'ApproximateReceiveCount': str(x.receives)}}
+                   for x in batch]
+        t0 = time.perf_counter()
+        try:
+            response = container.module.lambda_handler(
+                {'Records': records}, _Context(self.settings.timeout))
+            failed = {x['itemIdentifier']
+                      for x in response['batchItemFailures']}
+        except Exception:  # pylint: disable=W0718
+            failed = {x['messageId'] for x in records}
+        end = self.now + init + time.perf_counter() - t0
+        container.busy_until = end
+        self.counters.invocations += 1
+        for message in batch:
+            if message.record['messageId'] not in failed:
+                self.queue.remove(message)
+                self.counters.latencies.append(end - message.sent_at)
+
+    def run(self) -> dict[str, float]:
+        """Process all of the traffic, then summarise."""
+        n_messages = len(self.queue)
+        first_sent = min(x.sent_at for x in self.queue)
+        while self.queue:
+            batch = self._next_batch()
+            if batch:
+                self._invoke(batch)
+        last = max(x.busy_until for x in self.containers)
+        latencies = sorted(self.counters.latencies)
+        with self.containers[0].module.engine.connect() as connection:
+            rows = connection.execute(text(
+                'SELECT count(*) FROM carbonintensityrecord')).scalar()
+        for container in self.containers:
+            container.module.engine.dispose()
+        return {
+            'messages_per_s': len(latencies) / (last - first_sent),
+            'p50_s': _percentile(latencies, 50),
+            'p99_s': _percentile(latencies, 99),
+            'containers': len(self.containers),
+            'invocations': self.counters.invocations,
+            'db_connections': self.counters.connections,
+            'commits': self.counters.commits,
+            'duplicate_writes': self.counters.rows_written - (rows or 0),
+            'receives': self.receives,
+            'redeliveries': self.receives - n_messages,
+            'dlq': self.counters.dlq}
+
+
+def _percentile(values: list[float], p: float) -> float:
+    if not values:
+        return math.nan
+    return values[max(math.ceil(p/100 * len(values)) - 1, 0)]
+
+
+def simulate(settings: Settings,
+             traffic: list[tuple[float, dict[str, Any]]]) -> dict[str, float]:
+    """Run the settings against a new SQLite database."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.environ |= {'DB_USER': '', 'DB_PASSWORD': '', 'DB_HOST': '',
+                       'DB_PORT': '', 'DB_DIALECT_DRIVER': 'sqlite',
+                       'DB_NAME': str(Path(temp_dir) / 'sim.db')}
+        os.environ.setdefault('LOG_LEVEL', 'CRITICAL')
+        os.environ.setdefault('NATURAL_KEY', 'true')
+        return Simulation(settings, traffic).run()
+
+
+def main() -> None:
+    """Simulate each combination of settings and print the results."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[10])
+    parser.add_argument('--windows', type=float, nargs='+', default=[0])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1])
+    parser.add_argument('--visibility-timeout', type=float, default=30)
+    parser.add_argument('--max-receive-count', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=3,
+                        help="Lambda timeout (s).")
+    parser.add_argument('--traffic', type=Path,
+                        help="JSONL of SQS events or records to send, "
+                        "instead of synthetic messages.")
+    parser.add_argument('--messages', type=int, default=200,
+                        help="Number of synthetic messages.")
+    parser.add_argument('--rate', type=float, default=10,
+                        help="Messages sent per second.")
+    parser.add_argument('--resend', type=float, default=0.2,
+                        help="Fraction of synthetic messages sent twice.")
+    args = parser.parse_args()
+    logging.getLogger().setLevel('CRITICAL')
+
+    traffic = (recorded_traffic(args.traffic, args.rate) if args.traffic
+               else synthetic_traffic(args.messages, args.rate, args.resend))
+    columns = ['messages_per_s', 'p50_s', 'p99_s', 'containers',
+               'invocations', 'db_connections', 'commits',
+               'duplicate_writes', 'receives', 'redeliveries', 'dlq']
+    print(f"{'batch':>5} {'window':>6} {'conc':>4} " +
+          ' '.join(f'{x:>{max(len(x), 8)}}' for x in columns))
+    for batch_size, window, concurrency in itertools.product(
+            args.batch_sizes, args.windows, args.concurrency):
+        settings = Settings(batch_size, window, concurrency,
+                            args.visibility_timeout, args.max_receive_count,
+                            args.timeout)
+        result = simulate(settings, traffic)
+        print(f"{batch_size:>5} {window:>6g} {concurrency:>4} " +
+              ' '.join(f'{result[x]:>{max(len(x), 8)}.3g}' for x in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Generate synthetic SQS events like those received by the lambda."""
+
+import hashlib
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Any, Literal
+
+PayloadShape = Literal['complete', 'sparse', 'padded']
+PAYLOAD_SHAPES: tuple[PayloadShape, ...] = ('complete', 'sparse', 'padded')
+
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+STEP = timedelta(minutes=30)
+RATINGS = ['very low', 'low', 'moderate', 'high', 'very high']
+
+
+def _timestamp(dt: datetime) -> str:
+    return dt.strftime('%Y-%m-%dT%H:%MZ')
+
+
+def make_payload(index: int, shape: PayloadShape = 'complete',
+                 rng: random.Random | None = None) -> dict[str, Any]:
+    """Create an API response for the index-th half-hour period.
+
+    'sparse' payloads have a null forecast or actual value, as the API
+    sometimes returns.
+    """
+    rng = rng or random.Random(index)
+    from_ts = START + index*STEP
+    forecast: int | None = rng.randint(0, 500)
+    actual: int | None = rng.randint(0, 500)
+    if shape == 'sparse':
+        if rng.random() < 0.5:
+            forecast = None
+        else:
+            actual = None
+    return {"data": [{"from": _timestamp(from_ts),
+                      "to": _timestamp(from_ts + STEP),
+                      "intensity": {"forecast": forecast, "actual": actual,
+                                    "index": rng.choice(RATINGS)}}]}
+
+
+def make_record(index: int, shape: PayloadShape = 'complete',
+                rng: random.Random | None = None) -> dict[str, Any]:
+    """Create one SQS record containing an API response.
+
+    'padded' records carry a large unused requestPayload, to show the
+    cost of fields which the lambda does not need.
+    """
+    request_payload: dict[str, Any] = {
+        "version": "0", "id": f"request-{index}",
+        "detail-type": "Scheduled Event", "source": "aws.scheduler",
+        "time": _timestamp(START + index*STEP), "region": "eu-west-2",
+        "resources": ["arn:aws:scheduler:eu-west-2:0:schedule/default/x"],
+        "detail": "{}"}
+    if shape == 'padded':
+        request_payload['resources'] = [
+            f"arn:aws:scheduler:eu-west-2:0:schedule/default/{i}"
+            for i in range(50)]
+    body = json.dumps({
+        "version": "1.0",
+        "timestamp": "2024-03-11T19:12:46.272Z",
+        "requestContext": {"requestId": f"request-{index}",
+                           "functionArn": "arn:aws:lambda:eu-west-2:0:x",
+                           "condition": "Success",
+                           "approximateInvokeCount": 1},
+        "requestPayload": request_payload,
+        "responseContext": {"statusCode": 200,
+                            "executedVersion": "$LATEST"},
+        "responsePayload": make_payload(index, shape, rng)})
+    return {
+        "messageId": f"message-{index}",
+        "receiptHandle": "AQEB" + "x" * 300,
+        "body": body,
+        "attributes": {"ApproximateReceiveCount": "1",
+                       "SentTimestamp": "1710184366324",
+                       "SenderId": "AROAZI2LIJEAPNF6A3XFC:x",
+                       "ApproximateFirstReceiveTimestamp": "1710184366334"},
+        "messageAttributes": {},
+        "md5OfBody": hashlib.md5(body.encode(),
+                                 usedforsecurity=False).hexdigest(),
+        "eventSource": "aws:sqs",
+        "eventSourceARN": "arn:aws:sqs:eu-west-2:0:queue",
+        "awsRegion": "eu-west-2"}
+
+
+def make_event(batch_size: int, first_index: int = 0,
+               shape: PayloadShape = 'complete',
+               seed: int = 0) -> dict[str, Any]:
+    """Create an SQS event of batch_size records with consecutive times."""
+    rng = random.Random(seed + first_index)
+    return {"Records": [make_record(i, shape, rng) for i in
+                        range(first_index, first_index + batch_size)]}
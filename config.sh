@@ -24,4 +24,10 @@ DB_USER=dbuser
 DB_NAME=postgres
 DB_HOST=testdbi.cvyycu2kubso.eu-west-2.rds.amazonaws.com
 # DB_PASSWORD  -> define this separately
-DB_DIALECT_DRIVER=postgresql+psycopg2
\ No newline at end of file
+DB_DIALECT_DRIVER=postgresql+psycopg2
+
+# Table options (see README.md), used by the lambda and the bootstrap
+ROLLUPS=false
+PARTITIONED=false
+COMPACT=false
+NATURAL_KEY=false
@@ -4,7 +4,8 @@
 # A script to create an AWS Lambda function within a Cloudformation stack.
 
 # Run this script with one of the following input arguments:
-entryFuncs=("clean" "stack" "update_function" "update_layer" "loglevel")
+entryFuncs=("clean" "stack" "update_function" "update_layer" "loglevel"
+            "bootstrap")
 
 # Additional arguments:
 #   "stack": Optional 2nd argument is a space-separated list
@@ -12,6 +13,8 @@ entryFuncs=("clean" "stack" "update_function" "update_layer" "loglevel")
 #            deploy, which become template parameters.
 #   "loglevel": Mandatory 2nd argument is a log level string
 #               e.g. INFO, DEBUG, ERROR, etc.
+#   "bootstrap": Optional 2nd argument "dedupe" first deletes the
+#                rows which prevent adding a unique index.
 
 ID_FILE_NAME="id.txt"
 
@@ -204,6 +207,29 @@ update_layer() {
     fi
 }
 
+bootstrap() {
+    # Create or migrate the database tables. The DB_* variables (see
+    # config.sh) must be set and the database must be reachable. The
+    # table options must match the lambda's.
+    if [ -d venv ]; then
+        source venv/bin/activate
+    else
+        _prepare_packages
+    fi
+    COMMAND=bootstrap
+    if [[ "$ARG2" == "dedupe" ]]; then
+        COMMAND=dedupe
+    fi
+    DB_PORT=$DB_PORT DB_USER=$DB_USER DB_NAME=$DB_NAME DB_HOST=$DB_HOST \
+    DB_PASSWORD=$DB_PASSWORD DB_DIALECT_DRIVER=$DB_DIALECT_DRIVER \
+    ROLLUPS=$ROLLUPS PARTITIONED=$PARTITIONED COMPACT=$COMPACT \
+    NATURAL_KEY=$NATURAL_KEY \
+    python3 function/schema.py $COMMAND
+    if [[ "$?" -eq 0 ]]; then
+        echo "Bootstrapped database $DB_NAME"
+    fi
+}
+
 ################################################
 
 ok=0
@@ -0,0 +1,201 @@
+"""Load a JSONL file of API responses or SQS events into the database.
+
+Each line holds one of:
+    an SQS event, as received by the lambda ({"Records": [...]})
+    a single SQS record ({"messageId": ..., "body": ...})
+    an API response ({"data": [...]})
+
+Lines are validated in a process pool and the rows are written in large
+batches, so that an outage can be recovered or a new environment seeded
+without replaying the queue. Invalid lines are logged and skipped.
+
+The database is configured by the DB_* environment variables, the
+rollups are maintained if ROLLUPS=true, and the table partitioned by
+month, with compact columns or keyed on the time is used if
+PARTITIONED=true, COMPACT=true or NATURAL_KEY=true, e.g.:
+    python function/backfill.py responses.jsonl --batch-size 10000
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, TextIO
+
+from sqlalchemy import Engine
+
+import lambda_processing
+import rollup
+import schema
+import sql_model
+import sql_model_base
+import sqs_event
+
+logger = logging.getLogger()
+
+
+@dataclass
+class BackfillStats:
+    """Counts of the work done, for progress reports."""
+
+    lines: int = 0
+    rows: int = 0
+    failures: int = 0
+    seconds: float = 0
+
+    def report(self, stream: TextIO = sys.stderr) -> None:
+        """Print the counts and throughput."""
+        rate = self.rows / self.seconds if self.seconds else 0
+        print(f"{self.lines} lines, {self.rows} rows written, "
+              f"{self.failures} failed, {rate:.0f} rows/s", file=stream)
+
+
+def payloads_from_line(line: str) -> list[dict[str, Any]]:
+    """Obtain the API responses from one line of the file."""
+    item = json.loads(line)
+    if not isinstance(item, dict):
+        raise ValueError("Line is not a JSON object.")
+    if 'Records' in item:
+        return [sqs_event.extract_record(x) for x in sqs_event.split(item)]
+    if 'body' in item:
+        return [sqs_event.extract_record(item)]
+    return [item]
+
+
+def convert_lines(first_line_number: int, lines: list[str],
+                  convert: Callable[[dict[str, Any]], dict[str, Any]]
+                  = sql_model.row_from_payload
+                  ) -> tuple[list[dict[str, Any]], int]:
+    """Convert lines to table rows; return the rows and the failure count.
+
+    This runs in a worker process.
+    """
+    rows: list[dict[str, Any]] = []
+    failures = 0
+    for i, line in enumerate(lines, first_line_number):
+        if not line.strip():
+            continue
+        try:
+            rows.extend(convert(x) for x in payloads_from_line(line))
+        except Exception as e:  # pylint: disable=W0718
+            logger.error("Line %d failed: %s", i, e)
+            failures += 1
+    return rows, failures
+
+
+def _chunks(lines: Iterable[str], chunk_size: int
+            ) -> Iterator[tuple[int, list[str]]]:
+    iterator = iter(lines)
+    line_number = 1
+    while chunk := list(islice(iterator, chunk_size)):
+        yield line_number, chunk
+        line_number += len(chunk)
+
+
+class _InlineExecutor(Executor):
+    """Convert in this process, e.g. with --workers 0."""
+
+    def submit(self, fn, /, *args, **kwargs):  # type: ignore
+        future: Future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+# pylint: disable=R0913,R0914
+def backfill(lines: Iterable[str], engine: Engine, *,
+             workers: int | None = None, chunk_size: int = 1000,
+             batch_size: int = 5000, report_interval: float = 5.0,
+             table: type[sql_model_base.DataModelTable]
+             = sql_model.CarbonIntensityTable) -> BackfillStats:
+    """Validate the lines in parallel and write the rows in batches.
+
+    Progress is reported to stderr every report_interval seconds. Set
+    workers to 0 to convert the lines in this process. The rows are
+    written to table.
+    """
+    stats = BackfillStats()
+    convert = sql_model.row_converter(table)
+    t0 = last_report = time.perf_counter()
+    pending: deque[tuple[int, Future]] = deque()
+    rows: list[dict[str, Any]] = []
+
+    def collect() -> None:
+        n_lines, future = pending.popleft()
+        new_rows, failures = future.result()
+        rows.extend(new_rows)
+        stats.lines += n_lines
+        stats.failures += failures
+
+    def write() -> None:
+        table.add_rows(engine, rows)
+        stats.rows += len(rows)
+        rows.clear()
+
+    executor = (_InlineExecutor() if workers == 0 else
+                ProcessPoolExecutor(workers))
+    with executor:
+        max_pending = 2 * (workers or os.cpu_count() or 1)
+        for first_line_number, chunk in _chunks(lines, chunk_size):
+            pending.append((len(chunk), executor.submit(
+                convert_lines, first_line_number, chunk, convert)))
+            if len(pending) >= max_pending:
+                collect()
+            if len(rows) >= batch_size:
+                write()
+            now = time.perf_counter()
+            if now - last_report >= report_interval:
+                stats.seconds = now - t0
+                stats.report()
+                last_report = now
+        while pending:
+            collect()
+        write()
+    stats.seconds = time.perf_counter() - t0
+    return stats
+# pylint: enable=R0913,R0914
+
+
+def main() -> int:
+    """Run the backfill; return 1 if any line failed."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('path', help="JSONL file, or - for stdin.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Processes used to validate (default: CPUs).")
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help="Lines per worker task.")
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help="Rows per database transaction.")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'WARNING'))
+
+    engine = lambda_processing.DatabaseSettings.from_environment(
+        ).create_sql_engine()
+    partitioned = os.getenv('PARTITIONED', '').lower() == 'true'
+    compact = os.getenv('COMPACT', '').lower() == 'true'
+    natural_key = os.getenv('NATURAL_KEY', '').lower() == 'true'
+    table = sql_model.carbon_intensity_table(partitioned, compact,
+                                             natural_key)
+    rollups = os.getenv('ROLLUPS', '').lower() == 'true'
+    if rollups:
+        rollup.enable(table)
+    schema.ensure_schema(engine, schema.metadata_for(
+        rollups, partitioned, compact, natural_key))
+    with (sys.stdin if args.path == '-' else
+          open(args.path, encoding='utf-8')) as lines:
+        stats = backfill(lines, engine, workers=args.workers,
+                         chunk_size=args.chunk_size,
+                         batch_size=args.batch_size, table=table)
+    engine.dispose()
+    stats.report()
+    return 1 if stats.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
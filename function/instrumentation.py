@@ -0,0 +1,94 @@
+"""Optional timings and counters for the stages of the lambda.
+
+The base Instrumentation class does nothing, with negligible overhead.
+EMFInstrumentation accumulates the values over an invocation and then
+prints them as a CloudWatch Embedded Metric Format (EMF) log line.
+"""
+
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, ContextManager, Iterator
+
+from sqlalchemy import Engine, event
+
+_NULL_CONTEXT = nullcontext()
+
+
+class Instrumentation:
+    """Record nothing: subclasses override these methods."""
+
+    def stage(self, name: str) -> ContextManager[None]:
+        """Time the code executed in this context as the named stage."""
+        del name
+        return _NULL_CONTEXT
+
+    def count(self, name: str, value: float = 1) -> None:
+        """Add a value to the named counter."""
+
+    def attach(self, engine: Engine) -> None:
+        """Count the database round trips made by the engine."""
+
+    def flush(self) -> None:
+        """Output and then reset the values."""
+
+
+NULL_INSTRUMENTATION = Instrumentation()
+
+
+class EMFInstrumentation(Instrumentation):
+    """Output timings (ms) and counters in CloudWatch EMF."""
+
+    def __init__(self, namespace: str,
+                 dimensions: dict[str, str] | None = None,
+                 emit: Callable[[str], Any] = print):
+        self.namespace = namespace
+        self.dimensions = dimensions or {}
+        self.emit = emit
+        self.timings: defaultdict[str, float] = defaultdict(float)
+        self.counters: defaultdict[str, float] = defaultdict(float)
+
+    @contextmanager
+    def _timer(self, name: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += (time.perf_counter() - t0) * 1e3
+
+    def stage(self, name: str) -> ContextManager[None]:
+        """Time the code executed in this context as the named stage."""
+        return self._timer(name)
+
+    def count(self, name: str, value: float = 1) -> None:
+        """Add a value to the named counter."""
+        self.counters[name] += value
+
+    def _on_execute(self, *_args: Any) -> None:
+        self.count('db_round_trips')
+
+    def attach(self, engine: Engine) -> None:
+        """Count the database round trips made by the engine."""
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def to_emf(self) -> dict[str, Any]:
+        """Create the EMF object for the current values."""
+        metrics = ([{'Name': f'{k}_ms', 'Unit': 'Milliseconds'}
+                    for k in self.timings] +
+                   [{'Name': k, 'Unit': 'Count'} for k in self.counters])
+        return {'_aws': {'Timestamp': int(time.time() * 1000),
+                         'CloudWatchMetrics': [{
+                             'Namespace': self.namespace,
+                             'Dimensions': [list(self.dimensions)],
+                             'Metrics': metrics}]},
+                **self.dimensions,
+                **{f'{k}_ms': v for k, v in self.timings.items()},
+                **self.counters}
+
+    def flush(self) -> None:
+        """Output and then reset the values."""
+        if self.timings or self.counters:
+            self.emit(json.dumps(self.to_emf()))
+        self.timings.clear()
+        self.counters.clear()
@@ -1,29 +1,194 @@
 """An AWS Lambda to transfer data from a AWS SQS queue to a database."""
 
+# pylint: disable=C0411
+# Imported first, to time the imports below when STARTUP_PROFILE=true
+from startup import profile  # isort: skip
+
+import asyncio
+import functools
 import logging
+import math
 import os
-from typing import Any
-
-from sqlmodel import SQLModel
+import time
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Any, Callable
 
+import instrumentation
 import lambda_processing
+import registry
+import sql_model
+import ttl_cache
+# pylint: enable=C0411
+
+if TYPE_CHECKING:
+    from sqlalchemy import Connection, Engine
+    from sqlalchemy.ext.asyncio import AsyncEngine
 
 logger = logging.getLogger()
 logger.setLevel(os.environ['LOG_LEVEL'])
 
-logger.info("Connecting to database.")
-db_settings = lambda_processing.DatabaseSettings(
-    db_user=os.environ['DB_USER'],
-    db_name=os.environ['DB_NAME'],
-    db_password=os.environ['DB_PASSWORD'],
-    db_host=os.environ['DB_HOST'],
-    db_port=os.environ['DB_PORT'],
-    db_dialect_driver=os.environ['DB_DIALECT_DRIVER'])
-engine = db_settings.create_sql_engine()
-SQLModel.metadata.create_all(engine)
+# Validate every SQS record field, and/or the body MD5 digest:
+strict_validation = os.getenv('SQS_STRICT_VALIDATION', '').lower() == 'true'
+check_md5 = os.getenv('SQS_CHECK_MD5', '').lower() == 'true'
+
+with profile.phase('engine'):
+    db_settings = lambda_processing.DatabaseSettings.from_environment()
+    engine = db_settings.create_sql_engine()
+
+# Set PARTITIONED=true to write to the table partitioned by month, or
+# COMPACT=true for the table with compact columns, and RETENTION_DAYS to
+# delete the months older than this. Set NATURAL_KEY=true to keep one row
+# per time in the default table:
+partitioned = os.getenv('PARTITIONED', '').lower() == 'true'
+compact = os.getenv('COMPACT', '').lower() == 'true'
+natural_key = os.getenv('NATURAL_KEY', '').lower() == 'true'
+# pylint: disable=C0103
+carbon_intensity_table = sql_model.carbon_intensity_table(
+    partitioned, compact, natural_key)
+# pylint: enable=C0103
+registry.DEFAULT_REGISTRY.register(
+    'carbonintensity', sql_model.row_converter(carbon_intensity_table),
+    carbon_intensity_table)
+retention_days = os.getenv('RETENTION_DAYS')
+
+# Set ROLLUPS=true to maintain the hourly, daily and monthly summaries:
+rollups = os.getenv('ROLLUPS', '').lower() == 'true'
+if rollups:
+    import rollup  # pylint: disable=C0415
+    rollup.enable(carbon_intensity_table)
+
+# Rows already written by this container are skipped if received again
+# unchanged; set DEDUP_CACHE_SIZE=0 to disable this.
+dedup_cache_size = int(os.getenv('DEDUP_CACHE_SIZE', '4096'))
+written_cache: ttl_cache.TTLCache[tuple, int] | None = (
+    ttl_cache.TTLCache(dedup_cache_size,
+                       float(os.getenv('DEDUP_CACHE_TTL', '3600')))
+    if dedup_cache_size > 0 else None)
+
+# Set METRICS_FORMAT=emf to log per-stage timings and counters:
+if os.getenv('METRICS_FORMAT', '').lower() == 'emf':
+    metrics: instrumentation.Instrumentation = (
+        instrumentation.EMFInstrumentation(
+            os.getenv('METRICS_NAMESPACE', 'LambdaDB'),
+            {'FunctionName': os.getenv('AWS_LAMBDA_FUNCTION_NAME', '')}))
+else:
+    metrics = instrumentation.NULL_INSTRUMENTATION
+metrics.attach(engine)
+
+
+def _start(bind: 'Engine | Connection') -> None:
+    """Check the schema and apply the retention.
+
+    This runs with the first event, so that the init does not connect
+    to the database, then reports the startup profile. Set
+    DB_SCHEMA_CHECK=false to skip the check when the deployment tooling
+    has already run the bootstrap. A failed check is raised; a failed
+    retention is only logged.
+    """
+    if os.getenv('DB_SCHEMA_CHECK', 'true').lower() != 'false':
+        with profile.phase('schema_check'):
+            import schema  # pylint: disable=C0415
+            schema.ensure_schema(bind, schema.metadata_for(
+                rollups, partitioned, compact, natural_key))
+    if retention_days:
+        try:
+            dropped = carbon_intensity_table.drop_before(
+                bind, datetime.now(timezone.utc)
+                - timedelta(days=float(retention_days)))
+            logger.info("Retention: dropped partitions %s.", dropped)
+        except Exception:  # pylint: disable=W0718
+            logger.exception("Retention failed.")
+    profile.report()
+
+
+class _Startup:  # pylint: disable=R0903
+    """Run the start until it succeeds, waiting longer after each failure.
+
+    Events are still processed while it fails, e.g. while the database
+    is briefly unreachable, and the start is retried with a later event.
+    """
+
+    def __init__(self, start: Callable[[], None], backoff: float = 1,
+                 max_backoff: float = 300,
+                 clock: Callable[[], float] = time.monotonic):
+        self.start = start
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.done = False
+        self._failures = 0
+        self._retry_at = -math.inf
 
+    def __call__(self) -> None:
+        """Start, unless done or waiting to retry."""
+        if self.done or self.clock() < self._retry_at:
+            return
+        try:
+            self.start()
+        except Exception:  # pylint: disable=W0718
+            delay = min(self.backoff * 2**self._failures, self.max_backoff)
+            self._failures += 1
+            self._retry_at = self.clock() + delay
+            logger.exception(
+                "Schema check failed: retrying after %g s. If it persists, "
+                "bootstrap the database with ./create.sh bootstrap, then "
+                "set DB_SCHEMA_CHECK=false.", delay)
+        else:
+            self.done = True
 
-def lambda_handler(event: dict[str, Any], _context_unused: Any) -> None:
+
+_first_invocation = _Startup(lambda: _start(engine))
+
+
+def lambda_handler(event: dict[str, Any],
+                   _context_unused: Any) -> dict[str, list[dict[str, str]]]:
     """Define the lambda function."""
     logger.debug('Event: %s', event)
-    lambda_processing.lambda_processing(event, engine)
+    _first_invocation()
+    try:
+        return lambda_processing.lambda_processing(
+            event, engine, strict=strict_validation, check_md5=check_md5,
+            instrumentation=metrics, written=written_cache)
+    finally:
+        metrics.flush()
+
+
+@functools.cache
+def _async_runtime() -> tuple[asyncio.AbstractEventLoop, 'AsyncEngine']:
+    """Create the event loop and async engine, once per container."""
+    async_engine = db_settings.create_async_sql_engine()
+    metrics.attach(async_engine.sync_engine)
+    return asyncio.new_event_loop(), async_engine
+
+
+def _start_async() -> None:
+    """Start with the async engine: see _start."""
+    loop, async_engine = _async_runtime()
+
+    async def start() -> None:
+        async with async_engine.connect() as connection:
+            await connection.run_sync(_start)
+    loop.run_until_complete(start())
+
+
+_first_async_invocation = _Startup(_start_async)
+
+
+def async_lambda_handler(event: dict[str, Any], _context_unused: Any
+                         ) -> dict[str, list[dict[str, str]]]:
+    """Define the lambda function, using an asyncio database driver.
+
+    To use this, set the template Handler to
+    lambda_function.async_lambda_handler
+    """
+    logger.debug('Event: %s', event)
+    _first_async_invocation()
+    loop, async_engine = _async_runtime()
+    try:
+        return loop.run_until_complete(
+            lambda_processing.lambda_processing_async(
+                event, async_engine, strict=strict_validation,
+                check_md5=check_md5, instrumentation=metrics,
+                written=written_cache))
+    finally:
+        metrics.flush()
@@ -1,22 +1,58 @@
 """Functions for implementing the lambda."""
 
-from typing import Any
+from typing import TYPE_CHECKING, Any, Literal
+import asyncio
 import logging
+import os
 from dataclasses import dataclass
 
-from sqlalchemy import Engine, URL
+from typing_extensions import Self
+
+from sqlalchemy import Connection, Engine, URL
+from sqlalchemy.event import listen
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
 from sqlmodel import create_engine
 
-import source_model
 import sqs_event
-import sql_model
+from instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from registry import DEFAULT_REGISTRY, Registry
+from sql_model_base import DataModelTable
+from ttl_cache import TTLCache
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncEngine
 
 logger = logging.getLogger()
 
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg',
+                 'sqlite': 'sqlite+aiosqlite'}
+
+RowGroups = dict[type[DataModelTable], list[tuple[str, dict[str, Any]]]]
+
 
+def _int_or_none(value: Any) -> int | None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# pylint: disable=R0902
 @dataclass(kw_only=True)
 class DatabaseSettings:
-    """Gather database connection information and create engine."""
+    """Gather database connection information and create engine.
+
+    The pool_mode is one of:
+      'single': keep one connection, suitable for a Lambda container.
+      'null': open a new connection for each use, for use behind a
+              connection pooler such as RDS Proxy or PgBouncer.
+      'queue': the SQLAlchemy default pool.
+
+    Timeouts are in seconds, except statement_timeout_ms, and are only
+    applied for PostgreSQL. With the 'null' pool mode, the statement
+    timeout is set at the start of each transaction (SET LOCAL), since
+    poolers such as PgBouncer reject it as a connection parameter.
+    """
 
     db_name: str
     db_user: str | None
@@ -24,13 +60,84 @@ class DatabaseSettings:
     db_port: str | int | None = None
     db_password: str | None = None
     db_dialect_driver: str = 'postgresql+psycopg2'
+    pool_mode: Literal['single', 'null', 'queue'] = 'single'
+    pool_pre_ping: bool = True
+    pool_recycle: int = 300
+    connect_timeout: int | None = None
+    statement_timeout_ms: int | None = None
 
-    def create_sql_engine(self) -> Engine:
-        """Create a sqlalchemy/sqlmodel Engine instance."""
-        try:
-            db_port_int = int(self.db_port)  # type: ignore
-        except (TypeError, ValueError):
-            db_port_int = None
+    @classmethod
+    def from_environment(cls) -> Self:
+        """Read the settings from the DB_* environment variables."""
+        pool_recycle = _int_or_none(os.getenv('DB_POOL_RECYCLE'))
+        return cls(db_user=os.environ['DB_USER'],
+                   db_name=os.environ['DB_NAME'],
+                   db_password=os.environ['DB_PASSWORD'],
+                   db_host=os.environ['DB_HOST'],
+                   db_port=os.environ['DB_PORT'],
+                   db_dialect_driver=os.environ['DB_DIALECT_DRIVER'],
+                   pool_mode=os.getenv(
+                       'DB_POOL_MODE', 'single'),  # type: ignore
+                   pool_pre_ping=os.getenv(
+                       'DB_POOL_PRE_PING', 'true').lower() != 'false',
+                   pool_recycle=(cls.pool_recycle if pool_recycle is None
+                                 else pool_recycle),
+                   connect_timeout=_int_or_none(
+                       os.getenv('DB_CONNECT_TIMEOUT')),
+                   statement_timeout_ms=_int_or_none(
+                       os.getenv('DB_STATEMENT_TIMEOUT_MS')))
+
+    def _engine_options(self, backend_name: str,
+                        is_async: bool = False) -> dict[str, Any]:
+        if self.pool_mode == 'null':
+            options: dict[str, Any] = {'poolclass': NullPool}
+        elif self.pool_mode == 'single':
+            options = {'poolclass': (AsyncAdaptedQueuePool if is_async
+                                     else QueuePool),
+                       'pool_size': 1, 'max_overflow': 0}
+        elif self.pool_mode == 'queue':
+            options = {}
+        else:
+            raise ValueError(f"Unknown pool mode '{self.pool_mode}'.")
+        if self.pool_mode != 'null':
+            options['pool_pre_ping'] = self.pool_pre_ping
+            options['pool_recycle'] = self.pool_recycle
+
+        connect_args: dict[str, Any] = {}
+        # Otherwise, set per transaction by _set_statement_timeout
+        startup_timeout = (self.statement_timeout_ms is not None and
+                           self.pool_mode != 'null')
+        if backend_name == 'postgresql' and is_async:
+            # The asyncpg names for these settings:
+            if self.connect_timeout is not None:
+                connect_args['timeout'] = self.connect_timeout
+            if startup_timeout:
+                connect_args['server_settings'] = {
+                    'statement_timeout': str(self.statement_timeout_ms)}
+        elif backend_name == 'postgresql':
+            if self.connect_timeout is not None:
+                connect_args['connect_timeout'] = self.connect_timeout
+            if startup_timeout:
+                connect_args['options'] = (
+                    f'-c statement_timeout={self.statement_timeout_ms}')
+        if connect_args:
+            options['connect_args'] = connect_args
+        return options
+
+    def _set_statement_timeout(self, engine: Engine) -> None:
+        """Set the statement timeout in each transaction, if needed."""
+        if (self.statement_timeout_ms is None or self.pool_mode != 'null'
+                or engine.dialect.name != 'postgresql'):
+            return
+        statement = ('SET LOCAL statement_timeout = '
+                     f'{int(self.statement_timeout_ms)}')
+
+        def begin(connection: Connection) -> None:
+            connection.exec_driver_sql(statement)
+        listen(engine, 'begin', begin)
+
+    def _url(self, dialect_driver: str) -> URL:
+        db_port_int = _int_or_none(self.db_port)
 
         if self.db_password == '':  # nosec
             self.db_password = None
@@ -39,28 +146,262 @@ class DatabaseSettings:
         if self.db_host == '':
             self.db_host = None
 
-        url_object = URL.create(
-            self.db_dialect_driver,
+        return URL.create(
+            dialect_driver,
             username=self.db_user,
             password=self.db_password,
             host=self.db_host,
             database=self.db_name,
             port=db_port_int
         )
-        return create_engine(url_object)
+
+    def create_sql_engine(self) -> Engine:
+        """Create a sqlalchemy/sqlmodel Engine instance."""
+        url_object = self._url(self.db_dialect_driver)
+        engine = create_engine(
+            url_object, **self._engine_options(url_object.get_backend_name()))
+        self._set_statement_timeout(engine)
+        return engine
+
+    def create_async_sql_engine(self) -> 'AsyncEngine':
+        """Create an AsyncEngine, using the asyncio driver for the dialect.
+
+        This requires the asyncpg (PostgreSQL) or aiosqlite package.
+        """
+        backend_name = URL.create(self.db_dialect_driver).get_backend_name()
+        if backend_name not in ASYNC_DRIVERS:
+            raise ValueError(
+                f"No async driver is known for '{self.db_dialect_driver}'.")
+        # Imported here as it is slow, and only the async handler needs it
+        from sqlalchemy.ext.asyncio import (  # pylint: disable=C0415
+            create_async_engine)
+        url_object = self._url(ASYNC_DRIVERS[backend_name])
+        engine = create_async_engine(
+            url_object, **self._engine_options(backend_name, True))
+        self._set_statement_timeout(engine.sync_engine)
+        return engine
+# pylint: enable=R0902
+
+
+def batch_response(failed_message_ids: list[str]
+                   ) -> dict[str, list[dict[str, str]]]:
+    """Create the partial batch response understood by the SQS trigger."""
+    return {'batchItemFailures': [{'itemIdentifier': x}
+                                  for x in failed_message_ids]}
+
+
+def _log_record_failure(message_id: Any, e: Exception) -> None:
+    logger.error("Processing failed for message %s.", message_id)
+    logger.error(e)
+
+
+def _log_event_failure(event: dict[str, Any], e: Exception) -> None:
+    logger.error("Event data extraction failed.")
+    logger.error(e)
+    logger.error('Event: %s', event)
+
+
+def _convert_records(  # pylint: disable=R0913
+        records: list[dict[str, Any]], failed_ids: list[str], strict: bool,
+        check_md5: bool, instrumentation: Instrumentation,
+        registry: Registry) -> RowGroups:
+    """Validate each record and convert it to a row, grouped by table."""
+    groups: RowGroups = {}
+    for record in records:
+        message_id = record.get('messageId')
+        try:
+            source = registry.lookup(record)
+            with instrumentation.stage('extract'):
+                payload_dict = sqs_event.extract_record(record, strict,
+                                                        check_md5)
+            with instrumentation.stage('convert'):
+                row = source.convert(payload_dict)
+            logger.debug("Extracted data: %s", row)
+            instrumentation.count('bytes', len(record['body']))
+            groups.setdefault(source.table, []).append(
+                (record['messageId'], row))
+        except Exception as e:  # pylint: disable=W0718
+            _log_record_failure(message_id, e)
+            if not isinstance(message_id, str):
+                # The failure cannot be reported, so fail the whole batch
+                raise e
+            failed_ids.append(message_id)
+    return groups
+
+
+def _row_key(table: type[DataModelTable], row: dict[str, Any]) -> tuple:
+    return (table.__tablename__,  # type: ignore
+            *(row[k] for k in table.__natural_key__))
+
+
+def _row_hash(row: dict[str, Any]) -> int:
+    return hash(tuple(row.items()))
+
+
+def _skip_written(groups: RowGroups, written: TTLCache[tuple, int] | None,
+                  instrumentation: Instrumentation) -> RowGroups:
+    """Remove rows which this container has already written unchanged.
+
+    Rows of tables without a natural key are kept: each is a new record,
+    even if it repeats an earlier one.
+    """
+    if written is None:
+        return groups
+    new_groups: RowGroups = {}
+    skipped = 0
+    for table, valid in groups.items():
+        new = [x for x in valid if not table.__natural_key__ or
+               written.get(_row_key(table, x[1])) != _row_hash(x[1])]
+        skipped += len(valid) - len(new)
+        if new:
+            new_groups[table] = new
+    instrumentation.count('duplicates', skipped)
+    return new_groups
 
 
-def lambda_processing(event: dict[str, Any], engine: Engine):
-    """ETL: extract event data; validate; add to database."""
+def _remember_written(groups: RowGroups, failed_ids: list[str],
+                      written: TTLCache[tuple, int] | None) -> None:
+    if written is None:
+        return
+    failed = set(failed_ids)
+    for table, valid in groups.items():
+        if not table.__natural_key__:
+            continue
+        for message_id, row in valid:
+            if message_id not in failed:
+                written.set(_row_key(table, row), _row_hash(row))
+
+
+def _write_rows(engine: Engine, table: type[DataModelTable],
+                valid: list[tuple[str, dict[str, Any]]],
+                failed_ids: list[str]) -> None:
+    """Write all rows, or if that fails, write them one at a time."""
     try:
-        for payload_dict in sqs_event.extract(event):
-            source_api_data = source_model.validate_dict(payload_dict)
-            logger.debug("Extracted data: %s", source_api_data)
-            sql_model.CarbonIntensityTable.add_from_source_model(
-                engine, source_api_data.data[0])
+        table.add_rows(engine, [x[1] for x in valid])
+    except Exception as e:  # pylint: disable=W0718
+        logger.error("Batch write to %s failed.", table.__name__)
+        logger.error(e)
+        if len(valid) == 1:
+            failed_ids.append(valid[0][0])
+            return
+        # Isolate the bad record(s) by writing each one separately
+        for message_id, row in valid:
+            try:
+                table.add_rows(engine, [row])
+            except Exception as e_record:  # pylint: disable=W0718
+                _log_record_failure(message_id, e_record)
+                failed_ids.append(message_id)
+
+
+def lambda_processing(  # pylint: disable=R0913
+        event: dict[str, Any], engine: Engine, *,
+        strict: bool = False, check_md5: bool = False,
+        instrumentation: Instrumentation = NULL_INSTRUMENTATION,
+        written: TTLCache[tuple, int] | None = None,
+        registry: Registry = DEFAULT_REGISTRY
+        ) -> dict[str, list[dict[str, str]]]:
+    """ETL: extract event data; validate; add to database.
+
+    Each message is processed independently: the IDs of any messages
+    which failed are returned, so that only those are retried by SQS.
+    Set strict to validate every field of the SQS records.
+
+    The registry gives the conversion and table for each kind of
+    message: the rows for each table are written in one batch.
 
+    Optionally, written caches the natural key and content hash of the
+    rows written: rows found unchanged in it are not written again.
+    """
+    try:
+        records = sqs_event.split(event)
+        failed_ids: list[str] = []
+        groups = _convert_records(records, failed_ids, strict, check_md5,
+                                  instrumentation, registry)
+        groups = _skip_written(groups, written, instrumentation)
     except Exception as e:
-        logger.error("Event data extraction failed.")
+        _log_event_failure(event, e)
+        raise e
+
+    if groups:
+        with instrumentation.stage('write'):
+            for table, valid in groups.items():
+                _write_rows(engine, table, valid, failed_ids)
+        _remember_written(groups, failed_ids, written)
+
+    instrumentation.count('records', len(records))
+    instrumentation.count('failures', len(failed_ids))
+    return batch_response(failed_ids)
+
+
+async def _write_rows_async(engine: 'AsyncEngine',
+                            table: type[DataModelTable],
+                            valid: list[tuple[str, dict[str, Any]]],
+                            failed_ids: list[str]) -> None:
+    """Write all rows, or if that fails, write them one at a time."""
+    try:
+        await table.add_rows_async(engine, [x[1] for x in valid])
+    except Exception as e:  # pylint: disable=W0718
+        logger.error("Batch write to %s failed.", table.__name__)
         logger.error(e)
-        logger.error('Event: %s', event)
+        if len(valid) == 1:
+            failed_ids.append(valid[0][0])
+            return
+        for message_id, row in valid:
+            try:
+                await table.add_rows_async(engine, [row])
+            except Exception as e_record:  # pylint: disable=W0718
+                _log_record_failure(message_id, e_record)
+                failed_ids.append(message_id)
+
+
+async def _write_groups_async(engine: 'AsyncEngine', groups: RowGroups,
+                              failed_ids: list[str]) -> None:
+    for table, valid in groups.items():
+        await _write_rows_async(engine, table, valid, failed_ids)
+
+
+async def lambda_processing_async(  # pylint: disable=R0913
+        event: dict[str, Any], engine: 'AsyncEngine', *,
+        strict: bool = False, check_md5: bool = False,
+        instrumentation: Instrumentation = NULL_INSTRUMENTATION,
+        written: TTLCache[tuple, int] | None = None,
+        registry: Registry = DEFAULT_REGISTRY,
+        chunk_size: int = 100) -> dict[str, list[dict[str, str]]]:
+    """ETL as lambda_processing, but writing with an asyncio engine.
+
+    Records are converted and written in chunks (one transaction per
+    table each), and each chunk is converted while the previous one is
+    being written.
+    """
+    failed_ids: list[str] = []
+    written_groups: list[RowGroups] = []
+    pending: asyncio.Task | None = None
+    try:
+        records = sqs_event.split(event)
+        for start in range(0, len(records), chunk_size):
+            groups = _convert_records(records[start:start + chunk_size],
+                                      failed_ids, strict, check_md5,
+                                      instrumentation, registry)
+            groups = _skip_written(groups, written, instrumentation)
+            if not groups:
+                continue
+            written_groups.append(groups)
+            if pending is not None:
+                with instrumentation.stage('write'):
+                    await pending
+            pending = asyncio.create_task(
+                _write_groups_async(engine, groups, failed_ids))
+            await asyncio.sleep(0)  # Let the write start
+    except Exception as e:
+        _log_event_failure(event, e)
         raise e
+    finally:
+        if pending is not None:
+            with instrumentation.stage('write'):
+                await pending
+
+    for groups in written_groups:
+        _remember_written(groups, failed_ids, written)
+    instrumentation.count('records', len(records))
+    instrumentation.count('failures', len(failed_ids))
+    return batch_response(failed_ids)
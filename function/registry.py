@@ -0,0 +1,58 @@
+"""Map each kind of SQS message to its conversion and database table.
+
+A message's kind is given by its message attribute (by default named
+'source'), or is the registry's default kind if it has no such
+attribute. This allows one lambda to ingest several feeds.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import sql_model
+import sql_model_base
+
+RowConverter = Callable[[dict[str, Any]], dict[str, Any]]
+
+
+@dataclass(frozen=True)
+class Source:
+    """Convert an enqueued payload to a row, and the table to write it."""
+
+    convert: RowConverter
+    table: type[sql_model_base.DataModelTable]
+
+
+class Registry:
+    """Look up the Source of each SQS record."""
+
+    def __init__(self, default: str | None = None,
+                 attribute: str = 'source'):
+        self.default = default
+        self.attribute = attribute
+        self.sources: dict[str, Source] = {}
+
+    def register(self, name: str, convert: RowConverter,
+                 table: type[sql_model_base.DataModelTable]) -> None:
+        """Add or replace the Source of the named kind of message."""
+        self.sources[name] = Source(convert, table)
+
+    def discriminator(self, record: dict[str, Any]) -> str | None:
+        """Obtain the kind of message from the SQS record."""
+        attribute = (record.get('messageAttributes') or {}).get(
+            self.attribute)
+        if isinstance(attribute, dict) and 'stringValue' in attribute:
+            return attribute['stringValue']
+        return self.default
+
+    def lookup(self, record: dict[str, Any]) -> Source:
+        """Find the Source of the SQS record; raise ValueError if none."""
+        name = self.discriminator(record)
+        try:
+            return self.sources[name]  # type: ignore
+        except KeyError as e:
+            raise ValueError(f"No source registered for '{name}'.") from e
+
+
+DEFAULT_REGISTRY = Registry(default='carbonintensity')
+DEFAULT_REGISTRY.register('carbonintensity', sql_model.row_from_payload,
+                          sql_model.CarbonIntensityTable)
@@ -0,0 +1,218 @@
+"""Hourly, daily and monthly summaries of the carbon intensity data.
+
+Each summary (rollup) row holds the count, the min/mean/max of forecast
+and actual, and the count of each rating, for one time bucket. Once
+enable() is called, the buckets affected by each write to
+CarbonIntensityTable are recomputed in the same transaction: hours from
+the records, days from the hours and months from the days. Long-range
+queries can then read a few rollup rows with read_rollup().
+
+On PostgreSQL, the writers to the same month take turns to update its
+rollups, holding an advisory lock until they commit: otherwise, under
+READ COMMITTED, each would recompute a bucket without the other's rows.
+
+The rollup table has its own MetaData, so it is only created when
+requested, e.g. by schema.bootstrap with ROLLUPS=true.
+"""
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, ClassVar, Literal, get_args
+
+from sqlalchemy import Connection, Engine, MetaData, and_, func, or_
+from sqlmodel import select
+
+import source_model
+import sql_model
+import sql_model_base
+import sqlmodel
+
+Granularity = Literal['hour', 'day', 'month']
+GRANULARITIES: tuple[Granularity, ...] = get_args(Granularity)
+RATING_COLUMNS = {x: 'rating_' + x.replace(' ', '_')
+                  for x in get_args(source_model.Rating)}
+VALUES = ('forecast', 'actual')
+# Any constant shared by all processes writing to the same database
+ROLLUP_LOCK_ID = 0x726f6c6c
+# The time ranges read per query: each adds to the depth of the WHERE
+# clause, which SQLite limits (to 1000)
+RANGES_PER_QUERY = 100
+
+rollup_metadata = MetaData()
+
+
+# pylint: disable=R0902,R0903
+class CarbonIntensityRollup(sqlmodel.SQLModel):
+    """Summary of the records in one time bucket."""
+
+    granularity: str
+    bucket: datetime
+    count: int
+    forecast_min: int
+    forecast_mean: float
+    forecast_max: int
+    actual_min: int
+    actual_mean: float
+    actual_max: int
+    rating_very_low: int
+    rating_low: int
+    rating_moderate: int
+    rating_high: int
+    rating_very_high: int
+# pylint: enable=R0902,R0903
+
+
+class CarbonIntensityRollupTable(
+        CarbonIntensityRollup,
+        sql_model_base.ModelTable[CarbonIntensityRollup],
+        table=True):
+    """Provides the database interface (does not perform validation)."""
+
+    metadata = rollup_metadata
+    __natural_key__ = ('granularity', 'bucket')
+    # The table of records summarised, set by enable()
+    __source__: ClassVar[type[sql_model_base.DataModelTable]] = (
+        sql_model.CarbonIntensityTable)
+
+    id: int | None = sqlmodel.Field(default=None, primary_key=True)
+
+
+def _naive_utc(time: datetime) -> datetime:
+    if time.tzinfo is None:
+        return time
+    return time.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def bucket_start(time: datetime, granularity: Granularity) -> datetime:
+    """Obtain the start of the bucket containing the (UTC) time."""
+    time = _naive_utc(time).replace(minute=0, second=0, microsecond=0)
+    if granularity == 'hour':
+        return time
+    time = time.replace(hour=0)
+    if granularity == 'day':
+        return time
+    return time.replace(day=1)
+
+
+def bucket_end(start: datetime, granularity: Granularity) -> datetime:
+    """Obtain the end of the bucket which begins at start."""
+    if granularity == 'hour':
+        return start + timedelta(hours=1)
+    if granularity == 'day':
+        return start + timedelta(days=1)
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+def _ranges(buckets: set[datetime], granularity: Granularity
+            ) -> list[tuple[datetime, datetime]]:
+    """Merge the buckets into contiguous [start, end) time ranges."""
+    ranges: list[tuple[datetime, datetime]] = []
+    for start in sorted(buckets):
+        end = bucket_end(start, granularity)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def _unit_rollup(row: Any) -> dict[str, Any]:
+    """Represent one record as the rollup of a single record."""
+    rollup: dict[str, Any] = {'count': 1}
+    for k in VALUES:
+        value = getattr(row, k)
+        rollup |= {f'{k}_min': value, f'{k}_mean': value, f'{k}_max': value}
+    for rating, column in RATING_COLUMNS.items():
+        rollup[column] = int(row.rating == rating)
+    return rollup
+
+
+def combine(rollups: list[dict[str, Any]]) -> dict[str, Any]:
+    """Summarise several rollups as one."""
+    count = sum(x['count'] for x in rollups)
+    combined: dict[str, Any] = {'count': count}
+    for k in VALUES:
+        combined[f'{k}_min'] = min(x[f'{k}_min'] for x in rollups)
+        combined[f'{k}_max'] = max(x[f'{k}_max'] for x in rollups)
+        combined[f'{k}_mean'] = sum(x[f'{k}_mean'] * x['count']
+                                    for x in rollups) / count
+    for column in RATING_COLUMNS.values():
+        combined[column] = sum(x[column] for x in rollups)
+    return combined
+
+
+def _read_parts(connection: Connection, granularity: Granularity,
+                buckets: set[datetime]) -> list[tuple[datetime, dict]]:
+    """Read the records (for hours) or finer rollups in the buckets."""
+    if granularity == 'hour':
+        table: Any = CarbonIntensityRollupTable.__source__
+        column = table.time
+    else:
+        table = CarbonIntensityRollupTable
+        column = table.bucket
+    ranges = _ranges(buckets, granularity)
+    parts: list[tuple[datetime, dict]] = []
+    for i in range(0, len(ranges), RANGES_PER_QUERY):
+        condition = or_(*[and_(column >= start, column < end)
+                          for start, end in ranges[i:i + RANGES_PER_QUERY]])
+        if granularity == 'hour':
+            records = connection.execute(select(
+                table.time, table.rating, table.forecast,
+                table.actual).where(condition))
+            parts += [(x.time, _unit_rollup(x)) for x in records]
+        else:
+            finer = GRANULARITIES[GRANULARITIES.index(granularity) - 1]
+            rollups = connection.execute(select(table).where(
+                condition, table.granularity == finer)).mappings()
+            parts += [(x['bucket'], dict(x)) for x in rollups]
+    return parts
+
+
+def _lock_months(connection: Connection, months: set[datetime]) -> None:
+    """Wait for the other writers to the months to commit (PostgreSQL)."""
+    if connection.dialect.name != 'postgresql':
+        return
+    # In order, so that two writers cannot wait for each other
+    for month in sorted(months):
+        # Held until the end of the transaction
+        connection.execute(select(func.pg_advisory_xact_lock(
+            ROLLUP_LOCK_ID, 12*month.year + month.month - 1)))
+
+
+def update_rollups(connection: Connection,
+                   rows: list[dict[str, Any]]) -> None:
+    """Recompute every rollup bucket which contains one of the rows."""
+    times = {row['time'] for row in rows}
+    _lock_months(connection, {bucket_start(x, 'month') for x in times})
+    for granularity in GRANULARITIES:
+        buckets = {bucket_start(x, granularity) for x in times}
+        parts: dict[datetime, list[dict[str, Any]]] = {}
+        for time, rollup in _read_parts(connection, granularity, buckets):
+            parts.setdefault(bucket_start(time, granularity),
+                             []).append(rollup)
+        rollups = [{'granularity': granularity, 'bucket': bucket,
+                    **combine(parts[bucket])}
+                   for bucket in sorted(buckets) if bucket in parts]
+        CarbonIntensityRollupTable.write_rows(connection, rollups)
+
+
+def enable(table: type[sql_model_base.DataModelTable]
+           = sql_model.CarbonIntensityTable) -> None:
+    """Maintain the rollups when writing to the carbon intensity table."""
+    CarbonIntensityRollupTable.__source__ = table
+    if update_rollups not in table.__after_write__:
+        table.__after_write__ += (update_rollups,)
+
+
+def read_rollup(engine: Engine, granularity: Granularity, start: datetime,
+                end: datetime) -> list[CarbonIntensityRollup]:
+    """Obtain the rollups of the buckets beginning in [start, end)."""
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Unknown rollup granularity '{granularity}'.")
+    table: Any = CarbonIntensityRollupTable
+    statement = select(table).where(
+        table.granularity == granularity,
+        table.bucket >= _naive_utc(start),
+        table.bucket < _naive_utc(end)).order_by(table.bucket)
+    return table.read_all(engine, statement)
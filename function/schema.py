@@ -0,0 +1,280 @@
+"""Create or migrate the database schema only when the models change.
+
+A fingerprint of the table definitions is stored in a small version
+table. Checking it costs a single query, and the tables and indexes are
+only created when the stored fingerprint differs from the models. On
+PostgreSQL, an advisory lock ensures only one process bootstraps at a
+time. A unique index is not added to an existing table which repeats
+its columns: this is logged, and the version is not recorded, so that
+it is checked again.
+
+Run this file directly to bootstrap the database configured by the DB_*
+environment variables, e.g. from deployment tooling, with argument
+dedupe to first delete the rows which prevent a unique index, keeping
+the latest (highest id), or with argument compact to convert the carbon
+intensity table to the compact columns.
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+from datetime import datetime, timezone
+
+from sqlalchemy import (Column, ColumnElement, Connection, DateTime, Engine,
+                        Index, Integer, MetaData, String, Table, case, delete,
+                        func, insert, inspect, select, text)
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlmodel import SQLModel
+
+import lambda_processing
+import sql_model
+import sql_model_base
+
+logger = logging.getLogger()
+
+# Any constant shared by all processes bootstrapping the same database
+BOOTSTRAP_LOCK_ID = 0x6c616d6264616462
+
+version_metadata = MetaData()
+schema_version = Table(
+    'schema_version', version_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('fingerprint', String(64), nullable=False),
+    Column('applied_at', DateTime, nullable=False))
+
+
+def combine(*metadata: MetaData) -> MetaData:
+    """Copy the tables of several MetaData into one."""
+    combined = MetaData()
+    for x in metadata:
+        for table in x.sorted_tables:
+            table.to_metadata(combined)
+    return combined
+
+
+def metadata_for(rollups: bool = False, partitioned: bool = False,
+                 compact: bool = False, natural_key: bool = False
+                 ) -> MetaData:
+    """Obtain the tables to create, optionally with the rollup table.
+
+    The carbon intensity table is partitioned by month if partitioned,
+    has the compact columns if compact, or is keyed on the time if
+    natural_key.
+    """
+    metadata = sql_model.carbon_intensity_table(
+        partitioned, compact, natural_key).metadata  # type: ignore
+    if rollups:
+        import rollup  # pylint: disable=C0415
+        return combine(metadata, rollup.rollup_metadata)
+    return metadata
+
+
+def fingerprint(bind: Engine | Connection,
+                metadata: MetaData = SQLModel.metadata) -> str:
+    """Hash the DDL of all tables and indexes, compiled for the engine."""
+    ddl = []
+    for table in metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=bind.dialect)))
+        for index in sorted(table.indexes, key=lambda x: str(x.name)):
+            ddl.append(str(CreateIndex(index).compile(
+                dialect=bind.dialect)))
+    return hashlib.sha256('\n'.join(ddl).encode()).hexdigest()
+
+
+def _stored_fingerprint(connection: Connection) -> str | None:
+    return connection.execute(select(schema_version.c.fingerprint).order_by(
+        schema_version.c.id.desc()).limit(1)).scalar()
+
+
+def stored_fingerprint(bind: Engine | Connection) -> str | None:
+    """Read the latest fingerprint, or None if there is no version table.
+
+    Other errors, e.g. failing to connect, are raised.
+    """
+    with sql_model_base.transaction(bind) as connection:
+        if not inspect(connection).has_table(schema_version.name):
+            return None
+        return _stored_fingerprint(connection)
+
+
+def _repeated(index: Index) -> ColumnElement[bool] | None:
+    """Select the rows repeating the columns of an earlier row.
+
+    For each value of the index, all but the row with the highest id are
+    selected. None if the table has no single id column to order by.
+    """
+    primary_key = list(index.table.primary_key.columns)  # type: ignore
+    if len(primary_key) != 1 or primary_key[0].name in index.columns:
+        return None
+    latest = select(func.max(primary_key[0])).group_by(*index.columns)
+    return primary_key[0].not_in(latest)
+
+
+def _missing_indexes(connection: Connection,
+                     metadata: MetaData) -> list[Index]:
+    """Find the indexes which were declared after a table was created."""
+    inspector = inspect(connection)
+    missing: list[Index] = []
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {x['name'] for x in inspector.get_indexes(table.name)}
+        missing.extend(x for x in table.indexes if x.name not in existing)
+    return missing
+
+
+def _create_missing_indexes(connection: Connection,
+                            metadata: MetaData) -> list[str]:
+    """Add the missing indexes, except unique ones the rows would violate.
+
+    Return the names of the indexes skipped.
+    """
+    skipped = []
+    for index in _missing_indexes(connection, metadata):
+        repeated = _repeated(index) if index.unique else None
+        if repeated is not None:
+            count = connection.execute(
+                select(func.count())  # pylint: disable=E1102
+                .select_from(index.table)  # type: ignore
+                .where(repeated)).scalar()
+            if count:
+                logger.warning(
+                    "Not creating the unique index %s: %d rows repeat its "
+                    "columns. Run `python function/schema.py dedupe` to "
+                    "delete them.", index.name, count)
+                skipped.append(str(index.name))
+                continue
+        logger.info("Creating index %s.", index.name)
+        index.create(connection)
+    return skipped
+
+
+def _lock(connection: Connection) -> None:
+    if connection.dialect.name == 'postgresql':
+        # Held until the end of the transaction
+        connection.execute(select(
+            func.pg_advisory_xact_lock(BOOTSTRAP_LOCK_ID)))
+
+
+def bootstrap(bind: Engine | Connection,
+              metadata: MetaData = SQLModel.metadata, *,
+              if_changed: bool = False) -> bool:
+    """Create missing tables and indexes, then record the schema version.
+
+    If if_changed, nothing is done if the stored fingerprint, read once
+    the lock is held, matches the models. The version is not recorded
+    while a unique index is skipped, see dedupe. Return True if the
+    bootstrap was run. See sql_model_base.transaction for the bind.
+    """
+    new_fingerprint = fingerprint(bind, metadata)
+    with sql_model_base.transaction(bind) as connection:
+        _lock(connection)
+        version_metadata.create_all(connection)
+        if if_changed and _stored_fingerprint(connection) == new_fingerprint:
+            return False
+        metadata.create_all(connection)
+        if not _create_missing_indexes(connection, metadata):
+            connection.execute(insert(schema_version).values(
+                fingerprint=new_fingerprint,
+                applied_at=datetime.now(timezone.utc).replace(tzinfo=None)))
+    return True
+
+
+def dedupe(bind: Engine | Connection,
+           metadata: MetaData = SQLModel.metadata) -> int:
+    """Delete the rows which prevent a missing unique index being added.
+
+    For each value of the index, the latest (highest id) row is kept.
+    Return the number of rows deleted.
+    """
+    deleted = 0
+    with sql_model_base.transaction(bind) as connection:
+        _lock(connection)
+        for index in _missing_indexes(connection, metadata):
+            repeated = _repeated(index) if index.unique else None
+            if repeated is None:
+                continue
+            result = connection.execute(
+                delete(index.table).where(repeated))  # type: ignore
+            if result.rowcount:
+                logger.warning("Deleted %d rows repeating the columns of %s.",
+                               result.rowcount, index.name)
+                deleted += result.rowcount
+    return deleted
+
+
+def ensure_schema(bind: Engine | Connection,
+                  metadata: MetaData = SQLModel.metadata) -> bool:
+    """Bootstrap the schema if the models have changed.
+
+    Return True if the bootstrap was run (by this process).
+    """
+    if stored_fingerprint(bind) == fingerprint(bind, metadata):
+        return False
+    logger.info("Database schema is out of date: bootstrapping.")
+    return bootstrap(bind, metadata, if_changed=True)
+
+
+def migrate_compact(engine: Engine) -> None:
+    """Convert the carbon intensity table to the compact columns.
+
+    The existing times are taken to be UTC. The table is rewritten, so
+    this should be run while the lambda is stopped, e.g. with its event
+    source mapping disabled.
+    """
+    old = sql_model.CarbonIntensityTable.__table__  # type: ignore
+    new = sql_model.CompactCarbonIntensityTable.__table__  # type: ignore
+    codes = {x: i for i, x in enumerate(sql_model.RATINGS)}
+    with engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            # Rewrite the table in place, keeping its indexes and sequence
+            cases = ' '.join(f"WHEN '{k}' THEN {v}" for k, v in codes.items())
+            connection.execute(text(
+                f"ALTER TABLE {old.name} "
+                f"ALTER COLUMN rating TYPE SMALLINT USING CASE rating "
+                f"{cases} END, "
+                "ALTER COLUMN forecast TYPE SMALLINT, "
+                "ALTER COLUMN actual TYPE SMALLINT, "
+                "ALTER COLUMN time TYPE TIMESTAMP WITH TIME ZONE "
+                "USING time AT TIME ZONE 'UTC'"))
+        else:
+            # Copy to a new table, which then replaces the old one
+            staging = new.to_metadata(MetaData(), name=f'{new.name}_compact')
+            connection.execute(CreateTable(staging))
+            connection.execute(insert(staging).from_select(
+                [c.name for c in old.columns],
+                select(*[case(codes, value=c) if c.name == 'rating' else c
+                         for c in old.columns])))
+            old.drop(connection)
+            connection.execute(text(
+                f"ALTER TABLE {staging.name} RENAME TO {new.name}"))
+            for index in new.indexes:
+                index.create(connection)
+    bootstrap(engine, metadata_for(compact=True))
+
+
+def main() -> None:
+    """Bootstrap, optionally after de-duplicating, or migrate to compact."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('command', nargs='?', default='bootstrap',
+                        choices=['bootstrap', 'dedupe', 'compact'])
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+    engine = (lambda_processing.DatabaseSettings.from_environment()
+              .create_sql_engine())
+    if args.command == 'compact':
+        migrate_compact(engine)
+        return
+    metadata = metadata_for(
+        os.getenv('ROLLUPS', '').lower() == 'true',
+        os.getenv('PARTITIONED', '').lower() == 'true',
+        os.getenv('COMPACT', '').lower() == 'true',
+        os.getenv('NATURAL_KEY', '').lower() == 'true')
+    if args.command == 'dedupe':
+        dedupe(engine, metadata)
+    bootstrap(engine, metadata)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,30 +2,38 @@
 
 from datetime import datetime
 from typing import Literal, Annotated
-from typing_extensions import Self
+from typing_extensions import Self, TypedDict
 from annotated_types import Len
 
 from pydantic import BaseModel, Field, model_validator
 
 
+Rating = Literal['very low', 'low', 'moderate', 'high', 'very high']
+
+
+def fill_nulls(forecast: int | None,
+               actual: int | None) -> tuple[int, int]:
+    """Replace a null intensity with the other one, where possible."""
+    if actual is None:
+        if forecast is None:
+            raise ValueError('Both intensities are null.')
+        return forecast, forecast
+    if forecast is None:
+        return actual, actual
+    return forecast, actual
+
+
 class CarbonIntensity(BaseModel):
     """Sub-object of data contained in the REST API response."""
 
-    rating: Literal[
-        'very low', 'low', 'moderate', 'high', 'very high'] = Field(
-            validation_alias='index')
+    rating: Rating = Field(validation_alias='index')
     forecast: int | None
     actual: int | None
 
     @model_validator(mode='after')
     def remove_nulls(self) -> Self:
         """Try to remove nulls from the API data where possible."""
-        if self.actual is None and self.forecast is None:
-            raise ValueError('Both intensities are null.')
-        if self.actual is None:
-            self.actual = self.forecast
-        elif self.forecast is None:
-            self.forecast = self.actual
+        self.forecast, self.actual = fill_nulls(self.forecast, self.actual)
         return self
 
 
@@ -43,6 +51,20 @@ class CarbonIntensityResponse(BaseModel):
     data: Annotated[list[CarbonIntensityData], Len(min_length=1, max_length=1)]
 
 
+# The same structure as plain dicts, which are much cheaper to validate:
+CarbonIntensityDict = TypedDict('CarbonIntensityDict', {
+    'index': Rating, 'forecast': int | None, 'actual': int | None})
+CarbonIntensityDataDict = TypedDict('CarbonIntensityDataDict', {
+    'from': datetime, 'to': datetime, 'intensity': CarbonIntensityDict})
+
+
+class CarbonIntensityResponseDict(TypedDict):
+    """The REST API response, validated into dicts instead of models."""
+
+    data: Annotated[list[CarbonIntensityDataDict],
+                    Len(min_length=1, max_length=1)]
+
+
 def validate_json(api_response_txt: str) -> CarbonIntensityResponse:
     """Create a validated model object from a json string."""
     return CarbonIntensityResponse.model_validate_json(api_response_txt)
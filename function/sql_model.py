@@ -1,23 +1,33 @@
 """SQL database model for https://api.carbonintensity.org.uk/intensity data."""
 
-from typing import Annotated
-from datetime import datetime
+from typing import Annotated, Any, Callable, get_args
+from datetime import datetime, timezone
 
 from typing_extensions import Self
-from pydantic import AfterValidator
+from pydantic import AfterValidator, TypeAdapter
+from sqlalchemy import DateTime, Dialect, MetaData, SmallInteger, TypeDecorator
 
 import source_model
 import sqlmodel
 import sql_model_base
 
 
+RATINGS: tuple[str, ...] = get_args(source_model.Rating)
+SMALLINT_RANGE = range(-2**15, 2**15)
+
+
 def validate_rating(rating: str) -> str:
     """Allow only fixed set of values."""
-    if rating not in ['very low', 'low', 'moderate', 'high', 'very high']:
+    if rating not in RATINGS:
         raise AssertionError("Carbon intensity rating: invalid value.")
     return rating
 
 
+def midpoint(from_ts: datetime, to_ts: datetime) -> datetime:
+    """Represent a time interval by its midpoint."""
+    return from_ts + (to_ts - from_ts)/2
+
+
 # pylint: disable=R0903
 class CarbonIntensityRecord(
         sql_model_base.DataModel[source_model.CarbonIntensityData]):
@@ -33,15 +43,76 @@ class CarbonIntensityRecord(
                           source_data: source_model.CarbonIntensityData
                           ) -> Self:
         """Convert data from the source API into the desired db format."""
-        half_dt = (source_data.to_ts - source_data.from_ts)/2
-        midpoint = source_data.from_ts + half_dt
         return cls(forecast=source_data.intensity.forecast,
                    actual=source_data.intensity.actual,
                    rating=source_data.intensity.rating,
-                   time=midpoint)
+                   time=midpoint(source_data.from_ts, source_data.to_ts))
 # pylint: enable=R0903
 
 
+# pylint: disable=R0901,W0223
+class RatingCode(TypeDecorator):
+    """Store a rating as its position in RATINGS, a SMALLINT."""
+
+    impl = SmallInteger
+    cache_ok = True
+
+    def process_bind_param(self, value: str | None,
+                           dialect: Dialect) -> int | None:
+        """Encode the rating."""
+        return None if value is None else RATINGS.index(value)
+
+    def process_result_value(self, value: int | None,
+                             dialect: Dialect) -> str | None:
+        """Decode the rating."""
+        return None if value is None else RATINGS[value]
+
+
+class NaiveUTCDateTime(TypeDecorator):
+    """Store a time as TIMESTAMP (WITHOUT TIME ZONE), in naive UTC.
+
+    Aware times are converted to UTC when written: asyncpg does not
+    accept them for this type.
+    """
+
+    impl = DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value: datetime | None,
+                           dialect: Dialect) -> datetime | None:
+        """Make the time naive, in UTC."""
+        if value is None or value.tzinfo is None:
+            return value
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class UTCDateTime(TypeDecorator):
+    """Store a time as TIMESTAMP WITH TIME ZONE, read as naive UTC.
+
+    Naive times are taken to be UTC, as in the other tables.
+    """
+
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value: datetime | None,
+                           dialect: Dialect) -> datetime | None:
+        """Make the time aware, in UTC."""
+        if value is None:
+            return None
+        if value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc)
+
+    def process_result_value(self, value: datetime | None,
+                             dialect: Dialect) -> datetime | None:
+        """Convert the time to naive UTC."""
+        if value is None or value.tzinfo is None:
+            return value
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+# pylint: enable=R0901,W0223
+
+
 class CarbonIntensityTable(
         CarbonIntensityRecord,
         sql_model_base.DataModelTable[
@@ -49,4 +120,152 @@ class CarbonIntensityTable(
         table=True):
     """Provides the database interface (does not perform validation)."""
 
+    __time_column__ = 'time'
+
+    time: datetime = sqlmodel.Field(sa_type=NaiveUTCDateTime)
     id: int | None = sqlmodel.Field(default=None, primary_key=True)
+
+
+# Its own MetaData, as it is the same database table as CarbonIntensityTable
+keyed_metadata = MetaData()
+
+
+class KeyedCarbonIntensityTable(
+        CarbonIntensityRecord,
+        sql_model_base.DataModelTable[
+            CarbonIntensityRecord, source_model.CarbonIntensityData],
+        table=True):
+    """CarbonIntensityTable with one row per measurement time.
+
+    Writes are upserts keyed on the time, so a redelivered or repeated
+    record replaces its row rather than adding another. Opt in with
+    NATURAL_KEY=true; rows which already repeat a time must first be
+    removed with `python function/schema.py dedupe`.
+    """
+
+    metadata = keyed_metadata
+    __natural_key__ = ('time',)
+    __time_column__ = 'time'
+
+    time: datetime = sqlmodel.Field(sa_type=NaiveUTCDateTime)
+    id: int | None = sqlmodel.Field(default=None, primary_key=True)
+
+
+# Its own MetaData, as it is the same database table as CarbonIntensityTable
+partitioned_metadata = MetaData()
+
+
+class PartitionedCarbonIntensityTable(
+        CarbonIntensityRecord,
+        sql_model_base.DataModelTable[
+            CarbonIntensityRecord, source_model.CarbonIntensityData],
+        table=True):
+    """CarbonIntensityTable, partitioned by month on PostgreSQL.
+
+    Use it instead of CarbonIntensityTable by setting PARTITIONED=true.
+    An existing unpartitioned table is not converted.
+    """
+
+    metadata = partitioned_metadata
+    __natural_key__ = ('time',)
+    __time_column__ = 'time'
+    __partition_by__ = 'time'
+
+    time: datetime = sqlmodel.Field(primary_key=True,
+                                    sa_type=NaiveUTCDateTime)
+
+
+# Its own MetaData, as it is the same database table as CarbonIntensityTable
+compact_metadata = MetaData()
+
+
+class CompactCarbonIntensityTable(
+        CarbonIntensityRecord,
+        sql_model_base.DataModelTable[
+            CarbonIntensityRecord, source_model.CarbonIntensityData],
+        table=True):
+    """CarbonIntensityTable, with smaller column types.
+
+    The rating, forecast and actual are stored as SMALLINT, and the
+    time as TIMESTAMP WITH TIME ZONE. They are read as the same values
+    as from CarbonIntensityTable. Use it instead of CarbonIntensityTable
+    by setting COMPACT=true, after converting an existing table with
+    schema.migrate_compact.
+    """
+
+    metadata = compact_metadata
+    __natural_key__ = ('time',)
+    __time_column__ = 'time'
+
+    id: int | None = sqlmodel.Field(default=None, primary_key=True)
+    rating: str = sqlmodel.Field(sa_type=RatingCode)
+    forecast: int = sqlmodel.Field(sa_type=SmallInteger)
+    actual: int = sqlmodel.Field(sa_type=SmallInteger)
+    time: datetime = sqlmodel.Field(sa_type=UTCDateTime)
+
+
+def carbon_intensity_table(partitioned: bool = False, compact: bool = False,
+                           natural_key: bool = False
+                           ) -> type[sql_model_base.DataModelTable]:
+    """Obtain the table class to write the carbon intensity records.
+
+    The partitioned and compact tables are always keyed on the time.
+    """
+    if partitioned and compact:
+        raise ValueError(
+            "The partitioned table does not use the compact columns.")
+    if partitioned:
+        return PartitionedCarbonIntensityTable
+    if compact:
+        return CompactCarbonIntensityTable
+    if natural_key:
+        return KeyedCarbonIntensityTable
+    return CarbonIntensityTable
+
+
+_response_adapter = TypeAdapter(source_model.CarbonIntensityResponseDict)
+
+
+def row_from_payload(api_response: dict | str | bytes) -> dict[str, Any]:
+    """Validate API data and convert it directly to a CarbonIntensityTable row.
+
+    This gives the same result as source_model validation followed by
+    CarbonIntensityRecord.from_source_model, without creating the models.
+    """
+    if isinstance(api_response, dict):
+        response = _response_adapter.validate_python(api_response)
+    else:
+        response = _response_adapter.validate_json(api_response)
+    data = response['data'][0]
+    intensity = data['intensity']
+    forecast, actual = source_model.fill_nulls(intensity['forecast'],
+                                               intensity['actual'])
+    return {'rating': validate_rating(intensity['index']),
+            'forecast': forecast,
+            'actual': actual,
+            'time': midpoint(data['from'], data['to'])}
+
+
+def row_from_payload_compact(api_response: dict | str | bytes
+                             ) -> dict[str, Any]:
+    """Convert API data to a CompactCarbonIntensityTable row.
+
+    As row_from_payload, but the intensities must fit the SMALLINT
+    columns: PostgreSQL would only reject them when writing the batch,
+    and SQLite would store them.
+    """
+    row = row_from_payload(api_response)
+    for k in ('forecast', 'actual'):
+        if row[k] not in SMALLINT_RANGE:
+            raise ValueError(
+                f"Carbon intensity {k}: {row[k]} is out of range for the "
+                "compact table.")
+    return row
+
+
+def row_converter(table: type[sql_model_base.DataModelTable]
+                  ) -> Callable[[dict | str | bytes], dict[str, Any]]:
+    """Obtain the function converting API data to rows of the table."""
+    if table is CompactCarbonIntensityTable:
+        return row_from_payload_compact
+    return row_from_payload
@@ -1,14 +1,28 @@
 """Generic SQL database model for API data."""
 
-from typing import Literal, overload, Generic, TypeVar
+from typing import (TYPE_CHECKING, Any, Callable, ClassVar, Iterable,
+                    Iterator, Literal, overload, Generic, TypeVar)
 from abc import abstractmethod, ABC
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import csv
+import io
 
 from typing_extensions import Self
-from sqlmodel import SQLModel, Session
+from sqlmodel import SQLModel, Session, select
 from sqlmodel.sql.expression import SelectOfScalar
-from sqlalchemy import Engine
+from sqlalchemy import (Column, Connection, Engine, Executable, Index, Insert,
+                        MetaData, Row, RowMapping, Table, delete, insert,
+                        text)
+from sqlalchemy.dialects import postgresql, sqlite
 import pydantic
 
+from ttl_cache import TTLCache
+
+if TYPE_CHECKING:
+    # Imported only when needed: it loads the asyncio ORM session
+    from sqlalchemy.ext.asyncio import AsyncEngine
+
 SourceModelClass = TypeVar("SourceModelClass", bound=pydantic.BaseModel)
 
 
@@ -24,47 +38,367 @@ class DataModel(SQLModel, ABC, Generic[SourceModelClass]):
 
 
 DataModelClass = TypeVar("DataModelClass", bound=DataModel)
+ModelClass = TypeVar("ModelClass", bound=SQLModel)
+
+_MISSING = object()
+
+
+def _month_start(time: datetime) -> datetime:
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc).replace(tzinfo=None)
+    return time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(start: datetime) -> datetime:
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+@contextmanager
+def transaction(bind: Engine | Connection) -> Iterator[Connection]:
+    """Begin a transaction with the engine, or on the connection.
+
+    The connection must not already be in a transaction, e.g. as given
+    by AsyncConnection.run_sync after AsyncEngine.connect().
+    """
+    if isinstance(bind, Engine):
+        with bind.begin() as connection:
+            yield connection
+    else:
+        with bind.begin():
+            yield bind
 
 
 # pylint: disable=E1101,E1133
-class DataModelTable(Generic[DataModelClass, SourceModelClass]):
-    """Provides the database interface (does not perform validation)."""
+class ModelTable(Generic[ModelClass]):
+    """Provides the database interface (does not perform validation).
+
+    Optionally, set __natural_key__ to the names of the columns which
+    uniquely identify a record: a unique index is then created and
+    writes become upserts, which either update the existing row or do
+    nothing, according to __on_conflict__.
+
+    Set __time_column__ to the name of the column holding each record's
+    time, to index it and enable the time-based read methods.
+
+    On PostgreSQL with psycopg2, batches of at least __copy_threshold__
+    rows are loaded with COPY into a temporary staging table and then
+    merged into the table in one statement. Set it to None to always
+    use INSERT.
+
+    Each function in __after_write__ is called with the connection and
+    the rows after every write, in the same transaction, e.g. to
+    maintain summary tables.
+
+    Set __partition_by__ to the name of a time column to partition the
+    table by month of that column on PostgreSQL (elsewhere, it remains
+    a single table). The primary key must then be the natural key, which
+    must include that column. Each month's partition is created when
+    rows are first written to it, and drop_before() drops whole months.
+
+    Reads with read_all and read_first (and the methods using them) can
+    be cached by calling cache_reads(). Entries are keyed on the
+    compiled statement and its parameters, and the whole cache is
+    cleared whenever this process writes to the table.
+    """
+
+    __natural_key__: ClassVar[tuple[str, ...]] = ()
+    __on_conflict__: ClassVar[Literal['update', 'nothing']] = 'update'
+    __time_column__: ClassVar[str | None] = None
+    __copy_threshold__: ClassVar[int | None] = 500
+    __after_write__: ClassVar[
+        tuple[Callable[[Connection, list[dict[str, Any]]], None], ...]] = ()
+    __read_cache__: ClassVar[TTLCache | None] = None
+    __partition_by__: ClassVar[str | None] = None
+    __partitions__: ClassVar[set[datetime]]
+    __insert_statements__: ClassVar[dict[tuple, Insert]]
 
     def __init_subclass__(cls):
         """Set the table name using the inherited model name."""
+        super().__init_subclass__()
+        if not issubclass(cls, SQLModel):
+            return  # A base class without a table, e.g. DataModelTable
         cls.__tablename__: str = cls.__bases__[0].__tablename__  # type: ignore
+        cls.__partitions__ = set()  # Those known to exist
+        cls.__insert_statements__ = {}
+        table_args = []
+        if cls.__partition_by__:
+            if cls.__partition_by__ not in cls.__natural_key__:
+                raise ValueError(
+                    f"{cls.__name__}: the partition column must be part "
+                    "of the natural key.")
+            # The natural key is the primary key, so it is unique
+            table_args.append({'postgresql_partition_by':
+                               f'RANGE ({cls.__partition_by__})'})
+        elif cls.__natural_key__:
+            table_args.append(Index(
+                f'uq_{cls.__tablename__}_natural_key',
+                *cls.__natural_key__, unique=True))
+        if (cls.__time_column__ and
+                cls.__natural_key__[:1] != (cls.__time_column__,)):
+            # Not already indexed as the leading natural key column
+            table_args.insert(0, Index(
+                f'ix_{cls.__tablename__}_{cls.__time_column__}',
+                cls.__time_column__))
+        if table_args:
+            cls.__table_args__ = tuple(table_args)
 
     @classmethod
-    def _create_table_item_from_model(cls,
-                                      entry: DataModelClass) -> Self:
-        return cls(**{k: getattr(entry, k) for k in entry.model_fields})
+    def _create_row_from_model(cls, entry: ModelClass) -> dict[str, Any]:
+        return {k: getattr(entry, k) for k in entry.model_fields}
 
     @classmethod
     def _create_model_from_table_item(cls,
-                                      item: Self) -> DataModelClass:
+                                      item: Self) -> ModelClass:
         return cls.__bases__[0](
             **{k: getattr(item, k) for k in item.model_fields})  # type: ignore
 
     @classmethod
-    def _add(cls, engine: Engine, item: Self) -> None:
-        with Session(engine) as session:
-            session.add(item)
-            session.commit()
+    def _insert_statement(cls, dialect_name: str) -> Insert:
+        # Built once, so its compiled form and cache key are reused
+        key = (dialect_name, cls.__natural_key__, cls.__on_conflict__)
+        statement = cls.__insert_statements__.get(key)
+        if statement is None:
+            statement = cls._build_insert_statement(dialect_name)
+            cls.__insert_statements__[key] = statement
+        return statement
+
+    @classmethod
+    def _build_insert_statement(cls, dialect_name: str) -> Insert:
+        table = cls.__table__  # type: ignore
+        if not cls.__natural_key__:
+            return insert(table)
+        statement: postgresql.Insert | sqlite.Insert
+        if dialect_name == 'postgresql':
+            statement = postgresql.insert(table)
+        elif dialect_name == 'sqlite':
+            statement = sqlite.insert(table)
+        else:
+            raise NotImplementedError(
+                f"Upsert is not supported for dialect '{dialect_name}'.")
+        if cls.__on_conflict__ == 'nothing':
+            return statement.on_conflict_do_nothing(
+                index_elements=cls.__natural_key__)
+        return statement.on_conflict_do_update(
+            index_elements=cls.__natural_key__,
+            set_={c.name: statement.excluded[c.name] for c in table.columns
+                  if not c.primary_key and c.name not in cls.__natural_key__})
+
+    @classmethod
+    def _create_model_from_mapping(cls,
+                                   mapping: RowMapping) -> ModelClass:
+        model = cls.__bases__[0]
+        return model(**{k: mapping[k]  # type: ignore
+                        for k in model.model_fields})  # type: ignore
+
+    @classmethod
+    def _deduplicate(cls, rows: list[dict[str, Any]]
+                     ) -> list[dict[str, Any]]:
+        if cls.__natural_key__:
+            # One statement cannot upsert the same row twice: keep the last
+            return list({tuple(row[k] for k in cls.__natural_key__): row
+                         for row in rows}.values())
+        return rows
+
+    @classmethod
+    def _use_copy(cls, bind: Engine | Connection, n_rows: int) -> bool:
+        return (cls.__copy_threshold__ is not None and
+                n_rows >= cls.__copy_threshold__ and
+                bind.dialect.name == 'postgresql' and
+                bind.dialect.driver == 'psycopg2')
+
+    @classmethod
+    def _copy_rows(cls, connection: Connection,
+                   rows: list[dict[str, Any]]) -> None:
+        table = cls.__table__  # type: ignore
+        names = [c.name for c in table.columns if c.name in rows[0]]
+        staging = Table(f'{table.name}_staging', MetaData(),
+                        *[Column(k, table.c[k].type) for k in names],
+                        prefixes=['TEMPORARY'], postgresql_on_commit='DROP')
+        staging.create(connection)
+
+        # As for INSERT, convert the values of custom column types
+        processors = [(k, table.c[k].type.bind_processor(connection.dialect))
+                      for k in names]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([r'\N' if row[k] is None else
+                             row[k] if processor is None else
+                             processor(row[k]) for k, processor in processors])
+        buffer.seek(0)
+        preparer = connection.dialect.identifier_preparer
+        columns = ', '.join(preparer.quote(k) for k in names)
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(  # type: ignore
+                f"COPY {preparer.format_table(staging)} ({columns}) "
+                r"FROM STDIN WITH (FORMAT csv, NULL '\N')", buffer)
+        finally:
+            cursor.close()
+
+        connection.execute(
+            cls._insert_statement(connection.dialect.name).from_select(
+                names, staging.select()))
+        # Not only on commit: another COPY may follow in this transaction
+        staging.drop(connection)
+
+    @classmethod
+    def _partition_name(cls, start: datetime) -> str:
+        return f'{cls.__tablename__}_{start:%Y_%m}'  # type: ignore
+
+    @classmethod
+    def _create_partitions(cls, connection: Connection,
+                           rows: list[dict[str, Any]]) -> None:
+        if (cls.__partition_by__ is None or
+                connection.dialect.name != 'postgresql'):
+            return
+        quote = connection.dialect.identifier_preparer.quote
+        months = {_month_start(row[cls.__partition_by__]) for row in rows}
+        for start in sorted(months - cls.__partitions__):
+            connection.execute(text(
+                f"CREATE TABLE IF NOT EXISTS "
+                f"{quote(cls._partition_name(start))} PARTITION OF "
+                f"{quote(cls.__tablename__)} FOR VALUES FROM "  # type: ignore
+                f"('{start.isoformat()}') TO "
+                f"('{_next_month(start).isoformat()}')"))
+            cls.__partitions__.add(start)
+
+    @classmethod
+    def _write(cls, connection: Connection,
+               rows: list[dict[str, Any]]) -> None:
+        cls._invalidate_reads()
+        cls._create_partitions(connection, rows)
+        if cls._use_copy(connection, len(rows)):
+            cls._copy_rows(connection, rows)
+        else:
+            connection.execute(
+                cls._insert_statement(connection.dialect.name), rows)
+        for hook in cls.__after_write__:
+            hook(connection, rows)
+
+    @classmethod
+    def _add(cls, engine: Engine, rows: list[dict[str, Any]]) -> None:
+        rows = cls._deduplicate(rows)
+        if not rows:
+            return
+        try:
+            with engine.begin() as connection:
+                cls._write(connection, rows)
+        except Exception:
+            # Any partitions created were rolled back
+            cls.__partitions__.clear()
+            raise
+        # Also drop any reads cached before the transaction committed
+        cls._invalidate_reads()
+
+    @classmethod
+    async def _add_async(cls, engine: 'AsyncEngine',
+                         rows: list[dict[str, Any]]) -> None:
+        rows = cls._deduplicate(rows)
+        if not rows:
+            return
+        cls._invalidate_reads()
+        try:
+            async with engine.begin() as connection:
+                await connection.run_sync(cls._create_partitions, rows)
+                await connection.execute(
+                    cls._insert_statement(engine.dialect.name), rows)
+                for hook in cls.__after_write__:
+                    await connection.run_sync(hook, rows)
+        except Exception:
+            cls.__partitions__.clear()
+            raise
+        cls._invalidate_reads()
+
+    @classmethod
+    def add_rows(cls, engine: Engine, rows: list[dict[str, Any]]) -> None:
+        """Use dicts which were validated to match the database schema.
+
+        All rows are written in a single transaction.
+        """
+        cls._add(engine, rows)
+
+    @classmethod
+    def write_rows(cls, connection: Connection,
+                   rows: list[dict[str, Any]]) -> None:
+        """Write rows as add_rows, within the connection's transaction.
+
+        This does not commit, so the rows can be written atomically with
+        other changes. If the transaction is rolled back, call
+        forget_partitions().
+        """
+        rows = cls._deduplicate(rows)
+        if rows:
+            cls._write(connection, rows)
+
+    @classmethod
+    def forget_partitions(cls) -> None:
+        """Check again whether each partition exists before writing to it."""
+        cls.__partitions__.clear()
+
+    @classmethod
+    def drop_before(cls, bind: Engine | Connection,
+                    before: datetime) -> list[str]:
+        """Delete the records of every month before the time's month.
+
+        On PostgreSQL, a partitioned table's expired partitions are
+        dropped whole; their names are returned. Otherwise, the rows are
+        deleted. See transaction() for the bind.
+        """
+        cutoff = _month_start(before)
+        cls._invalidate_reads()
+        if (cls.__partition_by__ is None or
+                bind.dialect.name != 'postgresql'):
+            column = (getattr(cls, cls.__partition_by__)
+                      if cls.__partition_by__ else cls._time_column())
+            with transaction(bind) as connection:
+                connection.execute(delete(cls).where(column < cutoff))
+            return []
+        table_name: str = cls.__tablename__  # type: ignore
+        prefix = f'{table_name}_'
+        quote = bind.dialect.identifier_preparer.quote
+        dropped = []
+        with transaction(bind) as connection:
+            names = connection.execute(text(
+                "SELECT child.relname FROM pg_inherits "
+                "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+                "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+                "WHERE parent.relname = :table"),
+                {'table': table_name}).scalars()
+            for name in sorted(names):
+                try:
+                    start = datetime.strptime(name.removeprefix(prefix),
+                                              '%Y_%m')
+                except ValueError:
+                    continue  # Not created by this class
+                if start < cutoff:
+                    connection.execute(text(f"DROP TABLE {quote(name)}"))
+                    cls.__partitions__.discard(start)
+                    dropped.append(name)
+        return dropped
+
+    @classmethod
+    async def add_rows_async(cls, engine: 'AsyncEngine',
+                             rows: list[dict[str, Any]]) -> None:
+        """Asynchronously write rows: see add_rows."""
+        await cls._add_async(engine, rows)
 
     @classmethod
     def add_from_db_model(cls, engine: Engine,
-                          entry: DataModelClass) -> None:
+                          entry: ModelClass) -> None:
         """Use an object that was validated to match the database schema."""
-        item = cls._create_table_item_from_model(entry)
-        cls._add(engine, item)
+        cls._add(engine, [cls._create_row_from_model(entry)])
 
     @classmethod
-    def add_from_source_model(cls, engine: Engine,
-                              source_data: SourceModelClass
-                              ) -> None:
-        """Use an object that was validated to match the source API."""
-        item = cls.__bases__[0].from_source_model(source_data)  # type: ignore
-        cls.add_from_db_model(engine, item)
+    def add_many_from_db_models(cls, engine: Engine,
+                                entries: Iterable[ModelClass]) -> None:
+        """Use objects that were validated to match the database schema.
+
+        All entries are written in a single transaction.
+        """
+        cls._add(engine, [cls._create_row_from_model(x) for x in entries])
 
     @overload
     @classmethod
@@ -79,21 +413,213 @@ class DataModelTable(Generic[DataModelClass, SourceModelClass]):
     @classmethod
     def _read(cls, engine: Engine, method: Literal['all', 'first'],
               statement: SelectOfScalar[Self]) -> list[Self] | Self:
+        cache = cls.__read_cache__
+        key = None
+        if cache is not None:
+            key = cls._cache_key(engine, method, statement)
+        if key is not None:
+            result = cache.get(key, _MISSING)  # type: ignore
+            if result is not _MISSING:
+                return result
         with Session(engine) as session:
-            return getattr(session.exec(statement), method)()
+            result = getattr(session.exec(statement), method)()
+        if key is not None:
+            cache.set(key, result)  # type: ignore
+        return result
+
+    @classmethod
+    def _cache_key(cls, engine: Engine, method: str,
+                   statement: SelectOfScalar[Self]) -> tuple | None:
+        compiled = statement.compile(dialect=engine.dialect)
+        params = tuple(sorted(
+            (k, tuple(v) if isinstance(v, list) else v)
+            for k, v in compiled.params.items()))
+        key = (engine.url, method, str(compiled), params)
+        try:
+            hash(key)
+        except TypeError:
+            return None  # Not cached
+        return key
+
+    @classmethod
+    def _invalidate_reads(cls) -> None:
+        if cls.__read_cache__ is not None:
+            cls.__read_cache__.clear()
+
+    @classmethod
+    def cache_reads(cls, maxsize: int = 256, ttl: float = 60) -> None:
+        """Cache up to maxsize query results, each for up to ttl seconds.
+
+        Writes by other processes are only seen once the entries expire.
+        The table items are shared by the cached reads, but read_all and
+        read_first return new models. Set maxsize to 0 to stop caching.
+        """
+        cls.__read_cache__ = TTLCache(maxsize, ttl) if maxsize else None
+
+    @classmethod
+    def read_cache_stats(cls) -> dict[str, float]:
+        """Return the read cache's hits, misses, size and hit rate."""
+        if cls.__read_cache__ is None:
+            return {}
+        stats: dict[str, float] = dict(cls.__read_cache__.stats())
+        reads = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / reads if reads else 0.0
+        return stats
 
     @classmethod
     def read_all(cls, engine: Engine,
                  statement: SelectOfScalar[Self]
-                 ) -> list[DataModelClass]:
+                 ) -> list[ModelClass]:
         """Obtain all results from the query."""
         return [cls._create_model_from_table_item(x) for x in
                 cls._read(engine, 'all', statement)]
 
     @classmethod
     def read_first(cls, engine: Engine,
-                   statement: SelectOfScalar[Self]) -> DataModelClass:
+                   statement: SelectOfScalar[Self]) -> ModelClass:
         """Obtain the first result from the query."""
         return cls._create_model_from_table_item(
                         cls._read(engine, 'first', statement))
+
+    @classmethod
+    def read_columns(cls, engine: Engine,
+                     statement: Executable) -> dict[str, list[Any]]:
+        """Obtain all results from the query as lists of column values.
+
+        The query runs through SQLAlchemy Core, so no objects are created
+        for the rows.
+        """
+        with engine.connect() as connection:
+            result = connection.execute(statement)
+            keys = list(result.keys())
+            rows = result.fetchall()
+        columns = zip(*rows) if rows else [()] * len(keys)
+        return {k: list(c) for k, c in zip(keys, columns)}
+
+    @classmethod
+    async def read_all_async(cls, engine: 'AsyncEngine',
+                             statement: Executable) -> list[ModelClass]:
+        """Asynchronously obtain all results from the query."""
+        async with engine.connect() as connection:
+            result = await connection.execute(statement)
+            return [cls._create_model_from_mapping(x)
+                    for x in result.mappings()]
+
+    @classmethod
+    def _time_column(cls) -> Any:
+        if cls.__time_column__ is None:
+            raise NotImplementedError(
+                f"{cls.__name__} does not define a time column.")
+        return getattr(cls, cls.__time_column__)
+
+    @classmethod
+    def read_range(cls, engine: Engine, start: datetime,
+                   end: datetime) -> list[ModelClass]:
+        """Obtain the records with start <= time < end, in time order."""
+        column = cls._time_column()
+        statement = select(cls).where(column >= start, column < end
+                                      ).order_by(column)
+        return cls.read_all(engine, statement)
+
+    @classmethod
+    def read_latest(cls, engine: Engine, n: int) -> list[ModelClass]:
+        """Obtain the n most recent records, in time order."""
+        column = cls._time_column()
+        statement = select(cls).order_by(column.desc()).limit(n)
+        return cls.read_all(engine, statement)[::-1]
+
+    @overload
+    @classmethod
+    def read_chunks(cls, engine: Engine, statement: Executable,
+                    chunk_size: int = ..., *, raw: Literal[False] = ...
+                    ) -> Iterator[list[ModelClass]]: ...
+
+    @overload
+    @classmethod
+    def read_chunks(cls, engine: Engine, statement: Executable,
+                    chunk_size: int = ..., *, raw: Literal[True]
+                    ) -> Iterator[list[Row]]: ...
+
+    @classmethod
+    def read_chunks(cls, engine: Engine, statement: Executable,
+                    chunk_size: int = 1000, *, raw: bool = False
+                    ) -> Iterator[list[ModelClass]] | Iterator[list[Row]]:
+        """Lazily obtain the query results in lists of up to chunk_size.
+
+        A server-side cursor is used where the database supports one, so
+        memory use does not grow with the total number of results. Rows
+        are validated as records unless raw is set.
+        """
+        with engine.connect() as connection:
+            result = connection.execution_options(
+                stream_results=True, yield_per=chunk_size).execute(statement)
+            if raw:
+                for partition in result.partitions():
+                    yield list(partition)
+            else:
+                for mappings in result.mappings().partitions():
+                    yield [cls._create_model_from_mapping(x)
+                           for x in mappings]
+
+    @overload
+    @classmethod
+    def iter_read(cls, engine: Engine, statement: Executable,
+                  chunk_size: int = ..., *, raw: Literal[False] = ...
+                  ) -> Iterator[ModelClass]: ...
+
+    @overload
+    @classmethod
+    def iter_read(cls, engine: Engine, statement: Executable,
+                  chunk_size: int = ..., *, raw: Literal[True]
+                  ) -> Iterator[Row]: ...
+
+    @classmethod
+    def iter_read(cls, engine: Engine, statement: Executable,
+                  chunk_size: int = 1000, *, raw: bool = False
+                  ) -> Iterator[ModelClass] | Iterator[Row]:
+        """Lazily obtain the query results one at a time.
+
+        See read_chunks: results are fetched in chunks of chunk_size.
+        """
+        for chunk in cls.read_chunks(engine, statement, chunk_size,
+                                     raw=raw):  # type: ignore
+            yield from chunk
+
+    @classmethod
+    def read_numpy(cls, engine: Engine, statement: Executable) -> Any:
+        """Obtain all results from the query as a numpy record array.
+
+        This requires the optional numpy package.
+        """
+        import numpy  # pylint: disable=C0415
+        arrays = {k: numpy.array(v) for k, v in
+                  cls.read_columns(engine, statement).items()}
+        return numpy.rec.fromarrays(
+            list(arrays.values()),
+            dtype=[(k, v.dtype) for k, v in arrays.items()])
+
+
+class DataModelTable(ModelTable[DataModelClass],
+                     Generic[DataModelClass, SourceModelClass]):
+    """A ModelTable whose records can be converted from the source API."""
+
+    @classmethod
+    def add_from_source_model(cls, engine: Engine,
+                              source_data: SourceModelClass
+                              ) -> None:
+        """Use an object that was validated to match the source API."""
+        item = cls.__bases__[0].from_source_model(source_data)  # type: ignore
+        cls.add_from_db_model(engine, item)
+
+    @classmethod
+    def add_many_from_source_models(cls, engine: Engine,
+                                    source_data: Iterable[SourceModelClass]
+                                    ) -> None:
+        """Use objects that were validated to match the source API.
+
+        All entries are written in a single transaction.
+        """
+        cls.add_many_from_db_models(
+            engine, [cls.__bases__[0].from_source_model(x)  # type: ignore
+                     for x in source_data])
 # pylint: enable=E1101,E1133
@@ -2,8 +2,13 @@
 
 This allows easy extraction of the 'responsePayload' field from the
 event data, which is the (json) data originally enqueued in the SQS.
+
+By default, only the fields which are used are checked, and each record
+body is decoded once. Set strict=True to validate every field.
 """
 
+import hashlib
+import json
 from typing import Any, Iterator, Literal, Annotated
 from datetime import datetime
 from annotated_types import Len
@@ -46,11 +51,57 @@ class SQSEvent(BaseModel):
     Records: Annotated[list[SQSRecord], Len(min_length=1)]
 
 
-def extract(event: dict[str, Any]) -> Iterator[dict]:
+class SQSEventEnvelope(BaseModel):
+    """The outer structure of an SQS event, with unvalidated records.
+
+    This allows each record to be validated (and fail) independently.
+    """
+
+    Records: Annotated[list[dict[str, Any]], Len(min_length=1)]
+
+
+def split(event: dict[str, Any]) -> list[dict[str, Any]]:
+    """Check the outer structure of the event and return its records."""
+    return SQSEventEnvelope(**event).Records
+
+
+def verify_md5(record: dict[str, Any]) -> None:
+    """Check that the record body matches its MD5 digest."""
+    body = record.get('body')
+    if not isinstance(body, str):
+        raise ValueError("Record has no body.")
+    digest = hashlib.md5(body.encode(), usedforsecurity=False).hexdigest()
+    if digest != record.get('md5OfBody'):
+        raise ValueError("Record body does not match md5OfBody.")
+
+
+def _extract_payload(record: dict[str, Any]) -> dict:
+    if not isinstance(record.get('messageId'), str):
+        raise ValueError("Record has no messageId.")
+    try:
+        payload = json.loads(record['body'])['responsePayload']
+    except (KeyError, TypeError) as e:
+        raise ValueError("Record body has no responsePayload.") from e
+    if not isinstance(payload, dict):
+        raise ValueError("Record responsePayload is not an object.")
+    return payload
+
+
+def extract_record(record: dict[str, Any], strict: bool = False,
+                   check_md5: bool = False) -> dict:
+    """Validate one record and obtain the dict originally enqueued."""
+    if check_md5:
+        verify_md5(record)
+    if strict:
+        return SQSRecord(**record).body.responsePayload
+    return _extract_payload(record)
+
+
+def extract(event: dict[str, Any], strict: bool = False,
+            check_md5: bool = False) -> Iterator[dict]:
     """Obtain the dict that was originally enqueued in the SQS.
 
     Iterate over all messages in the event.
     """
-    validated_event = SQSEvent(**event)
-    for record in validated_event.Records:
-        yield record.body.responsePayload
+    for record in split(event):
+        yield extract_record(record, strict, check_md5)
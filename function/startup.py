@@ -0,0 +1,140 @@
+"""Profile the cold start: the time to import each module and to init.
+
+Set STARTUP_PROFILE=true to enable this. Importing this module then
+starts timing every subsequent import, like python -X importtime, so it
+must be imported first. Phases of the init are timed with phase(), and
+the results are printed as JSON by report(), e.g. on the first event.
+"""
+
+import importlib.abc
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from importlib.machinery import ModuleSpec
+from types import ModuleType
+from typing import Any, Callable, ContextManager, Iterator, Sequence
+
+
+class _TimedLoader(importlib.abc.Loader):
+    """Wrap a module's loader to time its execution."""
+
+    def __init__(self, loader: Any, startup_profile: 'StartupProfile'):
+        self.loader = loader
+        self.profile = startup_profile
+
+    def create_module(self, spec: ModuleSpec) -> ModuleType | None:
+        """Delegate to the wrapped loader."""
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module: ModuleType) -> None:
+        """Run the module's code, timing it."""
+        with self.profile.timed_import(module.__name__):
+            self.loader.exec_module(module)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.loader, name)
+
+
+class _ImportTimer(importlib.abc.MetaPathFinder):
+    """Find modules with the other finders, then wrap their loaders."""
+
+    def __init__(self, startup_profile: 'StartupProfile'):
+        self.profile = startup_profile
+
+    def find_spec(self, fullname: str, path: Sequence[str] | None,
+                  target: ModuleType | None = None) -> ModuleSpec | None:
+        """Return the spec found by the next finder, with a timed loader."""
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader, self.profile)
+                return spec
+        return None
+
+
+class StartupProfile:
+    """Collect import times (self and cumulative) and init phase times."""
+
+    def __init__(self, emit: Callable[[str], Any] = print):
+        self.emit = emit
+        self.imports: dict[str, tuple[float, float]] = {}
+        self.phases: dict[str, float] = {}
+        self._children: list[float] = [0.0]
+        self._finder = _ImportTimer(self)
+        self._t0 = time.perf_counter()
+
+    def start(self) -> None:
+        """Time all imports from now on."""
+        if self._finder not in sys.meta_path:
+            sys.meta_path.insert(0, self._finder)
+
+    def stop(self) -> None:
+        """Stop timing imports."""
+        if self._finder in sys.meta_path:
+            sys.meta_path.remove(self._finder)
+
+    @contextmanager
+    def timed_import(self, name: str) -> Iterator[None]:
+        """Record the time to execute the named module."""
+        self._children.append(0.0)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            cumulative = time.perf_counter() - t0
+            children = self._children.pop()
+            self._children[-1] += cumulative
+            self.imports[name] = (cumulative - children, cumulative)
+
+    @contextmanager
+    def _timer(self, name: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - t0
+
+    def phase(self, name: str) -> ContextManager[None]:
+        """Time the code executed in this context as the named phase."""
+        return self._timer(name)
+
+    def to_dict(self, top: int = 20) -> dict[str, Any]:
+        """Summarise the slowest imports, by self time, and the phases."""
+        slowest = sorted(self.imports.items(), key=lambda x: x[1][0],
+                         reverse=True)[:top]
+        return {'startup_ms': (time.perf_counter() - self._t0) * 1e3,
+                'imports_ms': self._children[0] * 1e3,
+                'phases_ms': {k: v * 1e3 for k, v in self.phases.items()},
+                'slowest_imports_ms': {
+                    k: {'self': v[0] * 1e3, 'cumulative': v[1] * 1e3}
+                    for k, v in slowest}}
+
+    def report(self, top: int = 20) -> None:
+        """Stop timing imports and output the summary."""
+        self.stop()
+        self.emit(json.dumps({'startup_profile': self.to_dict(top)}))
+
+
+class _NullProfile:
+    """Record nothing."""
+
+    def phase(self, name: str) -> ContextManager[None]:
+        """Do not time this context."""
+        del name
+        return nullcontext()
+
+    def report(self, top: int = 20) -> None:
+        """Do nothing."""
+
+
+profile: StartupProfile | _NullProfile
+if os.getenv('STARTUP_PROFILE', '').lower() == 'true':
+    profile = StartupProfile()
+    profile.start()
+else:
+    profile = _NullProfile()
@@ -0,0 +1,60 @@
+"""A bounded least-recently-used cache whose entries expire."""
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Generic, Hashable, TypeVar
+
+KeyT = TypeVar("KeyT", bound=Hashable)
+ValueT = TypeVar("ValueT")
+
+
+class TTLCache(Generic[KeyT, ValueT]):
+    """Keep up to maxsize entries, each for up to ttl seconds.
+
+    When full, the least recently used entry is evicted. The hits and
+    misses of get() are counted.
+    """
+
+    def __init__(self, maxsize: int, ttl: float,
+                 clock: Callable[[], float] = time.monotonic):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1.")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[KeyT, tuple[float, ValueT]] = (
+            OrderedDict())
+
+    def __len__(self) -> int:
+        """Count the entries, including any which have expired."""
+        return len(self._data)
+
+    def get(self, key: KeyT, default: Any = None) -> ValueT | Any:
+        """Return the value if present and not expired, else default."""
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= self.clock():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: KeyT, value: ValueT) -> None:
+        """Add or replace an entry, evicting the oldest if full."""
+        self._data[key] = (self.clock() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove every entry; the counters are kept."""
+        self._data.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Return the hit and miss counts and the current size."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data)}
@@ -40,4 +40,6 @@ aws lambda update-function-configuration \
 --environment "Variables={DB_PORT=$DB_PORT, \
 DB_USER=$DB_USER, DB_NAME=$DB_NAME, \
 DB_HOST=$DB_HOST, DB_PASSWORD=$DB_PASSWORD, \
-LOG_LEVEL=$LOG_LEVEL, DB_DIALECT_DRIVER=$DB_DIALECT_DRIVER}" &> /dev/null
+LOG_LEVEL=$LOG_LEVEL, DB_DIALECT_DRIVER=$DB_DIALECT_DRIVER, \
+ROLLUPS=${ROLLUPS:-false}, PARTITIONED=${PARTITIONED:-false}, \
+COMPACT=${COMPACT:-false}, NATURAL_KEY=${NATURAL_KEY:-false}}" &> /dev/null
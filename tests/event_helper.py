@@ -0,0 +1,26 @@
+"""Build SQS events and records for tests."""
+
+import json
+from typing import Any
+
+
+def get_test_event_data() -> dict[str, Any]:
+    with open('tests/test_sqs_event.json') as file:
+        return json.load(file)
+
+
+def make_record(message_id: str, payload: dict[str, Any]) -> dict[str, Any]:
+    """Copy the test event record, replacing its ID and payload."""
+    record = dict(get_test_event_data()['Records'][0])
+    body = json.loads(record['body'])
+    body['responsePayload'] = payload
+    record['body'] = json.dumps(body)
+    record['messageId'] = message_id
+    return record
+
+
+def make_payload(actual: Any, day: int = 1) -> dict[str, Any]:
+    return {"data": [{"from": f"2024-01-{day:02}T18:30Z",
+                      "to": f"2024-01-{day:02}T19:00Z",
+                      "intensity": {"forecast": 254, "actual": actual,
+                                    "index": "high"}}]}
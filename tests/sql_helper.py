@@ -3,12 +3,14 @@
 from pathlib import Path
 import tempfile
 import sqlite3
+from datetime import datetime
 from typing import Any
 from abc import ABC, abstractmethod
 import os
 
 import psycopg2
 from psycopg2 import sql
+from sqlalchemy import Column, Engine, MetaData, Table
 
 
 class DBhelper(ABC):
@@ -142,3 +144,20 @@ class PSQLHelper(DBhelper):
         os.environ['DB_HOST'] = self.host or ''
         os.environ['DB_PORT'] = self.port or ''
         os.environ['DB_DIALECT_DRIVER'] = self.POSTGRES_DIALECT
+
+
+def make_baseline_table(engine: Engine, table: Table,
+                        times: list[datetime]) -> Table:
+    """Create the table without its indexes, with rows at the times.
+
+    This is the table as created before its natural key was declared.
+    """
+    baseline = Table(table.name, MetaData(),
+                     *[Column(c.name, c.type, primary_key=c.primary_key)
+                       for c in table.columns])
+    baseline.create(engine)
+    with engine.begin() as connection:
+        connection.execute(baseline.insert(), [
+            {'rating': 'low', 'forecast': i, 'actual': i, 'time': t}
+            for i, t in enumerate(times)])
+    return baseline
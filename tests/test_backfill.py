@@ -0,0 +1,92 @@
+import unittest
+import sys
+import io
+import json
+import logging
+
+from sqlmodel import select, create_engine, SQLModel
+
+logging.getLogger().setLevel("CRITICAL")
+sys.path.append("function")
+
+import backfill  # type: ignore # noqa
+import sql_model  # type: ignore # noqa
+from sql_helper import SQLiteHelper  # noqa
+from event_helper import make_payload, make_record  # noqa
+
+
+class TestBackfill(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.sqlite = SQLiteHelper()
+        self.engine = create_engine(f"sqlite:///{self.sqlite.dbname}")
+        SQLModel.metadata.create_all(self.engine)
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+        self.sqlite.tearDown()
+
+    def make_lines(self) -> list[str]:
+        """One of each line format, plus a blank and an invalid line."""
+        event = {'Records': [make_record('a', make_payload(1, day=1)),
+                             make_record('b', make_payload(2, day=2))]}
+        return [json.dumps(event) + '\n',
+                json.dumps(make_record('c', make_payload(3, day=3))) + '\n',
+                '\n',
+                json.dumps(make_payload(4, day=4)) + '\n',
+                json.dumps(make_payload('x', day=5)) + '\n',
+                'not json\n']
+
+    def read_actual(self, table: type = sql_model.CarbonIntensityTable
+                    ) -> list[int]:
+        return [x.actual for x in table.read_all(
+            self.engine, select(table).order_by(table.time))]
+
+    def test_payloads_from_line(self):
+        lines = self.make_lines()
+        self.assertEqual(len(backfill.payloads_from_line(lines[0])), 2)
+        self.assertEqual(backfill.payloads_from_line(lines[1]),
+                         [make_payload(3, day=3)])
+        self.assertEqual(backfill.payloads_from_line(lines[3]),
+                         [make_payload(4, day=4)])
+        with self.assertRaises(ValueError):
+            backfill.payloads_from_line('[]')
+
+    def test_convert_lines(self):
+        rows, failures = backfill.convert_lines(1, self.make_lines())
+        self.assertEqual([x['actual'] for x in rows], [1, 2, 3, 4])
+        self.assertEqual(failures, 2)
+
+    def test_backfill_inline(self):
+        stats = backfill.backfill(self.make_lines(), self.engine, workers=0,
+                                  chunk_size=2, batch_size=3)
+        self.assertEqual(self.read_actual(), [1, 2, 3, 4])
+        self.assertEqual((stats.lines, stats.rows, stats.failures),
+                         (6, 4, 2))
+
+    def test_backfill_process_pool(self):
+        stats = backfill.backfill(self.make_lines(), self.engine, workers=2,
+                                  chunk_size=1)
+        self.assertEqual(self.read_actual(), [1, 2, 3, 4])
+        self.assertEqual(stats.failures, 2)
+
+    def test_backfill_compact(self):
+        """Intensities too large for the compact columns are failures."""
+        SQLModel.metadata.drop_all(self.engine)
+        sql_model.compact_metadata.create_all(self.engine)
+        lines = self.make_lines()[:2] + [
+            json.dumps(make_payload(40000, day=6)) + '\n']
+        table = sql_model.CompactCarbonIntensityTable
+        stats = backfill.backfill(lines, self.engine, workers=0, table=table)
+        self.assertEqual(self.read_actual(table), [1, 2, 3])
+        self.assertEqual(stats.failures, 1)
+
+    def test_report(self):
+        stream = io.StringIO()
+        backfill.BackfillStats(10, 8, 2, 2.0).report(stream)
+        self.assertEqual(stream.getvalue(),
+                         "10 lines, 8 rows written, 2 failed, 4 rows/s\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
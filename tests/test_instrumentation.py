@@ -0,0 +1,89 @@
+"""Unit tests for file instrumentation.py"""
+import unittest
+import sys
+import json
+import logging
+
+from sqlmodel import create_engine, SQLModel
+
+logging.getLogger().setLevel("CRITICAL")
+sys.path.append("function")
+
+import instrumentation  # type: ignore # noqa
+import lambda_processing  # type: ignore # noqa
+from sql_helper import SQLiteHelper  # noqa
+
+
+class TestNullInstrumentation(unittest.TestCase):
+
+    def test_no_op(self):
+        metrics = instrumentation.NULL_INSTRUMENTATION
+        with metrics.stage('a'):
+            metrics.count('b')
+        metrics.flush()
+
+
+class TestEMFInstrumentation(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.lines: list[str] = []
+        self.metrics = instrumentation.EMFInstrumentation(
+            'Test', {'FunctionName': 'f'}, self.lines.append)
+
+    def test_emf(self):
+        with self.metrics.stage('extract'):
+            pass
+        with self.metrics.stage('extract'):
+            pass
+        self.metrics.count('records', 3)
+        self.metrics.count('records')
+        self.metrics.flush()
+        self.assertEqual(len(self.lines), 1)
+        emf = json.loads(self.lines[0])
+        directive = emf['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual(directive['Namespace'], 'Test')
+        self.assertEqual(directive['Dimensions'], [['FunctionName']])
+        self.assertEqual(directive['Metrics'],
+                         [{'Name': 'extract_ms', 'Unit': 'Milliseconds'},
+                          {'Name': 'records', 'Unit': 'Count'}])
+        self.assertEqual(emf['FunctionName'], 'f')
+        self.assertEqual(emf['records'], 4)
+        self.assertGreaterEqual(emf['extract_ms'], 0)
+
+    def test_flush_resets(self):
+        self.metrics.count('records')
+        self.metrics.flush()
+        self.metrics.flush()
+        self.assertEqual(len(self.lines), 1)
+
+    def test_stage_exception(self):
+        """The stage is still timed if it raises."""
+        with self.assertRaises(ValueError):
+            with self.metrics.stage('write'):
+                raise ValueError()
+        self.assertIn('write', self.metrics.timings)
+
+    def test_processing(self):
+        sqlite = SQLiteHelper()
+        engine = create_engine(f"sqlite:///{sqlite.dbname}")
+        SQLModel.metadata.create_all(engine)
+        self.metrics.attach(engine)
+        with open('tests/test_sqs_event.json') as file:
+            event = json.load(file)
+        event['Records'].append({'messageId': 'bad', 'body': '{}'})
+        lambda_processing.lambda_processing(
+            event, engine, instrumentation=self.metrics)
+        self.metrics.flush()
+        emf = json.loads(self.lines[0])
+        self.assertEqual(emf['records'], 2)
+        self.assertEqual(emf['failures'], 1)
+        self.assertEqual(emf['db_round_trips'], 1)
+        self.assertEqual(emf['bytes'], len(event['Records'][0]['body']))
+        for stage in ['extract', 'convert', 'write']:
+            self.assertIn(f'{stage}_ms', emf)
+        engine.dispose()
+        sqlite.tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
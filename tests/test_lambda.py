@@ -3,9 +3,11 @@ import os
 import sys
 import json
 import importlib
+from datetime import datetime
 from typing import Any
+from unittest import mock
 
-from sqlmodel import select
+from sqlmodel import SQLModel, select
 import pydantic
 
 
@@ -21,8 +23,10 @@ os.environ['DB_DIALECT_DRIVER'] = 'sqlite'
 
 sys.path.append("function")
 import lambda_function  # type: ignore # noqa
-from sql_helper import SQLiteHelper, PSQLHelper, DBhelper  # noqa
+from sql_helper import (SQLiteHelper, PSQLHelper, DBhelper,  # noqa
+                        make_baseline_table)
 import sql_model  # type: ignore # noqa
+import schema  # type: ignore # noqa
 
 
 class TestFunctionSQL(unittest.TestCase):
@@ -54,11 +58,11 @@ class TestFunctionSQL(unittest.TestCase):
         return super().tearDown()
 
     def test_table_exists(self):
-        """There should be exactly one table in the database."""
+        """There should be the data table and the schema version table."""
         table_names = self.db.get_table_names()
-        self.assertEqual(len(table_names), 1)
-        self.assertEqual(table_names[0],
-                         sql_model.CarbonIntensityRecord.__tablename__)
+        self.assertEqual(sorted(table_names),
+                         sorted([sql_model.CarbonIntensityRecord.__tablename__,
+                                 schema.schema_version.name]))
 
     def test_read(self):
         """There should be one record in the table: read back and check."""
@@ -74,12 +78,133 @@ class TestFunctionSQL(unittest.TestCase):
         """Add two entries, then read back to check."""
         lambda_function.lambda_handler(self.test_event, self.test_context)
         table_names = self.db.get_table_names()
-        self.assertEqual(len(table_names), 1)
+        self.assertEqual(len(table_names), 2)
         statement = select(sql_model.CarbonIntensityTable)
         results = sql_model.CarbonIntensityTable.read_all(
             lambda_function.engine, statement)
         self.assertEqual(len(results), 2)
 
+    def test_call_multiple_natural_key(self):
+        """With NATURAL_KEY=true, the record is not duplicated."""
+        SQLModel.metadata.drop_all(lambda_function.engine)
+        with mock.patch.dict(os.environ, {'NATURAL_KEY': 'true'}):
+            importlib.reload(lambda_function)
+        for _ in range(2):
+            lambda_function.lambda_handler(self.test_event, self.test_context)
+        statement = select(sql_model.KeyedCarbonIntensityTable)
+        results = sql_model.KeyedCarbonIntensityTable.read_all(
+            lambda_function.engine, statement)
+        self.assertEqual(len(results), 1)
+
+    def test_existing_duplicates(self):
+        """Opt in to the natural key on a table that repeats a time.
+
+        The lambda does not delete the repeats: it logs them and skips
+        the unique index, so the upserts fail until dedupe is run.
+        """
+        SQLModel.metadata.drop_all(lambda_function.engine)
+        schema.version_metadata.drop_all(lambda_function.engine)
+        make_baseline_table(lambda_function.engine,
+                            sql_model.CarbonIntensityTable.__table__,
+                            [datetime(2024, 3, 11, 18, 45)] * 2)
+        with mock.patch.dict(os.environ, {'NATURAL_KEY': 'true'}):
+            importlib.reload(lambda_function)
+        with self.assertLogs(level='WARNING') as logs:
+            response = lambda_function.lambda_handler(self.test_event,
+                                                      self.test_context)
+        self.assertIn("Not creating the unique index", logs.output[0])
+        self.assertEqual(len(response['batchItemFailures']), 1)
+        table = sql_model.KeyedCarbonIntensityTable
+        statement = select(table)
+        results = table.read_all(lambda_function.engine, statement)
+        self.assertEqual([x.actual for x in results], [0, 1])
+
+        metadata = schema.metadata_for(natural_key=True)
+        self.assertEqual(schema.dedupe(lambda_function.engine, metadata), 1)
+        schema.bootstrap(lambda_function.engine, metadata)
+        response = lambda_function.lambda_handler(self.test_event,
+                                                  self.test_context)
+        self.assertEqual(response, {'batchItemFailures': []})
+        results = table.read_all(lambda_function.engine, statement)
+        self.assertEqual([x.actual for x in results], [259])
+
+    def test_schema_check_failure(self):
+        """A failed schema check is logged, and retried after a backoff.
+
+        Events still run meanwhile; the check stops once it succeeds.
+        """
+        importlib.reload(lambda_function)
+        now = [0.0]
+        lambda_function._first_invocation.clock = lambda: now[0]
+        with mock.patch.object(schema, 'ensure_schema',
+                               side_effect=[RuntimeError, RuntimeError,
+                                            False]) as ensure_schema:
+            with self.assertLogs(level='ERROR'):
+                response = lambda_function.lambda_handler(self.test_event,
+                                                          self.test_context)
+            lambda_function.lambda_handler(self.test_event, self.test_context)
+            self.assertEqual(ensure_schema.call_count, 1)
+            for t in [1, 2, 3, 10]:
+                now[0] = t
+                lambda_function.lambda_handler(self.test_event,
+                                               self.test_context)
+            # Retried at t=1, then (after 2 s) at t=3, which succeeded
+            self.assertEqual(ensure_schema.call_count, 3)
+        self.assertEqual(response, {'batchItemFailures': []})
+
+    def test_response(self):
+        """All messages succeeded, so no failures are reported."""
+        response = lambda_function.lambda_handler(self.test_event,
+                                                  self.test_context)
+        self.assertEqual(response, {'batchItemFailures': []})
+
+    def test_async_handler(self):
+        """Process the event using the asyncio database driver."""
+        driver = {'sqlite': 'aiosqlite'}.get(self.db.dialect_driver,
+                                             'asyncpg')
+        try:
+            importlib.import_module(driver)
+        except ImportError:
+            self.skipTest(f"{driver} is not installed")
+        event = self.test_event
+        record = event['Records'][0]
+        record['body'] = record['body'].replace('"actual": 259',
+                                                '"actual": 1')
+        response = lambda_function.async_lambda_handler(event,
+                                                        self.test_context)
+        loop, async_engine = lambda_function._async_runtime()
+        loop.run_until_complete(async_engine.dispose())
+        self.assertEqual(response, {'batchItemFailures': []})
+        statement = select(sql_model.CarbonIntensityTable)
+        results = sql_model.CarbonIntensityTable.read_all(
+            lambda_function.engine, statement)
+        self.assertEqual(sorted(x.actual for x in results), [1, 259])
+
+    def test_async_cold_start(self):
+        """The async handler bootstraps with the async engine only."""
+        driver = {'sqlite': 'aiosqlite'}.get(self.db.dialect_driver,
+                                             'asyncpg')
+        try:
+            importlib.import_module(driver)
+        except ImportError:
+            self.skipTest(f"{driver} is not installed")
+        SQLModel.metadata.drop_all(lambda_function.engine)
+        schema.version_metadata.drop_all(lambda_function.engine)
+        lambda_function.engine.dispose()
+        importlib.reload(lambda_function)
+        with mock.patch.object(lambda_function.engine, 'connect',
+                               side_effect=AssertionError) as connect:
+            response = lambda_function.async_lambda_handler(
+                self.test_event, self.test_context)
+        loop, async_engine = lambda_function._async_runtime()
+        loop.run_until_complete(async_engine.dispose())
+        connect.assert_not_called()
+        self.assertEqual(response, {'batchItemFailures': []})
+        statement = select(sql_model.CarbonIntensityTable)
+        results = sql_model.CarbonIntensityTable.read_all(
+            lambda_function.engine, statement)
+        self.assertEqual([x.actual for x in results], [259])
+
     def test_bad_event_data(self):
         """Not a valid SQS event object."""
         with self.assertRaises(pydantic.ValidationError):
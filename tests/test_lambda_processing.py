@@ -1,20 +1,35 @@
 import unittest
 import sys
-import json
 import logging
 import os
+from datetime import datetime
 from typing import Any
 
+from unittest import mock
+
 from sqlmodel import select, create_engine, SQLModel
-from sqlalchemy import Engine
+from sqlalchemy import Connection, Engine
+from sqlalchemy.pool import NullPool, QueuePool
 import pydantic
 
 logging.getLogger().setLevel("CRITICAL")
 sys.path.append("function")
 
 import lambda_processing  # type: ignore # noqa
+import registry  # type: ignore # noqa
+import schema  # type: ignore # noqa
 import sql_model  # type: ignore # noqa
-from sql_helper import SQLiteHelper, PSQLHelper, DBhelper  # noqa
+import ttl_cache  # type: ignore # noqa
+from sql_helper import (SQLiteHelper, PSQLHelper, DBhelper,  # noqa
+                        make_baseline_table)
+from event_helper import (get_test_event_data, make_payload,  # noqa
+                          make_record)
+
+
+# Writes to the table keyed on the time, as with NATURAL_KEY=true
+KEYED_REGISTRY = registry.Registry(default='carbonintensity')
+KEYED_REGISTRY.register('carbonintensity', sql_model.row_from_payload,
+                        sql_model.KeyedCarbonIntensityTable)
 
 
 class TestLambdaProcessing(unittest.TestCase):
@@ -32,8 +47,7 @@ class TestLambdaProcessing(unittest.TestCase):
         self.skipTest("ABC")
 
     def get_test_event_data(self) -> dict[str, Any]:
-        with open('tests/test_sqs_event.json') as file:
-            return json.load(file)
+        return get_test_event_data()
 
     def setUp(self) -> None:
         """Obtain an empty database and process a test event."""
@@ -45,6 +59,19 @@ class TestLambdaProcessing(unittest.TestCase):
                                             self.engine)
         return super().setUp()
 
+    def use_natural_key(self) -> None:
+        """Replace the table with the one keyed on the time."""
+        SQLModel.metadata.drop_all(self.engine)
+        sql_model.keyed_metadata.create_all(self.engine)
+        lambda_processing.lambda_processing(self.test_event, self.engine,
+                                            registry=KEYED_REGISTRY)
+
+    def read_keyed(self) -> list[int]:
+        """Read the actual values from the table keyed on the time."""
+        table = sql_model.KeyedCarbonIntensityTable
+        results = table.read_all(self.engine, select(table))
+        return sorted(x.actual for x in results)
+
     def test_table_exists(self):
         """There should be exactly one table in the database."""
         table_names = self.db.get_table_names()
@@ -73,6 +100,166 @@ class TestLambdaProcessing(unittest.TestCase):
                                                           statement)
         self.assertEqual(len(results), 2)
 
+    def test_call_multiple_natural_key(self):
+        """Keyed on the time, the record is not duplicated."""
+        self.use_natural_key()
+        lambda_processing.lambda_processing(self.test_event, self.engine,
+                                            registry=KEYED_REGISTRY)
+        self.assertEqual(self.read_keyed(), [259])
+
+    def test_existing_duplicates(self):
+        """Opt in to the natural key on a table which repeats a time.
+
+        The schema check logs the repeats and skips the unique index, so
+        the upsert fails until dedupe deletes them and the index is added;
+        then the record replaces the repeated rows.
+        """
+        SQLModel.metadata.drop_all(self.engine)
+        make_baseline_table(self.engine,
+                            sql_model.CarbonIntensityTable.__table__,
+                            [datetime(2024, 1, 1, 18, 45)] * 2)
+        metadata = schema.metadata_for(natural_key=True)
+        with self.assertLogs(level='WARNING'):
+            schema.ensure_schema(self.engine, metadata)
+        event = {'Records': [make_record('a', make_payload(3))]}
+        response = lambda_processing.lambda_processing(
+            event, self.engine, registry=KEYED_REGISTRY)
+        self.assertEqual(response['batchItemFailures'],
+                         [{'itemIdentifier': 'a'}])
+        self.assertEqual(self.read_keyed(), [0, 1])
+
+        schema.dedupe(self.engine, metadata)
+        schema.ensure_schema(self.engine, metadata)
+        response = lambda_processing.lambda_processing(
+            event, self.engine, registry=KEYED_REGISTRY)
+        self.assertEqual(response['batchItemFailures'], [])
+        self.assertEqual(self.read_keyed(), [3])
+
+    def test_call_multiple_update(self):
+        """Keyed on the time, a later message updates the record."""
+        self.use_natural_key()
+        for message_id, actual in [('a', 1), ('b', 2)]:
+            event = {'Records': [make_record(message_id,
+                                             make_payload(actual))]}
+            lambda_processing.lambda_processing(event, self.engine,
+                                                registry=KEYED_REGISTRY)
+        self.assertEqual(self.read_keyed(), [2, 259])
+
+    def test_batch(self):
+        """Add a batch of several records in one call."""
+        event = {'Records': [make_record(str(i), make_payload(i, i + 1))
+                             for i in range(5)]}
+        lambda_processing.lambda_processing(event, self.engine)
+        statement = select(sql_model.CarbonIntensityTable)
+        results = sql_model.CarbonIntensityTable.read_all(self.engine,
+                                                          statement)
+        self.assertEqual(len(results), 6)
+
+    def test_batch_duplicates(self):
+        """Keyed on the time, repeats within one batch are written once."""
+        self.use_natural_key()
+        event = self.get_test_event_data()
+        event['Records'] = event['Records'] * 5
+        lambda_processing.lambda_processing(event, self.engine,
+                                            registry=KEYED_REGISTRY)
+        self.assertEqual(self.read_keyed(), [259])
+
+    def test_written_cache(self):
+        """Unchanged rows already written are skipped; changes are not."""
+        self.use_natural_key()
+        written = ttl_cache.TTLCache(10, 60)
+        table = sql_model.KeyedCarbonIntensityTable
+        event = {'Records': [make_record('a', make_payload(1))]}
+        with mock.patch.object(table, 'add_rows',
+                               wraps=table.add_rows) as add_rows:
+            for _ in range(2):
+                response = lambda_processing.lambda_processing(
+                    event, self.engine, written=written,
+                    registry=KEYED_REGISTRY)
+                self.assertEqual(response, {'batchItemFailures': []})
+            self.assertEqual(add_rows.call_count, 1)
+            event = {'Records': [make_record('b', make_payload(2))]}
+            lambda_processing.lambda_processing(
+                event, self.engine, written=written, registry=KEYED_REGISTRY)
+            self.assertEqual(add_rows.call_count, 2)
+        self.assertEqual(written.stats(), {'hits': 2, 'misses': 1,
+                                           'size': 1})
+        self.assertEqual(self.read_keyed(), [2, 259])
+
+    def test_written_cache_no_natural_key(self):
+        """Without a natural key, repeated rows are all written."""
+        written = ttl_cache.TTLCache(10, 60)
+        table = sql_model.CarbonIntensityTable
+        event = {'Records': [make_record('a', make_payload(1))]}
+        with mock.patch.object(table, 'add_rows') as add_rows:
+            for _ in range(2):
+                lambda_processing.lambda_processing(event, self.engine,
+                                                    written=written)
+        self.assertEqual(add_rows.call_count, 2)
+        self.assertEqual(len(written), 0)
+
+    def test_written_cache_failure(self):
+        """Rows which failed to write are not cached."""
+        written = ttl_cache.TTLCache(10, 60)
+        event = {'Records': [make_record('a', make_payload(1))]}
+        with mock.patch.object(sql_model.CarbonIntensityTable, 'add_rows',
+                               side_effect=RuntimeError):
+            lambda_processing.lambda_processing(event, self.engine,
+                                                written=written)
+        self.assertEqual(len(written), 0)
+
+    def test_no_failures(self):
+        response = lambda_processing.lambda_processing(self.test_event,
+                                                       self.engine)
+        self.assertEqual(response, {'batchItemFailures': []})
+
+    def test_partial_failure_validation(self):
+        """Only the invalid record is reported; the others are written."""
+        event = {'Records': [
+            make_record('good1', make_payload(1, 1)),
+            make_record('bad', make_payload("not a number", 2)),
+            make_record('good2', make_payload(2, 3))]}
+        response = lambda_processing.lambda_processing(event, self.engine)
+        self.assertEqual(response,
+                         {'batchItemFailures': [{'itemIdentifier': 'bad'}]})
+        statement = select(sql_model.CarbonIntensityTable)
+        results = sql_model.CarbonIntensityTable.read_all(self.engine,
+                                                          statement)
+        self.assertEqual(sorted(x.actual for x in results), [1, 2, 259])
+
+    def test_partial_failure_write(self):
+        """A record which cannot be written does not block the others."""
+        event = {'Records': [
+            make_record('good1', make_payload(1, 1)),
+            make_record('bad', make_payload(10**30, 2)),
+            make_record('good2', make_payload(2, 3))]}
+        response = lambda_processing.lambda_processing(event, self.engine)
+        self.assertEqual(response,
+                         {'batchItemFailures': [{'itemIdentifier': 'bad'}]})
+        statement = select(sql_model.CarbonIntensityTable)
+        results = sql_model.CarbonIntensityTable.read_all(self.engine,
+                                                          statement)
+        self.assertEqual(sorted(x.actual for x in results), [1, 2, 259])
+
+    def test_invalid_record_envelope(self):
+        """A record without a message ID fails the whole batch."""
+        event = {'Records': [make_record('good1', make_payload(1)),
+                             {'body': 'no'}]}
+        with self.assertRaises(ValueError):
+            lambda_processing.lambda_processing(event, self.engine)
+
+    def test_strict(self):
+        """Strict validation rejects a record with a missing field."""
+        record = make_record('a', make_payload(1))
+        del record['receiptHandle']
+        response = lambda_processing.lambda_processing(
+            {'Records': [record]}, self.engine, strict=True)
+        self.assertEqual(response,
+                         {'batchItemFailures': [{'itemIdentifier': 'a'}]})
+        response = lambda_processing.lambda_processing(
+            {'Records': [record]}, self.engine)
+        self.assertEqual(response, {'batchItemFailures': []})
+
     def test_bad_event_data(self):
         """Not a valid SQS event object."""
         with self.assertRaises(pydantic.ValidationError):
@@ -142,5 +329,191 @@ class TestCreateSQLEnginePSQL(TestLambdaProcessing):
         return db
 
 
+class TestDatabaseSettings(unittest.TestCase):
+
+    def make_settings(self, **kwargs) -> lambda_processing.DatabaseSettings:
+        return lambda_processing.DatabaseSettings(
+            db_user=None, db_name=':memory:', db_host=None,
+            db_dialect_driver='sqlite', **kwargs)
+
+    def test_single_pool(self):
+        engine = self.make_settings().create_sql_engine()
+        self.assertIsInstance(engine.pool, QueuePool)
+        self.assertEqual(engine.pool.size(), 1)  # type: ignore
+        self.assertEqual(engine.pool._max_overflow, 0)  # type: ignore
+        self.assertTrue(engine.pool._pre_ping)
+        self.assertEqual(engine.pool._recycle, 300)
+        with engine.connect():
+            pass
+
+    def test_null_pool(self):
+        engine = self.make_settings(pool_mode='null').create_sql_engine()
+        self.assertIsInstance(engine.pool, NullPool)
+
+    def test_queue_pool(self):
+        engine = self.make_settings(pool_mode='queue', pool_recycle=10,
+                                    pool_pre_ping=False).create_sql_engine()
+        self.assertFalse(engine.pool._pre_ping)
+        self.assertEqual(engine.pool._recycle, 10)
+
+    def test_bad_pool_mode(self):
+        with self.assertRaises(ValueError):
+            self.make_settings(pool_mode='bad').create_sql_engine()
+
+    def test_postgresql_timeouts(self):
+        settings = self.make_settings(connect_timeout=5,
+                                      statement_timeout_ms=2000)
+        self.assertEqual(settings._engine_options('postgresql')[
+            'connect_args'], {'connect_timeout': 5,
+                              'options': '-c statement_timeout=2000'})
+        self.assertNotIn('connect_args', settings._engine_options('sqlite'))
+
+    def test_postgresql_timeouts_null_pool(self):
+        """Behind a pooler, the statement timeout is set per transaction."""
+        settings = self.make_settings(pool_mode='null', connect_timeout=5,
+                                      statement_timeout_ms=2000)
+        self.assertEqual(settings._engine_options('postgresql')[
+            'connect_args'], {'connect_timeout': 5})
+        self.assertEqual(settings._engine_options('postgresql', True)[
+            'connect_args'], {'timeout': 5})
+        engine = create_engine('sqlite://')
+        engine.dialect.name = 'postgresql'
+        settings._set_statement_timeout(engine)
+        with mock.patch.object(Connection, 'exec_driver_sql') as execute:
+            with engine.begin():
+                pass
+        execute.assert_called_once_with('SET LOCAL statement_timeout = 2000')
+
+    def test_from_environment(self):
+        environment = {'DB_USER': 'u', 'DB_NAME': 'n', 'DB_PASSWORD': '',
+                       'DB_HOST': 'h', 'DB_PORT': '5432',
+                       'DB_DIALECT_DRIVER': 'postgresql+psycopg2',
+                       'DB_POOL_MODE': 'null', 'DB_POOL_RECYCLE': '60',
+                       'DB_POOL_PRE_PING': 'false',
+                       'DB_CONNECT_TIMEOUT': '3',
+                       'DB_STATEMENT_TIMEOUT_MS': '500'}
+        with mock.patch.dict(os.environ, environment):
+            settings = lambda_processing.DatabaseSettings.from_environment()
+        self.assertEqual(settings.pool_mode, 'null')
+        self.assertEqual(settings.pool_recycle, 60)
+        self.assertFalse(settings.pool_pre_ping)
+        self.assertEqual(settings.connect_timeout, 3)
+        self.assertEqual(settings.statement_timeout_ms, 500)
+
+    def test_pool_recycle_from_environment(self):
+        """DB_POOL_RECYCLE=0 is kept; unset gives the default."""
+        environment = {'DB_USER': 'u', 'DB_NAME': 'n', 'DB_PASSWORD': '',
+                       'DB_HOST': 'h', 'DB_PORT': '5432',
+                       'DB_DIALECT_DRIVER': 'postgresql+psycopg2'}
+        for value, expected in [('0', 0), (None, 300)]:
+            with self.subTest(value=value), \
+                    mock.patch.dict(os.environ, environment):
+                os.environ.pop('DB_POOL_RECYCLE', None)
+                if value is not None:
+                    os.environ['DB_POOL_RECYCLE'] = value
+                settings = (lambda_processing.DatabaseSettings
+                            .from_environment())
+                self.assertEqual(settings.pool_recycle, expected)
+
+
+class TestLambdaProcessingAsync(unittest.IsolatedAsyncioTestCase):
+    """The asyncio variant, using SQLite and aiosqlite."""
+
+    def setUp(self) -> None:
+        try:
+            import aiosqlite  # noqa
+        except ImportError:
+            self.skipTest("aiosqlite is not installed")
+        self.db = SQLiteHelper()
+        settings = lambda_processing.DatabaseSettings(
+            db_user=None, db_name=self.db.dbname, db_host=None,
+            db_dialect_driver='sqlite')
+        self.engine = settings.create_sql_engine()
+        SQLModel.metadata.create_all(self.engine)
+        self.async_engine = settings.create_async_sql_engine()
+
+    async def asyncTearDown(self) -> None:
+        await self.async_engine.dispose()
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+        self.db.tearDown()
+
+    def read_actual(self) -> list[int]:
+        results = sql_model.CarbonIntensityTable.read_all(
+            self.engine, select(sql_model.CarbonIntensityTable))
+        return sorted(x.actual for x in results)
+
+    async def test_write(self):
+        event = get_test_event_data()
+        response = await lambda_processing.lambda_processing_async(
+            event, self.async_engine)
+        self.assertEqual(response, {'batchItemFailures': []})
+        self.assertEqual(self.read_actual(), [259])
+
+    async def test_written_cache(self):
+        SQLModel.metadata.drop_all(self.engine)
+        sql_model.keyed_metadata.create_all(self.engine)
+        table = sql_model.KeyedCarbonIntensityTable
+        written = ttl_cache.TTLCache(10, 60)
+        records = [make_record(str(i), make_payload(i, i + 1))
+                   for i in range(3)]
+        await lambda_processing.lambda_processing_async(
+            {'Records': records[:2]}, self.async_engine, written=written,
+            registry=KEYED_REGISTRY, chunk_size=1)
+        with mock.patch.object(table, 'add_rows_async',
+                               wraps=table.add_rows_async) as add_rows:
+            response = await lambda_processing.lambda_processing_async(
+                {'Records': records}, self.async_engine, written=written,
+                registry=KEYED_REGISTRY, chunk_size=1)
+        self.assertEqual(response, {'batchItemFailures': []})
+        self.assertEqual(add_rows.call_count, 1)
+        results = table.read_all(self.engine, select(table))
+        self.assertEqual(sorted(x.actual for x in results), [0, 1, 2])
+
+    async def test_chunks_partial_failure(self):
+        """Records in several chunks, with failures in two chunks."""
+        records = [make_record(str(i), make_payload(i, i + 1))
+                   for i in range(7)]
+        records[1] = make_record(
+            'bad1', make_payload("x", 20))
+        records[5] = make_record(
+            'bad2', make_payload(10**30, 21))
+        response = await lambda_processing.lambda_processing_async(
+            {'Records': records}, self.async_engine, chunk_size=3)
+        self.assertEqual(response, {'batchItemFailures': [
+            {'itemIdentifier': 'bad1'}, {'itemIdentifier': 'bad2'}]})
+        self.assertEqual(self.read_actual(), [0, 2, 3, 4, 6])
+
+    async def test_bad_event_data(self):
+        with self.assertRaises(pydantic.ValidationError):
+            await lambda_processing.lambda_processing_async(
+                {"Records": "no"}, self.async_engine)
+
+    async def test_unreportable_failure(self):
+        """Earlier chunks are still written before the error is raised."""
+        records = [make_record('a', make_payload(1)),
+                   {'body': 'no'}]
+        with self.assertRaises(ValueError):
+            await lambda_processing.lambda_processing_async(
+                {'Records': records}, self.async_engine, chunk_size=1)
+        self.assertEqual(self.read_actual(), [1])
+
+    def test_no_async_driver(self):
+        settings = lambda_processing.DatabaseSettings(
+            db_user=None, db_name='x', db_host=None,
+            db_dialect_driver='mysql')
+        with self.assertRaises(ValueError):
+            settings.create_async_sql_engine()
+
+    def test_async_postgresql_options(self):
+        settings = lambda_processing.DatabaseSettings(
+            db_user=None, db_name='x', db_host=None, connect_timeout=5,
+            statement_timeout_ms=2000)
+        self.assertEqual(
+            settings._engine_options('postgresql', True)['connect_args'],
+            {'timeout': 5, 'server_settings': {'statement_timeout': '2000'}})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,114 @@
+"""Unit tests for file registry.py"""
+import unittest
+import sys
+import logging
+from unittest import mock
+
+from sqlmodel import select, create_engine, SQLModel
+from sqlalchemy import MetaData
+
+logging.getLogger().setLevel("CRITICAL")
+sys.path.append("function")
+
+import lambda_processing  # type: ignore # noqa
+import registry  # type: ignore # noqa
+import source_model  # type: ignore # noqa
+import sql_model  # type: ignore # noqa
+import sql_model_base  # type: ignore # noqa
+from sql_helper import SQLiteHelper  # noqa
+from event_helper import make_payload, make_record  # noqa
+
+
+class FeedRecord(sql_model.CarbonIntensityRecord):
+    pass
+
+
+class FeedTable(FeedRecord, sql_model_base.DataModelTable[
+                    FeedRecord, source_model.CarbonIntensityData],
+                table=True):
+    metadata = MetaData()
+    __natural_key__ = ('time',)
+    id: int | None = sql_model.sqlmodel.Field(default=None,
+                                              primary_key=True)
+
+
+def feed_record(message_id: str, actual: int, day: int = 1) -> dict:
+    record = make_record(message_id, make_payload(actual, day))
+    record['messageAttributes'] = {'source': {'stringValue': 'feed',
+                                              'dataType': 'String'}}
+    return record
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.registry = registry.Registry(default='carbonintensity')
+        self.registry.register('carbonintensity', sql_model.row_from_payload,
+                               sql_model.CarbonIntensityTable)
+        self.registry.register('feed', sql_model.row_from_payload, FeedTable)
+
+    def test_lookup(self):
+        self.assertIs(self.registry.lookup(make_record('a', {})).table,
+                      sql_model.CarbonIntensityTable)
+        self.assertIs(self.registry.lookup(feed_record('b', 1)).table,
+                      FeedTable)
+
+    def test_unknown(self):
+        record = feed_record('a', 1)
+        record['messageAttributes']['source']['stringValue'] = 'unknown'
+        with self.assertRaises(ValueError):
+            self.registry.lookup(record)
+        with self.assertRaises(ValueError):
+            registry.Registry().lookup(make_record('a', {}))
+
+    def test_default_registry(self):
+        self.assertIs(
+            registry.DEFAULT_REGISTRY.lookup(make_record('a', {})).table,
+            sql_model.CarbonIntensityTable)
+
+
+class TestRegistryProcessing(unittest.TestCase):
+    """One batch holding records for two tables."""
+
+    def setUp(self) -> None:
+        self.sqlite = SQLiteHelper()
+        self.engine = create_engine(f"sqlite:///{self.sqlite.dbname}")
+        SQLModel.metadata.create_all(self.engine)
+        FeedTable.metadata.create_all(self.engine)
+        self.registry = registry.Registry(default='carbonintensity')
+        self.registry.register('carbonintensity', sql_model.row_from_payload,
+                               sql_model.CarbonIntensityTable)
+        self.registry.register('feed', sql_model.row_from_payload, FeedTable)
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+        self.sqlite.tearDown()
+
+    def read_actual(self, table: type) -> list[int]:
+        return sorted(x.actual for x in
+                      table.read_all(self.engine, select(table)))
+
+    def test_grouped_writes(self):
+        records = [make_record('a', make_payload(1, 1)),
+                   feed_record('b', 2, 1),
+                   make_record('c', make_payload(3, 2)),
+                   feed_record('d', 4, 2)]
+        records[3]['messageAttributes']['source']['stringValue'] = 'x'
+        with mock.patch.object(sql_model.CarbonIntensityTable, 'add_rows',
+                               wraps=sql_model.CarbonIntensityTable
+                               .add_rows) as add_main, \
+                mock.patch.object(FeedTable, 'add_rows',
+                                  wraps=FeedTable.add_rows) as add_feed:
+            response = lambda_processing.lambda_processing(
+                {'Records': records}, self.engine, registry=self.registry)
+        self.assertEqual(response, {'batchItemFailures': [
+            {'itemIdentifier': 'd'}]})
+        self.assertEqual(add_main.call_count, 1)
+        self.assertEqual(add_feed.call_count, 1)
+        self.assertEqual(self.read_actual(sql_model.CarbonIntensityTable),
+                         [1, 3])
+        self.assertEqual(self.read_actual(FeedTable), [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
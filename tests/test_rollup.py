@@ -0,0 +1,211 @@
+"""Unit tests for file rollup.py"""
+import unittest
+import sys
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from sqlmodel import create_engine, SQLModel
+from sqlalchemy.ext.asyncio import create_async_engine
+
+sys.path.append("function")
+
+import rollup  # type: ignore # noqa
+import schema  # type: ignore # noqa
+import sql_model  # type: ignore # noqa
+from sql_helper import SQLiteHelper  # noqa
+
+START = datetime(2023, 12, 31, 22, 15)
+STEP = timedelta(minutes=30)
+RATINGS = ['very low', 'low', 'moderate', 'high', 'very high']
+
+
+def make_rows(n: int, offset: int = 0) -> list[dict]:
+    """Half-hourly rows, from December 2023 into January 2024."""
+    return [{'rating': RATINGS[i % 5], 'forecast': i, 'actual': 2*i + offset,
+             'time': START + i*STEP} for i in range(n)]
+
+
+class TestBuckets(unittest.TestCase):
+
+    def test_bucket_start(self):
+        time = datetime(2024, 3, 5, 18, 45, tzinfo=timezone.utc)
+        self.assertEqual(rollup.bucket_start(time, 'hour'),
+                         datetime(2024, 3, 5, 18))
+        self.assertEqual(rollup.bucket_start(time, 'day'),
+                         datetime(2024, 3, 5))
+        self.assertEqual(rollup.bucket_start(time, 'month'),
+                         datetime(2024, 3, 1))
+
+    def test_bucket_end(self):
+        self.assertEqual(rollup.bucket_end(datetime(2024, 3, 5, 18), 'hour'),
+                         datetime(2024, 3, 5, 19))
+        self.assertEqual(rollup.bucket_end(datetime(2024, 2, 29), 'day'),
+                         datetime(2024, 3, 1))
+        self.assertEqual(rollup.bucket_end(datetime(2023, 12, 1), 'month'),
+                         datetime(2024, 1, 1))
+
+    def test_combine(self):
+        combined = rollup.combine(
+            [rollup._unit_rollup(mock.Mock(**x)) for x in make_rows(3)])
+        self.assertEqual(combined['count'], 3)
+        self.assertEqual((combined['actual_min'], combined['actual_mean'],
+                          combined['actual_max']), (0, 2, 4))
+        self.assertEqual([combined[x] for x in
+                          rollup.RATING_COLUMNS.values()], [1, 1, 1, 0, 0])
+
+    def test_lock_months(self):
+        """On PostgreSQL, lock each month in order."""
+        connection = mock.Mock()
+        connection.dialect.name = 'postgresql'
+        rollup._lock_months(connection, {datetime(2024, 1, 1),
+                                         datetime(2023, 12, 1)})
+        self.assertEqual(
+            [str(x.args[0].compile(compile_kwargs={'literal_binds': True}))
+             for x in connection.execute.call_args_list],
+            [f'SELECT pg_advisory_xact_lock({rollup.ROLLUP_LOCK_ID}, {x}) '
+             'AS pg_advisory_xact_lock_1' for x in [24287, 24288]])
+
+        connection.dialect.name = 'sqlite'
+        connection.reset_mock()
+        rollup._lock_months(connection, {datetime(2024, 1, 1)})
+        connection.execute.assert_not_called()
+
+
+class TestRollup(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.sqlite = SQLiteHelper()
+        self.engine = create_engine(f"sqlite:///{self.sqlite.dbname}")
+        schema.metadata_for(rollups=True).create_all(self.engine)
+        self.patch = mock.patch.object(sql_model.CarbonIntensityTable,
+                                       '__after_write__', ())
+        self.patch.start()
+        rollup.enable()
+
+    def tearDown(self) -> None:
+        self.patch.stop()
+        self.engine.dispose()
+        self.sqlite.tearDown()
+
+    def expected(self, rows: list[dict], granularity: str) -> dict:
+        """Compute the rollups from all of the rows."""
+        buckets: dict[datetime, list[dict]] = {}
+        for row in rows:
+            buckets.setdefault(rollup.bucket_start(row['time'], granularity),
+                               []).append(row)
+        return {k: (len(v), min(x['actual'] for x in v),
+                    sum(x['actual'] for x in v) / len(v),
+                    max(x['forecast'] for x in v),
+                    sum(x['rating'] == 'low' for x in v))
+                for k, v in buckets.items()}
+
+    def read(self, granularity: str) -> dict:
+        return {x.bucket: (x.count, x.actual_min, x.actual_mean,
+                           x.forecast_max, x.rating_low)
+                for x in rollup.read_rollup(
+                    self.engine, granularity, datetime(2023, 1, 1),
+                    datetime(2025, 1, 1))}
+
+    def test_incremental(self):
+        """Rollups updated batch by batch match those of all the rows."""
+        rows = make_rows(100)
+        for i in range(0, 100, 7):
+            sql_model.CarbonIntensityTable.add_rows(self.engine,
+                                                    rows[i:i + 7])
+        for granularity in rollup.GRANULARITIES:
+            with self.subTest(granularity=granularity):
+                self.assertEqual(self.read(granularity),
+                                 self.expected(rows, granularity))
+        self.assertEqual(len(self.read('month')), 2)
+
+    def test_many_buckets(self):
+        """Rows in more separate buckets than SQLite allows in one query."""
+        rows = [{'rating': 'low', 'forecast': i, 'actual': i,
+                 'time': START + 4*i*STEP} for i in range(1200)]
+        sql_model.CarbonIntensityTable.add_rows(self.engine, rows)
+        self.assertEqual(self.read('hour'), self.expected(rows, 'hour'))
+        self.assertEqual(self.read('day'), self.expected(rows, 'day'))
+
+    def test_update(self):
+        """Records replaced by an upsert are replaced in the rollups."""
+        table = sql_model.KeyedCarbonIntensityTable
+        sql_model.CarbonIntensityTable.__table__.drop(self.engine)
+        sql_model.keyed_metadata.create_all(self.engine)
+        rows = make_rows(10)
+        with mock.patch.object(table, '__after_write__', ()):
+            rollup.enable(table)
+            table.add_rows(self.engine, rows)
+            changed = make_rows(10, offset=100)[3:5]
+            table.add_rows(self.engine, changed)
+        rows[3:5] = changed
+        self.assertEqual(self.read('day'), self.expected(rows, 'day'))
+
+    def test_range(self):
+        sql_model.CarbonIntensityTable.add_rows(self.engine, make_rows(10))
+        results = rollup.read_rollup(self.engine, 'hour',
+                                     datetime(2024, 1, 1),
+                                     datetime(2024, 1, 1, 2))
+        self.assertEqual([x.bucket for x in results],
+                         [datetime(2024, 1, 1), datetime(2024, 1, 1, 1)])
+        self.assertIsInstance(results[0], rollup.CarbonIntensityRollup)
+
+    def test_add_rollups(self):
+        """Rollups can be written as records, but not from the API data."""
+        table = rollup.CarbonIntensityRollupTable
+        self.assertFalse(hasattr(table, 'add_from_source_model'))
+        item = rollup.CarbonIntensityRollup(
+            granularity='day', bucket=datetime(2024, 1, 1),
+            **rollup.combine([rollup._unit_rollup(mock.Mock(**x))
+                              for x in make_rows(2)]))
+        table.add_many_from_db_models(self.engine, [item])
+        self.assertEqual(rollup.read_rollup(self.engine, 'day', START,
+                                            datetime(2025, 1, 1)), [item])
+
+    def test_bad_granularity(self):
+        with self.assertRaises(ValueError):
+            rollup.read_rollup(self.engine, 'week', START, START)
+
+    def test_enable_once(self):
+        rollup.enable()
+        self.assertEqual(sql_model.CarbonIntensityTable.__after_write__,
+                         (rollup.update_rollups,))
+
+    def test_metadata(self):
+        self.assertEqual(len(schema.metadata_for().tables), 1)
+        self.assertEqual(set(schema.metadata_for(rollups=True).tables),
+                         {'carbonintensityrecord', 'carbonintensityrollup'})
+
+
+class TestRollupAsync(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        try:
+            import aiosqlite  # noqa
+        except ImportError:
+            self.skipTest("aiosqlite is not installed")
+        self.sqlite = SQLiteHelper()
+        self.engine = create_engine(f"sqlite:///{self.sqlite.dbname}")
+        schema.metadata_for(rollups=True).create_all(self.engine)
+        self.async_engine = create_async_engine(
+            f"sqlite+aiosqlite:///{self.sqlite.dbname}")
+
+    async def asyncTearDown(self) -> None:
+        await self.async_engine.dispose()
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+        self.sqlite.tearDown()
+
+    async def test_add_rows_async(self):
+        with mock.patch.object(sql_model.CarbonIntensityTable,
+                               '__after_write__', (rollup.update_rollups,)):
+            await sql_model.CarbonIntensityTable.add_rows_async(
+                self.async_engine, make_rows(4))
+        results = rollup.read_rollup(self.engine, 'month',
+                                     datetime(2023, 1, 1),
+                                     datetime(2025, 1, 1))
+        self.assertEqual([x.count for x in results], [4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+"""Unit tests for file schema.py"""
+import unittest
+import sys
+import os
+from datetime import datetime
+
+from sqlmodel import create_engine, select, SQLModel
+from sqlalchemy import (MetaData, Table, Column, Integer, Index, inspect,
+                        text)
+from sqlalchemy.exc import OperationalError
+
+sys.path.append("function")
+
+import schema  # type: ignore # noqa
+import sql_model  # type: ignore # noqa
+from sql_helper import SQLiteHelper, make_baseline_table  # noqa
+
+
+class TestSchema(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.sqlite = SQLiteHelper()
+        self.engine = create_engine(f"sqlite:///{self.sqlite.dbname}")
+
+    def test_fingerprint_stable(self):
+        self.assertEqual(schema.fingerprint(self.engine),
+                         schema.fingerprint(self.engine))
+
+    def test_no_version(self):
+        self.assertIsNone(schema.stored_fingerprint(self.engine))
+
+    def test_unreachable(self):
+        """Failing to connect is not mistaken for a missing version."""
+        engine = create_engine(
+            f"sqlite:///{self.sqlite.dbname}.missing/database.db")
+        with self.assertRaises(OperationalError):
+            schema.stored_fingerprint(engine)
+
+    def test_ensure_schema(self):
+        """The bootstrap runs only once for unchanged models."""
+        self.assertTrue(schema.ensure_schema(self.engine))
+        self.assertEqual(
+            sorted(self.sqlite.get_table_names()),
+            sorted([sql_model.CarbonIntensityRecord.__tablename__,
+                    schema.schema_version.name]))
+        self.assertEqual(schema.stored_fingerprint(self.engine),
+                         schema.fingerprint(self.engine))
+        self.assertFalse(schema.ensure_schema(self.engine))
+        self.assertEqual(self.sqlite.get_table_length(
+            schema.schema_version.name), 1)
+
+    def test_changed_model(self):
+        """A change in the model definitions triggers a new bootstrap."""
+        schema.ensure_schema(self.engine)
+        metadata = MetaData()
+        Table('other', metadata, Column('id', Integer, primary_key=True))
+        self.assertTrue(schema.ensure_schema(self.engine, metadata))
+        self.assertIn('other', self.sqlite.get_table_names())
+        self.assertEqual(self.sqlite.get_table_length(
+            schema.schema_version.name), 2)
+
+    def test_missing_index(self):
+        """An index declared after table creation is added."""
+        old = MetaData()
+        Table('other', old, Column('id', Integer, primary_key=True),
+              Column('x', Integer))
+        old.create_all(self.engine)
+        new = MetaData()
+        table = Table('other', new, Column('id', Integer, primary_key=True),
+                      Column('x', Integer))
+        Index('ix_other_x', table.c.x, unique=True)
+        schema.ensure_schema(self.engine, new)
+        indexes = inspect(self.engine).get_indexes('other')
+        self.assertEqual([x['name'] for x in indexes], ['ix_other_x'])
+
+    def test_existing_duplicates(self):
+        """A table created without the unique index may repeat times.
+
+        The bootstrap does not delete them: it skips the unique index and
+        the version, until dedupe deletes all but the latest of each time.
+        """
+        table = sql_model.KeyedCarbonIntensityTable.__table__
+        old = make_baseline_table(self.engine, table, [
+            datetime(2024, 1, 1, i) for i in [0, 1, 0, 2, 1, 0]])
+
+        def read() -> list:
+            with self.engine.connect() as connection:
+                return connection.execute(select(
+                    old.c.id, old.c.actual).order_by(old.c.id)).all()
+
+        def index_names() -> list:
+            return [x['name'] for x in
+                    inspect(self.engine).get_indexes(table.name)]
+
+        self.assertTrue(schema.ensure_schema(self.engine))
+        self.assertEqual(len(read()), 6)
+        metadata = schema.metadata_for(natural_key=True)
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertTrue(schema.ensure_schema(self.engine, metadata))
+        self.assertIn("3 rows repeat", logs.output[0])
+        self.assertEqual(len(read()), 6)
+        self.assertNotIn('uq_carbonintensityrecord_natural_key',
+                         index_names())
+        self.assertNotEqual(schema.stored_fingerprint(self.engine),
+                            schema.fingerprint(self.engine, metadata))
+
+        self.assertEqual(schema.dedupe(self.engine, metadata), 3)
+        self.assertEqual(read(), [(4, 3), (5, 4), (6, 5)])
+        self.assertTrue(schema.ensure_schema(self.engine, metadata))
+        self.assertIn('uq_carbonintensityrecord_natural_key', index_names())
+        self.assertFalse(schema.ensure_schema(self.engine, metadata))
+
+    def test_bootstrap_if_changed(self):
+        """The fingerprint is checked again within the bootstrap."""
+        self.assertTrue(schema.bootstrap(self.engine, if_changed=True))
+        self.assertFalse(schema.bootstrap(self.engine, if_changed=True))
+        self.assertTrue(schema.bootstrap(self.engine))
+        self.assertEqual(self.sqlite.get_table_length(
+            schema.schema_version.name), 2)
+
+    def test_migrate_compact(self):
+        """The existing rows are converted to the compact columns."""
+        schema.ensure_schema(self.engine)
+        rows = [{'rating': x, 'forecast': i, 'actual': -i,
+                 'time': datetime(2024, 1, 1, i)}
+                for i, x in enumerate(sql_model.RATINGS)]
+        sql_model.CarbonIntensityTable.add_rows(self.engine, rows)
+        schema.migrate_compact(self.engine)
+
+        table = sql_model.CompactCarbonIntensityTable
+        results = table.read_all(self.engine, select(table).order_by(table.id))
+        self.assertEqual(results, [sql_model.CarbonIntensityRecord(**x)
+                                   for x in rows])
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.execute(text(
+                "SELECT rating FROM carbonintensityrecord ORDER BY id")
+                ).scalars().all(), [0, 1, 2, 3, 4])
+        self.assertEqual(
+            [x['name'] for x in inspect(self.engine).get_indexes(
+                table.__tablename__)],
+            ['uq_carbonintensityrecord_natural_key'])
+        self.assertFalse(schema.ensure_schema(
+            self.engine, schema.metadata_for(compact=True)))
+        # New rows continue the id sequence
+        table.add_rows(self.engine, [rows[0] | {'time': datetime(2024, 2, 1)}])
+        self.assertEqual(table.read_first(self.engine, select(table).where(
+            table.id == len(rows) + 1)).rating, 'very low')
+
+    def test_metadata_for(self):
+        self.assertIs(schema.metadata_for(compact=True),
+                      sql_model.compact_metadata)
+        self.assertIs(schema.metadata_for(partitioned=True),
+                      sql_model.partitioned_metadata)
+        with self.assertRaises(ValueError):
+            schema.metadata_for(partitioned=True, compact=True)
+
+    def test_default_metadata(self):
+        self.assertIs(SQLModel.metadata,
+                      sql_model.CarbonIntensityTable.metadata)
+
+    def tearDown(self) -> None:
+        if os.getenv('STEP_TESTS', None):
+            print()
+            print(f'Finished test: {unittest.TestCase.id(self)}')
+            input("Press Enter to tear down...")
+        self.engine.dispose()
+        self.sqlite.tearDown()
+        return super().tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,17 +4,23 @@ Set environment variable STEP_TESTS to any value to step through SQL tests.
 """
 import unittest
 import sys
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import os
+import json
+from unittest import mock
 
 from sqlmodel import select, create_engine, SQLModel
+from sqlalchemy import MetaData
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.ext.asyncio import create_async_engine
 import pydantic
 
 sys.path.append("function")
 
 import sql_model  # type: ignore # noqa
 import source_model  # type: ignore # noqa
-from sql_helper import SQLiteHelper  # noqa
+import sql_model_base  # type: ignore # noqa
+from sql_helper import PSQLHelper, SQLiteHelper  # noqa
 
 
 TEST_ARGS = dict(rating="high", forecast=10,
@@ -37,6 +43,15 @@ class TestCarbonIntensity(unittest.TestCase):
             sql_model.CarbonIntensityRecord(rating="wrong", forecast=10,
                                             actual=400, time=datetime.now())
 
+    def test_valid_ratings(self):
+        """Every rating of the source model is valid."""
+        for rating in sql_model.RATINGS:
+            with self.subTest(rating=rating):
+                carb = sql_model.CarbonIntensityRecord(
+                    rating=rating, forecast=10, actual=400,
+                    time=datetime.now())
+                self.assertEqual(carb.rating, rating)
+
     def test_invalid_forecast(self):
         with self.assertRaises(pydantic.ValidationError):
             sql_model.CarbonIntensityRecord(rating="low",
@@ -73,6 +88,51 @@ class TestCarbonIntensity(unittest.TestCase):
         self.assertEqual(db_obj.time, expected_time)
 
 
+class TestRowFromPayload(unittest.TestCase):
+    """The direct conversion must match the model-based conversion."""
+
+    VALID_FILES = ['tests/test_api_response.txt',
+                   'tests/test_api_actual_null.txt',
+                   'tests/test_api_forecast_null.txt']
+
+    def model_path(self, payload_txt: str) -> dict:
+        source_data = source_model.validate_json(payload_txt).data[0]
+        db_obj = sql_model.CarbonIntensityRecord.from_source_model(source_data)
+        return sql_model.CarbonIntensityTable._create_row_from_model(db_obj)
+
+    def test_same_as_models(self):
+        for filename in self.VALID_FILES:
+            with open(filename, 'r') as file:
+                payload_txt = file.read()
+            expected = self.model_path(payload_txt)
+            for payload in [payload_txt, payload_txt.encode(),
+                            json.loads(payload_txt)]:
+                with self.subTest(filename=filename, type=type(payload)):
+                    row = sql_model.row_from_payload(payload)
+                    self.assertEqual(row, expected)
+                    self.assertEqual(
+                        [type(x) for x in row.values()],
+                        [type(x) for x in expected.values()])
+
+    def test_invalid(self):
+        with open('tests/test_api_response.txt', 'r') as file:
+            good = json.loads(file.read())
+        bad_payloads = [
+            '{"data": []}',
+            json.dumps({'data': good['data'] * 2}),
+            json.dumps(good).replace('"high"', '"wrong"'),
+            json.dumps(good).replace('247', '"x"'),
+            json.dumps(good).replace('"from"', '"fromm"')]
+        with open('tests/test_api_both_null.txt', 'r') as file:
+            bad_payloads.append(file.read())
+        for payload_txt in bad_payloads:
+            with self.subTest(payload=payload_txt):
+                with self.assertRaises(ValueError):
+                    sql_model.row_from_payload(payload_txt)
+                with self.assertRaises(ValueError):
+                    self.model_path(payload_txt)
+
+
 class TestCarbonIntensityTable(unittest.TestCase):
 
     def setUp(self) -> None:
@@ -86,14 +146,20 @@ class TestCarbonIntensityTable(unittest.TestCase):
         self.assertEqual(table_names[0],
                          sql_model.CarbonIntensityRecord.__tablename__)
 
-    def test_create_table_item(self):
+    def test_create_row(self):
         carb = sql_model.CarbonIntensityRecord(**TEST_ARGS)  # type: ignore
-        item = sql_model.CarbonIntensityTable._create_table_item_from_model(
-                                                                        carb)
-        self.assertIsInstance(item, sql_model.CarbonIntensityTable)
-        for i, tup in enumerate(carb):
-            with self.subTest(i=i):
-                self.assertEqual(tup[1], TEST_ARGS[tup[0]])
+        row = sql_model.CarbonIntensityTable._create_row_from_model(carb)
+        self.assertEqual(row, TEST_ARGS)
+
+    def test_naive_utc_datetime(self):
+        """Aware times are written as naive UTC, which asyncpg requires."""
+        column = sql_model.CarbonIntensityTable.__table__.c.time
+        naive = datetime(2024, 6, 1, 12)
+        aware = datetime(2024, 6, 1, 13, tzinfo=timezone(timedelta(hours=1)))
+        for value in [naive, aware]:
+            with self.subTest(value=value):
+                self.assertEqual(
+                    column.type.process_bind_param(value, None), naive)
 
     def test_add_from_db_model(self):
         carb = sql_model.CarbonIntensityRecord(**TEST_ARGS)  # type: ignore
@@ -115,6 +181,44 @@ class TestCarbonIntensityTable(unittest.TestCase):
                 with self.subTest(k=k):
                     self.assertEqual(data[0][0][0:19], str(TEST_ARGS[k])[0:19])
 
+    def test_add_many_from_db_models(self):
+        """Add several entries in one call, then read back to check."""
+        entries = [sql_model.CarbonIntensityRecord(
+                        rating='moderate', forecast=i, actual=i + 1,
+                        time=datetime(2024, 1, 1, i)) for i in range(5)]
+        sql_model.CarbonIntensityTable.add_many_from_db_models(self.engine,
+                                                               entries)
+        self.assertEqual(self.sqlite.get_table_length(
+            sql_model.CarbonIntensityRecord.__tablename__), 5)  # type: ignore
+        results = sql_model.CarbonIntensityTable.read_all(
+            self.engine, select(sql_model.CarbonIntensityTable))
+        self.assertEqual(results, entries)
+
+    def test_add_rows(self):
+        carb = sql_model.CarbonIntensityRecord(**TEST_ARGS)  # type: ignore
+        sql_model.CarbonIntensityTable.add_rows(self.engine, [TEST_ARGS])
+        results = sql_model.CarbonIntensityTable.read_all(
+            self.engine, select(sql_model.CarbonIntensityTable))
+        self.assertEqual(results, [carb])
+
+    def test_add_many_empty(self):
+        sql_model.CarbonIntensityTable.add_many_from_db_models(self.engine,
+                                                               [])
+        self.assertEqual(self.sqlite.get_table_length(
+            sql_model.CarbonIntensityRecord.__tablename__), 0)  # type: ignore
+
+    def test_insert_statement_cached(self):
+        """The statement is built once per dialect and conflict setting."""
+        table = sql_model.CarbonIntensityTable
+        statement = table._insert_statement('sqlite')
+        self.assertIs(table._insert_statement('sqlite'), statement)
+        self.assertIsNot(table._insert_statement('postgresql'), statement)
+        with mock.patch.object(table, '__on_conflict__', 'nothing'):
+            self.assertIsNot(table._insert_statement('sqlite'), statement)
+        with mock.patch.object(table, '_build_insert_statement') as build:
+            table.add_rows(self.engine, [TEST_ARGS])
+        build.assert_not_called()
+
     def test_read_all(self):
         """Add multiple entries, then read back to check."""
         c1 = sql_model.CarbonIntensityRecord(rating='very high', forecast=0,
@@ -169,6 +273,117 @@ class TestCarbonIntensityTable(unittest.TestCase):
                                                             statement)
         self.assertEqual(results, c1)
 
+    def add_test_entries(self) -> list:
+        entries = [sql_model.CarbonIntensityRecord(
+                        rating='moderate', forecast=i, actual=i + 1,
+                        time=datetime(2024, 1, 1, i)) for i in range(3)]
+        sql_model.CarbonIntensityTable.add_many_from_db_models(self.engine,
+                                                               entries)
+        return entries
+
+    def test_read_columns(self):
+        entries = self.add_test_entries()
+        statement = select(sql_model.CarbonIntensityTable).order_by(
+            sql_model.CarbonIntensityTable.time)
+        columns = sql_model.CarbonIntensityTable.read_columns(self.engine,
+                                                              statement)
+        self.assertEqual(list(columns),
+                         ['rating', 'forecast', 'actual', 'time', 'id'])
+        for k in TEST_ARGS:
+            with self.subTest(k=k):
+                self.assertEqual(columns[k], [getattr(x, k) for x in entries])
+
+    def test_read_columns_selected(self):
+        self.add_test_entries()
+        statement = select(sql_model.CarbonIntensityTable.actual).where(
+            sql_model.CarbonIntensityTable.forecast > 0)
+        columns = sql_model.CarbonIntensityTable.read_columns(self.engine,
+                                                              statement)
+        self.assertEqual(columns, {'actual': [2, 3]})
+
+    def test_read_columns_empty(self):
+        statement = select(sql_model.CarbonIntensityTable.actual,
+                           sql_model.CarbonIntensityTable.time)
+        columns = sql_model.CarbonIntensityTable.read_columns(self.engine,
+                                                              statement)
+        self.assertEqual(columns, {'actual': [], 'time': []})
+
+    def test_read_chunks(self):
+        entries = [sql_model.CarbonIntensityRecord(
+                        rating='low', forecast=i, actual=i,
+                        time=datetime(2024, 1, 1 + i)) for i in range(7)]
+        sql_model.CarbonIntensityTable.add_many_from_db_models(self.engine,
+                                                               entries)
+        statement = select(sql_model.CarbonIntensityTable).order_by(
+            sql_model.CarbonIntensityTable.time)
+        chunks = list(sql_model.CarbonIntensityTable.read_chunks(
+            self.engine, statement, 3))
+        self.assertEqual([len(x) for x in chunks], [3, 3, 1])
+        self.assertEqual([x for chunk in chunks for x in chunk], entries)
+        for x in chunks[0]:
+            self.assertIsInstance(x, sql_model.CarbonIntensityRecord)
+            self.assertNotIsInstance(x, sql_model.CarbonIntensityTable)
+
+    def test_iter_read(self):
+        entries = self.add_test_entries()
+        statement = select(sql_model.CarbonIntensityTable).order_by(
+            sql_model.CarbonIntensityTable.time)
+        results = sql_model.CarbonIntensityTable.iter_read(
+            self.engine, statement, 2)
+        self.assertNotIsInstance(results, list)
+        self.assertEqual(list(results), entries)
+
+    def test_iter_read_raw(self):
+        entries = self.add_test_entries()
+        statement = select(sql_model.CarbonIntensityTable.actual).order_by(
+            sql_model.CarbonIntensityTable.time)
+        results = list(sql_model.CarbonIntensityTable.iter_read(
+            self.engine, statement, 2, raw=True))
+        self.assertEqual([tuple(x) for x in results],
+                         [(x.actual,) for x in entries])
+
+    def test_read_range(self):
+        entries = [sql_model.CarbonIntensityRecord(
+                        rating='low', forecast=i, actual=i,
+                        time=datetime(2024, 1, 1, i)) for i in range(6)]
+        sql_model.CarbonIntensityTable.add_many_from_db_models(
+            self.engine, entries[::-1])
+        results = sql_model.CarbonIntensityTable.read_range(
+            self.engine, datetime(2024, 1, 1, 2), datetime(2024, 1, 1, 5))
+        self.assertEqual(results, entries[2:5])
+
+    def test_read_latest(self):
+        entries = [sql_model.CarbonIntensityRecord(
+                        rating='low', forecast=i, actual=i,
+                        time=datetime(2024, 1, 1, i)) for i in range(6)]
+        sql_model.CarbonIntensityTable.add_many_from_db_models(
+            self.engine, entries[::-1])
+        results = sql_model.CarbonIntensityTable.read_latest(self.engine, 2)
+        self.assertEqual(results, entries[4:])
+        results = sql_model.CarbonIntensityTable.read_latest(self.engine, 10)
+        self.assertEqual(results, entries)
+
+    def test_no_time_column(self):
+        with mock.patch.object(sql_model.CarbonIntensityTable,
+                               '__time_column__', None):
+            with self.assertRaises(NotImplementedError):
+                sql_model.CarbonIntensityTable.read_latest(self.engine, 1)
+
+    def test_read_numpy(self):
+        try:
+            import numpy  # noqa
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        entries = self.add_test_entries()
+        statement = select(sql_model.CarbonIntensityTable).order_by(
+            sql_model.CarbonIntensityTable.time)
+        array = sql_model.CarbonIntensityTable.read_numpy(self.engine,
+                                                          statement)
+        self.assertEqual(len(array), 3)
+        self.assertEqual(list(array.actual), [x.actual for x in entries])
+        self.assertEqual(list(array['rating']), ['moderate'] * 3)
+        self.assertEqual(array.forecast.sum(), 3)
+
     def tearDown(self) -> None:
         if os.getenv('STEP_TESTS', None):
             print()
@@ -178,5 +393,459 @@ class TestCarbonIntensityTable(unittest.TestCase):
         return super().tearDown()
 
 
+class TestKeyedCarbonIntensityTable(unittest.TestCase):
+    """Writes to the table keyed on the time are upserts."""
+
+    def setUp(self) -> None:
+        self.sqlite = SQLiteHelper()
+        self.engine = create_engine(f"sqlite:///{self.sqlite.dbname}")
+        sql_model.keyed_metadata.create_all(self.engine)
+        self.table = sql_model.KeyedCarbonIntensityTable
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+        self.sqlite.tearDown()
+
+    def test_upsert_update(self):
+        """A record with the same time replaces the existing values."""
+        c1 = sql_model.CarbonIntensityRecord(**TEST_ARGS)  # type: ignore
+        c2 = sql_model.CarbonIntensityRecord(
+            **(TEST_ARGS | {'actual': 5, 'rating': 'low'}))  # type: ignore
+        self.table.add_from_db_model(self.engine, c1)
+        self.table.add_from_db_model(self.engine, c2)
+        results = self.table.read_all(self.engine, select(self.table))
+        self.assertEqual(results, [c2])
+
+    def test_upsert_nothing(self):
+        """With on-conflict 'nothing', the first record is kept."""
+        c1 = sql_model.CarbonIntensityRecord(**TEST_ARGS)  # type: ignore
+        c2 = sql_model.CarbonIntensityRecord(
+            **(TEST_ARGS | {'actual': 5, 'rating': 'low'}))  # type: ignore
+        with mock.patch.object(self.table, '__on_conflict__', 'nothing'):
+            self.table.add_from_db_model(self.engine, c1)
+            self.table.add_from_db_model(self.engine, c2)
+        results = self.table.read_all(self.engine, select(self.table))
+        self.assertEqual(results, [c1])
+
+    def test_upsert_unsupported_dialect(self):
+        with self.assertRaises(NotImplementedError):
+            self.table._insert_statement('mysql')
+
+    def test_selected(self):
+        self.assertIs(sql_model.carbon_intensity_table(natural_key=True),
+                      self.table)
+        self.assertIs(sql_model.carbon_intensity_table(),
+                      sql_model.CarbonIntensityTable)
+
+
+class TestCarbonIntensityTableAsync(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        try:
+            import aiosqlite  # noqa
+        except ImportError:
+            self.skipTest("aiosqlite is not installed")
+        self.sqlite = SQLiteHelper()
+        engine = create_engine(f"sqlite:///{self.sqlite.dbname}")
+        SQLModel.metadata.create_all(engine)
+        engine.dispose()
+        self.engine = create_async_engine(
+            f"sqlite+aiosqlite:///{self.sqlite.dbname}")
+
+    async def asyncTearDown(self) -> None:
+        await self.engine.dispose()
+
+    def tearDown(self) -> None:
+        self.sqlite.tearDown()
+
+    async def test_add_read(self):
+        carb = sql_model.CarbonIntensityRecord(**TEST_ARGS)  # type: ignore
+        await sql_model.CarbonIntensityTable.add_rows_async(
+            self.engine, [TEST_ARGS, TEST_ARGS])
+        results = await sql_model.CarbonIntensityTable.read_all_async(
+            self.engine, select(sql_model.CarbonIntensityTable))
+        self.assertEqual(results, [carb, carb])
+
+
+class TestTableIndexes(unittest.TestCase):
+
+    def test_time_index_from_natural_key(self):
+        """The time column is indexed once, by the natural key index."""
+        indexes = sql_model.KeyedCarbonIntensityTable.__table__.indexes
+        self.assertEqual([x.name for x in indexes],
+                         ['uq_carbonintensityrecord_natural_key'])
+        self.assertEqual([c.name for c in list(indexes)[0].columns],
+                         ['time'])
+
+    def test_time_index(self):
+        """Without a natural key, the time column gets its own index."""
+        class OtherRecord(sql_model.CarbonIntensityRecord):
+            pass
+
+        class OtherTable(OtherRecord, sql_model_base.DataModelTable[
+                             OtherRecord, source_model.CarbonIntensityData],
+                         table=True):
+            metadata = MetaData()
+            __time_column__ = 'time'
+            id: int | None = sql_model.sqlmodel.Field(default=None,
+                                                      primary_key=True)
+
+        indexes = OtherTable.__table__.indexes  # type: ignore
+        self.assertEqual([x.name for x in indexes], ['ix_otherrecord_time'])
+        self.assertNotIn('otherrecord', SQLModel.metadata.tables)
+
+
+class TestCopyRows(unittest.TestCase):
+    """Large batches are loaded with COPY on postgresql+psycopg2 only."""
+
+    def make_rows(self, n: int) -> list[dict]:
+        return [{'rating': 'moderate', 'forecast': i, 'actual': i,
+                 'time': datetime(2024, 1, 1 + i // 24, i % 24)}
+                for i in range(n)]
+
+    def test_use_copy(self):
+        table = sql_model.CarbonIntensityTable
+        threshold = table.__copy_threshold__
+        engine = create_engine("postgresql+psycopg2://user@host/db")
+        self.assertTrue(table._use_copy(engine, threshold))
+        self.assertFalse(table._use_copy(engine, threshold - 1))
+        with mock.patch.object(table, '__copy_threshold__', None):
+            self.assertFalse(table._use_copy(engine, threshold))
+        self.assertFalse(table._use_copy(create_engine("sqlite://"),
+                                         threshold))
+
+    def test_sqlite_fallback(self):
+        sqlite = SQLiteHelper()
+        engine = create_engine(f"sqlite:///{sqlite.dbname}")
+        SQLModel.metadata.create_all(engine)
+        table = sql_model.CarbonIntensityTable
+        with mock.patch.object(table, '__copy_threshold__', 1):
+            table.add_rows(engine, self.make_rows(5))
+        self.assertEqual(len(table.read_all(engine, select(table))), 5)
+        engine.dispose()
+        sqlite.tearDown()
+
+
+class TestReadCache(unittest.TestCase):
+    """Reads are cached on request, and invalidated by writes."""
+
+    def setUp(self) -> None:
+        self.sqlite = SQLiteHelper()
+        self.engine = create_engine(f"sqlite:///{self.sqlite.dbname}")
+        sql_model.keyed_metadata.create_all(self.engine)
+        self.table = sql_model.KeyedCarbonIntensityTable
+        self.table.cache_reads(maxsize=10, ttl=60)
+        self.addCleanup(self.table.cache_reads, 0)
+        self.table.add_rows(self.engine, TestCopyRows().make_rows(3))
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+        self.sqlite.tearDown()
+
+    def statement(self, forecast: int):
+        return select(self.table).where(self.table.forecast == forecast)
+
+    def test_hit(self):
+        first = self.table.read_all(self.engine, self.statement(1))
+        with mock.patch.object(sql_model_base, 'Session') as session:
+            second = self.table.read_all(self.engine, self.statement(1))
+        session.assert_not_called()
+        self.assertEqual(first, second)
+        self.assertIsNot(first[0], second[0])
+        self.assertEqual(self.table.read_cache_stats(),
+                         {'hits': 1, 'misses': 1, 'size': 1,
+                          'hit_rate': 0.5})
+
+    def test_parameters(self):
+        """Statements differing only in their parameters are distinct."""
+        self.assertEqual(
+            self.table.read_first(self.engine, self.statement(1)).forecast, 1)
+        self.assertEqual(
+            self.table.read_first(self.engine, self.statement(2)).forecast, 2)
+        self.assertEqual(self.table.read_cache_stats()['misses'], 2)
+
+    def test_invalidated_by_write(self):
+        self.assertEqual(
+            self.table.read_first(self.engine, self.statement(1)).actual, 1)
+        self.table.add_rows(self.engine, [
+            TestCopyRows().make_rows(3)[1] | {'actual': 100}])
+        self.assertEqual(self.table.read_cache_stats()['size'], 0)
+        self.assertEqual(
+            self.table.read_first(self.engine, self.statement(1)).actual, 100)
+
+    def test_expiry(self):
+        self.table.read_all(self.engine, self.statement(1))
+        self.table.__read_cache__.clock = lambda: float('inf')
+        self.table.read_all(self.engine, self.statement(1))
+        self.assertEqual(self.table.read_cache_stats()['misses'], 2)
+
+    def test_disabled(self):
+        self.table.cache_reads(0)
+        self.assertEqual(self.table.read_cache_stats(), {})
+        self.assertEqual(
+            len(self.table.read_all(self.engine, select(self.table))), 3)
+
+
+class TestPartitionedTable(unittest.TestCase):
+    """Partitioned by month on PostgreSQL, a single table elsewhere."""
+
+    table = sql_model.PartitionedCarbonIntensityTable
+
+    def setUp(self) -> None:
+        self.sqlite = SQLiteHelper()
+        self.engine = create_engine(f"sqlite:///{self.sqlite.dbname}")
+        sql_model.partitioned_metadata.create_all(self.engine)
+        self.table.forget_partitions()
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+        self.sqlite.tearDown()
+
+    def make_rows(self) -> list[dict]:
+        return [{'rating': 'low', 'forecast': i, 'actual': i,
+                 'time': datetime(2024, 1 + i, 15)} for i in range(3)]
+
+    def times(self) -> list[datetime]:
+        return [x.time for x in self.table.read_all(
+            self.engine, select(self.table).order_by(self.table.time))]
+
+    def test_separate_metadata(self):
+        self.assertNotIn(self.table.__table__, SQLModel.metadata.sorted_tables)
+        self.assertEqual(self.table.__tablename__,
+                         sql_model.CarbonIntensityTable.__tablename__)
+        self.assertIs(sql_model.carbon_intensity_table(True), self.table)
+        self.assertIs(sql_model.carbon_intensity_table(False),
+                      sql_model.CarbonIntensityTable)
+
+    def test_partition_ddl(self):
+        dialect = create_engine("postgresql+psycopg2://user@host/db").dialect
+        ddl = str(CreateTable(self.table.__table__).compile(dialect=dialect))
+        self.assertIn("PARTITION BY RANGE (time)", ddl)
+        self.assertIn("PRIMARY KEY (time)", ddl)
+        self.assertEqual(self.table.__table__.indexes, set())
+
+    def test_partition_column_in_natural_key(self):
+        with self.assertRaises(ValueError):
+            class _Table(  # pylint: disable=W0612
+                    sql_model.CarbonIntensityRecord,
+                    sql_model_base.DataModelTable[
+                        sql_model.CarbonIntensityRecord,
+                        source_model.CarbonIntensityData]):
+                __partition_by__ = 'time'
+
+    def test_create_partitions(self):
+        """Each month's partition is created once per process."""
+        connection = mock.Mock()
+        connection.dialect = create_engine(
+            "postgresql+psycopg2://user@host/db").dialect
+        self.table._create_partitions(connection, self.make_rows())
+        self.table._create_partitions(connection, self.make_rows()[:1])
+        statements = [str(x.args[0]) for x in
+                      connection.execute.call_args_list]
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(
+            statements[0],
+            "CREATE TABLE IF NOT EXISTS carbonintensityrecord_2024_01 "
+            "PARTITION OF carbonintensityrecord FOR VALUES FROM "
+            "('2024-01-01T00:00:00') TO ('2024-02-01T00:00:00')")
+
+    def test_forget_on_failure(self):
+        """Partitions created in a failed transaction are checked again."""
+        self.table.__partitions__.add(datetime(2024, 1, 1))
+        with mock.patch.object(self.table, '_write',
+                               side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.table.add_rows(self.engine, self.make_rows())
+        self.assertEqual(self.table.__partitions__, set())
+
+    def test_upsert(self):
+        self.table.add_rows(self.engine, self.make_rows())
+        self.table.add_rows(self.engine,
+                            [self.make_rows()[0] | {'actual': 100}])
+        self.assertEqual([x.actual for x in self.table.read_all(
+            self.engine, select(self.table).order_by(self.table.time))],
+            [100, 1, 2])
+
+    def test_drop_before(self):
+        """Whole months before the given time's month are deleted."""
+        self.table.add_rows(self.engine, self.make_rows())
+        self.table.drop_before(self.engine, datetime(2024, 2, 20))
+        self.assertEqual(self.times(),
+                         [datetime(2024, 2, 15), datetime(2024, 3, 15)])
+
+    def test_drop_before_unpartitioned(self):
+        engine = create_engine("sqlite://")
+        SQLModel.metadata.create_all(engine)
+        table = sql_model.CarbonIntensityTable
+        table.add_rows(engine, self.make_rows())
+        self.assertEqual(table.drop_before(engine, datetime(2024, 3, 1)), [])
+        self.assertEqual(len(table.read_all(engine, select(table))), 1)
+        engine.dispose()
+
+
+class TestPartitionedTablePSQL(TestPartitionedTable):
+
+    def setUp(self) -> None:
+        try:
+            self.db = PSQLHelper()
+        except KeyError:
+            self.skipTest("TEST_DB_* parameter(s) not set")
+        self.engine = create_engine(
+            f"{self.db.dialect_driver}://{self.db.user}:{self.db.password}@"
+            f"{self.db.host}:{self.db.port}/{self.db.dbname}")
+        sql_model.partitioned_metadata.create_all(self.engine)
+        self.table.forget_partitions()
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+        self.db.tearDown()
+
+    def test_drop_before(self):
+        """Expired partitions are dropped whole."""
+        self.table.add_rows(self.engine, self.make_rows())
+        self.assertEqual(
+            self.table.drop_before(self.engine, datetime(2024, 2, 20)),
+            ['carbonintensityrecord_2024_01'])
+        self.assertEqual(self.times(),
+                         [datetime(2024, 2, 15), datetime(2024, 3, 15)])
+        # The partition is created again if needed
+        self.table.add_rows(self.engine, self.make_rows()[:1])
+        self.assertEqual(len(self.times()), 3)
+
+class TestCompactTable(unittest.TestCase):
+    """The compact columns are read as the same values."""
+
+    table = sql_model.CompactCarbonIntensityTable
+
+    def setUp(self) -> None:
+        self.sqlite = SQLiteHelper()
+        self.engine = create_engine(f"sqlite:///{self.sqlite.dbname}")
+        sql_model.compact_metadata.create_all(self.engine)
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+        self.sqlite.tearDown()
+
+    def test_column_types(self):
+        dialect = create_engine("postgresql+psycopg2://user@host/db").dialect
+        ddl = str(CreateTable(self.table.__table__).compile(dialect=dialect))
+        for column in ["rating SMALLINT", "forecast SMALLINT",
+                       "actual SMALLINT", "time TIMESTAMP WITH TIME ZONE"]:
+            self.assertIn(column, ddl)
+
+    def test_round_trip(self):
+        rows = [{'rating': x, 'forecast': -i, 'actual': 400 + i,
+                 'time': datetime(2024, 1, 1, i)}
+                for i, x in enumerate(sql_model.RATINGS)]
+        self.table.add_rows(self.engine, rows)
+        results = self.table.read_all(self.engine,
+                                      select(self.table).order_by(
+                                          self.table.time))
+        self.assertEqual(results, [sql_model.CarbonIntensityRecord(**x)
+                                   for x in rows])
+
+    def test_rating_code(self):
+        rating = sql_model.RatingCode()
+        for i, x in enumerate(sql_model.RATINGS):
+            self.assertEqual(rating.process_bind_param(x, None), i)
+            self.assertEqual(rating.process_result_value(i, None), x)
+        self.assertIsNone(rating.process_bind_param(None, None))
+        with self.assertRaises(ValueError):
+            rating.process_bind_param('unknown', None)
+
+    def test_utc_datetime(self):
+        """Naive times are UTC; aware times are read as naive UTC."""
+        utc = sql_model.UTCDateTime()
+        naive = datetime(2024, 6, 1, 12)
+        aware = datetime(2024, 6, 1, 13, tzinfo=timezone(timedelta(hours=1)))
+        self.assertEqual(utc.process_bind_param(naive, None),
+                         naive.replace(tzinfo=timezone.utc))
+        self.assertEqual(utc.process_bind_param(aware, None),
+                         naive.replace(tzinfo=timezone.utc))
+        self.assertEqual(utc.process_result_value(aware, None), naive)
+        self.assertEqual(utc.process_result_value(naive, None), naive)
+
+    def test_copy_converts_values(self):
+        """COPY writes the encoded values, as INSERT does."""
+        dialect = create_engine("postgresql+psycopg2://user@host/db").dialect
+        connection = mock.MagicMock()
+        connection.dialect = dialect
+        cursor = connection.connection.cursor.return_value
+        loaded = []
+        cursor.copy_expert.side_effect = (
+            lambda sql, buffer: loaded.append(buffer.getvalue()))
+        self.table._copy_rows(connection, [
+            {'rating': 'high', 'forecast': 1, 'actual': 2,
+             'time': datetime(2024, 1, 1)}])
+        self.assertEqual(loaded[0].split(',')[0], '3')
+
+    def test_smallint_range(self):
+        """The intensities must fit SMALLINT when converted."""
+        payload = {"data": [{"from": "2024-01-01T18:30Z",
+                             "to": "2024-01-01T19:00Z",
+                             "intensity": {"forecast": 32767, "actual": None,
+                                           "index": "high"}}]}
+        self.assertEqual(sql_model.row_from_payload_compact(payload)[
+            'actual'], 32767)
+        payload['data'][0]['intensity']['actual'] = 32768
+        with self.assertRaises(ValueError):
+            sql_model.row_from_payload_compact(payload)
+        self.assertEqual(sql_model.row_from_payload(payload)['actual'],
+                         32768)
+        self.assertIs(sql_model.row_converter(self.table),
+                      sql_model.row_from_payload_compact)
+        self.assertIs(sql_model.row_converter(sql_model.CarbonIntensityTable),
+                      sql_model.row_from_payload)
+
+    def test_not_with_partitions(self):
+        with self.assertRaises(ValueError):
+            sql_model.carbon_intensity_table(partitioned=True, compact=True)
+
+
+class TestCopyRowsPSQL(TestCopyRows):
+
+    def setUp(self) -> None:
+        try:
+            self.db = PSQLHelper()
+        except KeyError:
+            self.skipTest("TEST_DB_* parameter(s) not set")
+        self.engine = create_engine(
+            f"{self.db.dialect_driver}://{self.db.user}:{self.db.password}@"
+            f"{self.db.host}:{self.db.port}/{self.db.dbname}")
+        SQLModel.metadata.create_all(self.engine)
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+        self.db.tearDown()
+
+    def test_copy_upsert(self):
+        """COPY updates existing rows, like INSERT."""
+        table = sql_model.CarbonIntensityTable
+        rows = self.make_rows(table.__copy_threshold__)
+        table.add_rows(self.engine, rows[:10])
+        with mock.patch.object(table, '_copy_rows',
+                               wraps=table._copy_rows) as copy_rows:
+            table.add_rows(self.engine,
+                           [x | {'actual': 0} for x in rows[:10]] + rows[10:])
+        copy_rows.assert_called_once()
+        results = table.read_all(self.engine,
+                                 select(table).order_by(table.time))
+        self.assertEqual(len(results), len(rows))
+        self.assertEqual([x.actual for x in results[:11]], [0]*10 + [10])
+
+    def test_copy_twice(self):
+        """Several COPY writes can be made in the same transaction."""
+        table = sql_model.CarbonIntensityTable
+        rows = self.make_rows(2 * table.__copy_threshold__)
+        with mock.patch.object(table, '_copy_rows',
+                               wraps=table._copy_rows) as copy_rows:
+            with self.engine.begin() as connection:
+                table.write_rows(connection, rows[::2])
+                table.write_rows(connection, rows[1::2])
+        self.assertEqual(copy_rows.call_count, 2)
+        self.assertEqual(len(table.read_all(self.engine, select(table))),
+                         len(rows))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,6 +2,8 @@ import unittest
 import sys
 import json
 
+import pydantic
+
 sys.path.append("function")
 
 from function import sqs_event  # noqa
@@ -34,6 +36,62 @@ class TestEvent(unittest.TestCase):
         self.assertEqual(len(payloads), 1)
         self.assertEqual(payloads[0], self.exp_payload)
 
+    def test_split(self):
+        records = sqs_event.split(self.event)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['messageId'],
+                         '825495f7-6822-4884-92cf-528f9c9bed27')
+
+    def test_split_empty(self):
+        with self.assertRaises(pydantic.ValidationError):
+            sqs_event.split({'Records': []})
+
+    def test_extract_record(self):
+        record = sqs_event.split(self.event)[0]
+        self.assertEqual(sqs_event.extract_record(record), self.exp_payload)
+
+    def test_extract_record_strict(self):
+        record = sqs_event.split(self.event)[0]
+        self.assertEqual(sqs_event.extract_record(record, strict=True),
+                         self.exp_payload)
+
+    def test_extract_strict(self):
+        payloads = list(sqs_event.extract(self.event, strict=True))
+        self.assertEqual(payloads, [self.exp_payload])
+
+    def test_extract_record_invalid(self):
+        for body in ['{}', '[]', 'not json', '{"responsePayload": 3}', None]:
+            record = dict(sqs_event.split(self.event)[0])
+            record['body'] = body
+            for strict in [True, False]:
+                with self.subTest(body=body, strict=strict):
+                    with self.assertRaises(ValueError):
+                        sqs_event.extract_record(record, strict)
+
+    def test_extract_record_no_message_id(self):
+        record = dict(sqs_event.split(self.event)[0])
+        del record['messageId']
+        with self.assertRaises(ValueError):
+            sqs_event.extract_record(record)
+
+    def test_lean_ignores_unused_fields(self):
+        """Fields which are not used are only checked in strict mode."""
+        record = dict(sqs_event.split(self.event)[0])
+        del record['receiptHandle']
+        self.assertEqual(sqs_event.extract_record(record), self.exp_payload)
+        with self.assertRaises(pydantic.ValidationError):
+            sqs_event.extract_record(record, strict=True)
+
+    def test_md5(self):
+        record = dict(sqs_event.split(self.event)[0])
+        self.assertEqual(sqs_event.extract_record(record, check_md5=True),
+                         self.exp_payload)
+        record['md5OfBody'] = '0' * 32
+        for strict in [True, False]:
+            with self.subTest(strict=strict):
+                with self.assertRaises(ValueError):
+                    sqs_event.extract_record(record, strict, check_md5=True)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,65 @@
+"""Unit tests for file startup.py"""
+import unittest
+import sys
+import json
+import tempfile
+import importlib
+from pathlib import Path
+
+sys.path.append("function")
+
+import startup  # type: ignore # noqa
+
+
+class TestStartupProfile(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        path = Path(self.temp_dir.name)
+        (path / 'startup_outer.py').write_text("import startup_inner\n")
+        (path / 'startup_inner.py').write_text("x = sum(range(1000))\n")
+        sys.path.insert(0, self.temp_dir.name)
+        self.lines: list[str] = []
+        self.profile = startup.StartupProfile(emit=self.lines.append)
+
+    def tearDown(self) -> None:
+        self.profile.stop()
+        sys.path.remove(self.temp_dir.name)
+        for name in ['startup_outer', 'startup_inner']:
+            sys.modules.pop(name, None)
+        self.temp_dir.cleanup()
+
+    def test_imports(self):
+        self.profile.start()
+        importlib.import_module('startup_outer')
+        self.profile.stop()
+        importlib.reload(sys.modules['startup_inner'])
+        imports = self.profile.imports
+        self.assertEqual(set(imports), {'startup_outer', 'startup_inner'})
+        outer_self, outer_cumulative = imports['startup_outer']
+        inner_self, inner_cumulative = imports['startup_inner']
+        self.assertEqual(inner_self, inner_cumulative)
+        self.assertAlmostEqual(outer_cumulative,
+                               outer_self + inner_cumulative)
+        self.assertAlmostEqual(self.profile.to_dict()['imports_ms'],
+                               outer_cumulative * 1e3)
+
+    def test_report(self):
+        with self.profile.phase('init'):
+            pass
+        self.profile.start()
+        self.profile.report(top=1)
+        self.assertNotIn(self.profile._finder, sys.meta_path)
+        report = json.loads(self.lines[0])['startup_profile']
+        self.assertEqual(list(report['phases_ms']), ['init'])
+        self.assertEqual(report['slowest_imports_ms'], {})
+
+    def test_null_profile(self):
+        profile = startup._NullProfile()
+        with profile.phase('init'):
+            pass
+        profile.report()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+"""Unit tests for file ttl_cache.py"""
+import unittest
+import sys
+
+sys.path.append("function")
+
+import ttl_cache  # type: ignore # noqa
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.now = 0.0
+        self.cache = ttl_cache.TTLCache(2, 10, clock=lambda: self.now)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('b', 0), 0)
+        self.assertEqual(self.cache.stats(),
+                         {'hits': 1, 'misses': 2, 'size': 1})
+
+    def test_expiry(self):
+        self.cache.set('a', 1)
+        self.now = 9.9
+        self.assertEqual(self.cache.get('a'), 1)
+        self.now = 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_least_recently_used_evicted(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def test_clear(self):
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_bad_size(self):
+        with self.assertRaises(ValueError):
+            ttl_cache.TTLCache(0, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()